@@ -1,87 +1,384 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-from flask_session import Session
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file, Response
 import os
 import io
 import random
 from PIL import Image
 import base64
+import contextvars
+import hashlib
+import json
 import logging
-import google.generativeai as genai
+import threading
 import time
 import uuid
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
 
-from config import MODEL_DISPLAY_NAMES, MODEL_NAMES_LIST, GOOGLE_SESSION_TOKEN, GEMINI_API_KEY
+from config import (
+    MODEL_DISPLAY_NAMES, MODEL_NAMES_LIST, GOOGLE_SESSION_TOKEN, GEMINI_API_KEY, REFERENCE_MAX_UPLOAD_BYTES,
+    RESULT_CACHE_MAX, RESULT_CACHE_TTL, METRICS_TOKEN, BATCH_CONCURRENCY, SESSION_MAX_RESULTS, HISTORY_PAGE_SIZE,
+    THUMBNAIL_MAX_SIDE, WARM_UP_AT_BOOT, IMAGE_WORKERS
+)
+from batch import BatchProgress, expand_batch, pack_items, parse_num_images
+from blob_store import reference_images, generated_images, thumbnails
+from cache import create_cache
+from coalescing import InflightCoalescer, request_fingerprint
+from history import generation_history, ensure_thumbnail
+from http_client import upstream, async_upstream
+from log_setup import setup_logging, bind_log_fields, session_tag
+from image_processing import reference_limits
+from language import language_memo, warm_up as warm_up_language_detection
+from metrics import registry, stage_timer, generation_errors, generations
+from prompt_service import prompt_service
+from scheduler import upstream_scheduler
+from session_store import create_session_interface
+from task_queue import FairExecutor, TaskQueue, QueueFullError, create_task_store
 from utils import (
-    main_generator_function, create_blank_image,
-    improve_and_translate_to_english, generate_magic_prompt_in_english, translate_to_english
+    main_generator_function, create_blank_image, normalize_reference_image,
+    improve_and_translate_to_english, generate_magic_prompt_in_english, translate_to_english,
+    translation_cache, media_id_cache
 )
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'una-clave-secreta-solo-para-desarrollo-local')
-app.config["SESSION_TYPE"] = "filesystem"
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_USE_SIGNER"] = True
-app.config["SESSION_FILE_DIR"] = "/tmp/flask_session"
 
-Session(app)
+# Endpoints que no leen ni modifican la sesión: reciben una sesión nula (ver session_store.py).
+SESSIONLESS_ENDPOINTS = {
+    'static', 'get_reference_image', 'get_generated_image', 'get_thumbnail', 'task_events', 'wait_for_task', 'metrics'
+}
+app.session_interface = create_session_interface(app, SESSIONLESS_ENDPOINTS)
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging()
 
-# --- SISTEMA DE TAREAS LIGERO CON HILOS (REEMPLAZA A CELERY/REDIS) ---
-tasks = {}
+# Lo pesado se carga al importar la app y no en la primera petición que lo
+# necesita; con gunicorn --preload, una sola vez en el máster.
+if WARM_UP_AT_BOOT:
+    logging.info("Language profiles loaded in %.2fs.", warm_up_language_detection())
+    prompt_service.preload()
 
-def run_generation_in_background(task_id, prompt_en, num_images, seed, selected_ratio, model_type, final_ref_images, save_images_flag):
-    """
-    Esta función se ejecutará en un hilo separado (en segundo plano).
-    Llama a la función de generación principal y guarda el resultado en el diccionario 'tasks'.
-    """
-    logging.info(f"Thread for task {task_id} started.")
+# --- COLA DE TAREAS: POOL FIJO DE HILOS + ALMACÉN COMPARTIDO ENTRE WORKERS ---
+task_store = create_task_store()
+task_queue = TaskQueue(task_store)
+# Generaciones idénticas en curso comparten una sola llamada al backend (las
+# de semilla aleatoria, sólo dentro de la misma sesión); las de semilla fija
+# (deterministas) se sirven además desde caché.
+generation_coalescer = InflightCoalescer()
+result_cache = create_cache('results', RESULT_CACHE_MAX, RESULT_CACHE_TTL)
+
+def load_reference_images(task_id, final_ref_images):
+    """Bytes de cada referencia, o None si alguna ya no está en el almacén."""
+    ref_images = []
+    with stage_timer('reference_load'):
+        for ref in final_ref_images:
+            # Los data URLs (lienzo en blanco de GEM_PIX) pasan tal cual; los IDs se leen del almacén.
+            image_bytes = ref if ref.startswith('data:') else reference_images.get(ref)
+            if image_bytes is None:
+                logging.error("Reference image %s for task %s is no longer available.", ref, task_id)
+                return None
+            ref_images.append(image_bytes)
+    return ref_images
+
+def generation_fingerprint(prompt_en, num_images, seed, selected_ratio, model_type, final_ref_images):
+    # Los IDs de referencia ya son el hash de la imagen normalizada.
+    ref_keys = [hashlib.sha256(ref.encode('utf-8')).hexdigest() if ref.startswith('data:') else ref for ref in final_ref_images]
+    return request_fingerprint(prompt_en, model_type, selected_ratio, seed, num_images, ref_keys)
+
+def coalescing_key(fingerprint, seed, session_id):
+    """Clave para unificar generaciones en curso: dos usuarios no deben recibir la misma imagen "aleatoria"."""
+    return fingerprint if int(seed) != -1 else f"{session_id}:{fingerprint}"
+
+def cached_generation(task_id, fingerprint, seed):
+    """Resultado guardado de una generación de semilla fija, si sus imágenes siguen en disco."""
+    if int(seed) == -1:
+        return None
+    cached = result_cache.get(fingerprint)
+    if cached and all(generated_images.exists(image_id) for image_id in cached['images']):
+        logging.info("Task %s served from the fixed-seed result cache.", task_id, extra={'event': 'task'})
+        return cached
+    return None
+
+def finish_generation(task_id, fingerprint, seed, result, shared):
+    if shared:
+        logging.info("Task %s reused an identical in-flight generation.", task_id, extra={'event': 'task'})
+    elif int(seed) != -1 and result.get('status') == 'success':
+        result_cache.set(fingerprint, result)
+    logging.info("Worker for task %s finished.", task_id, extra={'event': 'task'})
+    return record_generation(result, 'coalesced' if shared else 'upstream')
+
+# Miniaturas e historial, en hilos aparte una vez publicado el resultado: no
+# retrasan el SUCCESS de la tarea. Las miniaturas van al pool de procesos de
+# imágenes, así que hay un hilo por proceso de ese pool.
+history_writer = ThreadPoolExecutor(max_workers=max(1, IMAGE_WORKERS), thread_name_prefix="history")
+# session_id -> escrituras de historial en curso de esa sesión (ver get_history).
+_pending_history = {}
+_pending_history_lock = threading.Lock()
+
+def _add_to_history(session_id, image_ids, prompt, model_type, aspect_ratio):
+    # Primero las miniaturas: cuando la galería vea las entradas, ya están hechas.
+    for image_id in image_ids:
+        try:
+            ensure_thumbnail(image_id)
+        except Exception as e:
+            # /thumbnails/<id> la reintenta cuando la galería la pida.
+            logging.error("Thumbnail for image %s failed: %s", image_id, e)
     try:
-        result = main_generator_function(
-            prompt_en, num_images, seed, selected_ratio, model_type, final_ref_images, save_images_flag
-        )
-        tasks[task_id] = {'status': 'SUCCESS', 'result': result}
+        generation_history.add(session_id, image_ids, prompt, model_type, aspect_ratio)
     except Exception as e:
-        logging.error(f"Task {task_id} failed in background thread: {e}")
-        tasks[task_id] = {'status': 'FAILURE', 'result': {'status': 'error', 'message': 'La generación falló por un error inesperado.'}}
-    logging.info(f"Thread for task {task_id} finished.")
+        logging.error("Saving %d image(s) to history failed: %s", len(image_ids), e)
+
+def _history_written(session_id, future):
+    with _pending_history_lock:
+        pending = _pending_history.get(session_id)
+        if pending is not None:
+            pending.discard(future)
+            if not pending:
+                del _pending_history[session_id]
+
+def _queue_history(session_id, *args):
+    future = history_writer.submit(contextvars.copy_context().run, _add_to_history, session_id, *args)
+    with _pending_history_lock:
+        _pending_history.setdefault(session_id, set()).add(future)
+    future.add_done_callback(lambda f: _history_written(session_id, f))
+
+def wait_for_history(session_id, timeout):
+    """Espera (como mucho `timeout` s) a que se escriba el historial pendiente de esta sesión en este proceso."""
+    with _pending_history_lock:
+        pending = list(_pending_history.get(session_id, ()))
+    if pending:
+        futures_wait(pending, timeout=timeout)
+
+def save_to_history(session_id, result, prompt, model_type, aspect_ratio):
+    """Apunta en el historial de la sesión, en segundo plano, las imágenes de un resultado correcto."""
+    if session_id and result.get('status') == 'success':
+        _queue_history(session_id, result['images'], prompt, model_type, aspect_ratio)
+    return result
+
+def save_panels_to_history(session_id, call, result, model_type):
+    """Como save_to_history para una llamada de un lote: cada elemento con su prompt y relación de aspecto."""
+    if session_id and result.get('status') == 'success':
+        for item, images in zip(call, result.get('panels', [])):
+            if images:
+                _queue_history(session_id, images, item['prompt'], model_type, item['aspect_ratio'])
+
+def report_stage(task_id, key):
+    """on_stage de la generación: la etapa queda en la tarea y en las que esperan su resultado."""
+    def on_stage(stage):
+        task_store.update(task_id, stage=stage)
+        generation_coalescer.update(key, stage=stage)
+    return on_stage
+
+def report_upstream_turn(task_id, key=None):
+    """on_wait del planificador: la posición y la espera estimada quedan en la tarea (ver task_state)."""
+    def on_wait(position, eta):
+        fields = {'stage': 'waiting_upstream', 'queue_position': position, 'eta_seconds': eta}
+        task_store.update(task_id, **fields)
+        if key is not None:
+            generation_coalescer.update(key, **fields)
+    return on_wait
+
+def follow_generation(task_id):
+    """on_update de una tarea que espera la generación idéntica de otra: recibe sus etapas."""
+    return lambda **fields: task_store.update(task_id, **fields)
+
+def run_generation_in_background(task_id, prompt_es, num_images, seed, selected_ratio, model_type, final_ref_images, save_images_flag, session_id=None):
+    """
+    Esta función se ejecuta en uno de los hilos del pool de la cola de tareas.
+    Traduce el prompt (primera etapa, fuera de la petición HTTP), espera su
+    turno en el planificador del backend, llama a la función de generación
+    principal y devuelve su resultado; la cola se encarga de guardarlo en el
+    almacén de tareas.
+    """
+    logging.info("Worker for task %s started.", task_id, extra={'event': 'task'})
+    task_store.update(task_id, stage='translating')
+    with stage_timer('translate'):
+        prompt_en = translate_to_english(prompt_es)
+    ref_images = load_reference_images(task_id, final_ref_images)
+    if ref_images is None:
+        return record_generation({'status': 'error', 'message': 'generic_upload_error'}, 'reference_store')
+
+    fingerprint = generation_fingerprint(prompt_en, num_images, seed, selected_ratio, model_type, final_ref_images)
+    cached = cached_generation(task_id, fingerprint, seed)
+    if cached:
+        save_to_history(session_id, cached, prompt_es, model_type, selected_ratio)
+        return record_generation(cached, 'result_cache')
+
+    key = coalescing_key(fingerprint, seed, session_id)
+    result, shared = generation_coalescer.run(key, lambda: upstream_scheduler.run(
+        session_id, model_type, num_images, lambda: main_generator_function(
+            prompt_en, num_images, seed, selected_ratio, model_type, ref_images, save_images_flag,
+            on_stage=report_stage(task_id, key)
+        ), on_wait=report_upstream_turn(task_id, key)
+    ), on_update=follow_generation(task_id))
+    result = finish_generation(task_id, fingerprint, seed, result, shared)
+    save_to_history(session_id, result, prompt_es, model_type, selected_ratio)
+    return result
+
+# Llamadas de lotes, compartido por todos los lotes del proceso: un lote no
+# añade hilos propios a los de la cola de tareas, y las sesiones se turnan.
+batch_executor = FairExecutor(max(1, BATCH_CONCURRENCY), thread_name_prefix="batch")
+
+def run_batch_in_background(task_id, items, num_images, model_type, final_ref_images, save_images_flag, session_id=None):
+    """
+    Lote de /generate_batch (ver batch.py) en un hilo de la cola. Sus llamadas
+    al backend van en paralelo en batch_executor, por turnos con los lotes de
+    otras sesiones y cada una con su turno en el planificador (su posición y
+    espera quedan en la tarea), y publican sus imágenes en cuanto terminan.
+    """
+    logging.info("Batch task %s started with %d item(s).", task_id, len(items))
+    ref_images = load_reference_images(task_id, final_ref_images)
+    if ref_images is None:
+        return record_generation({'status': 'error', 'message': 'generic_upload_error'}, 'reference_store')
+    progress = BatchProgress(task_store, task_id, items)
+    task_store.update(task_id, stage='generating', **progress.fields())
+
+    def run_call(call):
+        def generate():
+            progress.upstream_turn(call)
+            return main_generator_function(
+                prompts_en, num_images, call[0]['seed'], call[0]['aspect_ratio'], model_type, ref_images, save_images_flag
+            )
+
+        try:
+            with stage_timer('translate'):
+                prompts_en = [translate_to_english(item['prompt']) for item in call]
+            result = upstream_scheduler.run(session_id, model_type, num_images * len(call), generate,
+                                            on_wait=lambda position, eta: progress.upstream_turn(call, position, eta))
+            save_panels_to_history(session_id, call, result, model_type)
+        except Exception as e:
+            progress.fail(call, e)
+        else:
+            progress.record(call, result)
+
+    calls = pack_items(items)
+    # Cada llamada hereda el contexto de la tarea para que sus tiempos cuenten en ella.
+    for future in [batch_executor.submit(session_id, contextvars.copy_context().run, run_call, call) for call in calls]:
+        future.result()
+    logging.info("Batch task %s finished: %d upstream call(s).", task_id, len(calls))
+    return record_generation(progress.result(), 'batch')
+
+# Lo que encolan /generate y /generate_batch. En modo asíncrono asgi.py los
+# cambia, junto con task_queue, por sus corrutinas equivalentes.
+generation_job = run_generation_in_background
+batch_job = run_batch_in_background
+# Si un worker se recicla con tareas en cola, otro las retoma (ver TaskQueue.register_job).
+task_queue.register_job('generate', run_generation_in_background)
+task_queue.register_job('batch', run_batch_in_background)
+
+# Claves de error que devuelve main_generator_function → mensaje para el usuario.
+ERROR_MESSAGES = {
+    "minor_upload_error": "La imagen de referencia no pudo ser procesada. Podría infringir las políticas de contenido (menores, contenido explícito). Prueba con otra imagen.",
+    "prominent_people_error": "La imagen de referencia parece contener personas famosas o contenido sensible. Por favor, intenta con una imagen diferente.",
+    "child_exploitation_error": "Se ha detectado contenido inaceptable en la imagen. Esta acción está estrictamente prohibida y no será procesada.",
+    "harmful_content_error": "La imagen de referencia parece contener elementos dañinos y no puede ser procesada. Por favor, usa otra.",
+    "generic_upload_error": "Hubo un problema al subir tu imagen. Asegúrate de que es un archivo válido (JPG/PNG) y no está dañado.",
+    "image_too_large": "¡La imagen es muy grande! Por favor, intenta con una imagen de menos de 10MB.",
+    "upload_failed: no_media_ids": "Ocurrió un error al subir la imagen de referencia. Por favor, inténtalo de nuevo.",
+    "unsafe_generation_error": "Tu descripción parece infringir las políticas de contenido seguro. Por favor, modifica el texto para continuar.",
+    "no_images_returned": "La IA no pudo generar un resultado para tu descripción. ¡Intenta ser más específico o prueba con una idea diferente!",
+    "auth_error": "Tu sesión parece haber caducado. Por favor, recarga la página para continuar.",
+    "connection_error: timeout": "La solicitud tardó demasiado en responder. Esto puede pasar con imágenes muy pesadas o una conexión lenta. Inténtalo de nuevo.",
+    "connection_error": "No se pudo conectar con el servidor de IA. Revisa tu conexión a internet y vuelve a intentarlo.",
+    "generic_api_error": "Ocurrió un error inesperado con la IA. Si el problema persiste, prueba con una descripción o imagen diferente."
+}
+
+def error_metric_key(message):
+    """Clave acotada para las métricas: 'connection_error: <detalle>' cuenta como 'connection_error'."""
+    message = message or 'generic_api_error'
+    return message if message in ERROR_MESSAGES else message.split(':', 1)[0].strip()
+
+def record_generation(result, source):
+    status = result.get('status', 'error')
+    generations.inc(source=source, status=status)
+    if status != 'success':
+        generation_errors.inc(error=error_metric_key(result.get('message')))
+    return result
+
+TERMINAL_TASK_STATES = {'done', 'error', 'not_found'}
+
+def queued_state(task_id):
+    position = task_queue.position(task_id)
+    return {'queue_position': position, 'eta_seconds': upstream_scheduler.eta_for_position(position)}
+
+def upstream_turn_state(task):
+    return {'queue_position': task.get('queue_position'), 'eta_seconds': task.get('eta_seconds')}
+
+def public_batch_items(items):
+    """Elementos de un lote con el mensaje de error para el usuario en lugar de la clave interna."""
+    return [{**item, 'error': ERROR_MESSAGES.get(item['error'], "Ocurrió un error inesperado.") if item['error'] else None}
+            for item in items]
+
+def task_state(task_id, task):
+    """
+    Estado público de una tarea: queued, running, translating, waiting_upstream,
+    uploading, generating, done, error o not_found. En queued y waiting_upstream
+    incluye queue_position y eta_seconds (estimación); en un lote en curso,
+    'batch' con el progreso, las imágenes de cada elemento ya terminado y, si
+    alguna llamada espera turno en el backend, su queue_position y eta_seconds.
+    """
+    if task is None:
+        return {'state': 'not_found'}
+    if task['status'] == 'PENDING':
+        return {'state': 'queued', **queued_state(task_id)}
+    if task['status'] == 'RUNNING':
+        if task.get('stage') == 'waiting_upstream':
+            return {'state': 'waiting_upstream', **upstream_turn_state(task)}
+        if 'batch_items' in task:
+            # Lote: cada elemento terminado ya trae sus imágenes (entrega progresiva).
+            batch = {'total': task['batch_total'], 'done': task['batch_done'], 'items': public_batch_items(task['batch_items'])}
+            if task.get('queue_position'):
+                # Turno de la siguiente llamada del lote que espera en el planificador.
+                batch.update(upstream_turn_state(task))
+            return {'state': task.get('stage') or 'running', 'batch': batch}
+        return {'state': task.get('stage') or 'running'}
+    if task['status'] == 'SUCCESS' and task['result'].get('status') == 'success':
+        return {'state': 'done'}
+    return {'state': 'error'}
 # -------------------------------------------------------------------------
 
+# Una visita a / tras este tiempo sin actividad empieza de cero.
+SESSION_TIMEOUT_MIN = 30
+# last_activity sólo se reescribe si tiene más de este tiempo: recargar la
+# página no obliga a guardar la sesión.
+SESSION_TOUCH_SECONDS = 60
+
+@app.before_request
+def start_task_queue():
+    # Hilos de trabajo y purga periódica, una vez por proceso (tras el fork de gunicorn).
+    task_queue.ensure_started()
+
+@app.before_request
+def bind_request_log_fields():
+    # Tarea y sesión de la petición en cada línea de log, sin cargar la sesión.
+    view_args = request.view_args or {}
+    bind_log_fields(task_id=view_args.get('task_id'), session=session_tag(getattr(session, 'known_sid', None)))
+
 @app.before_request
 def initialize_session():
-    if request.endpoint:
-        logging.info(f"Session before request: {session.sid if session.sid else 'No SID'}, Keys: {list(session.keys())}")
-
-        if 'results' not in session:
-            session['results'] = []
-        if 'reference_images_list' not in session:
-            session['reference_images_list'] = []
-        if 'save_images' not in session:
-            session['save_images'] = False
-
-        if 'active_tab' not in session:
-            session['active_tab'] = MODEL_NAMES_LIST[0]
-        if 'aspect_ratio_index' not in session:
-            session['aspect_ratio_index'] = 0
-        if 'last_prompt' not in session:
-            session['last_prompt'] = ''
-
-        SESSION_TIMEOUT_MIN = 30
-        if request.endpoint == 'index':
-            now = time.time()
-            last_activity = session.get('last_activity', 0)
-            if now - last_activity > SESSION_TIMEOUT_MIN * 60 or 'last_activity' not in session:
-                logging.info(f"New visit detected for SID {session.sid}: Cleaning old refs/results.")
-                session.clear()
-                session['last_activity'] = now
-            else:
-                session['last_activity'] = now
+    # Sólo la portada: el resto de rutas leen la sesión con valores por
+    # defecto y no la cargan ni la guardan si no la usan.
+    if request.endpoint != 'index':
+        return
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Session before request, keys: %s", list(session.keys()), extra={'event': 'session'})
+    # Sesiones anteriores guardaban data URLs completos; ahora sólo IDs.
+    if any(img.startswith('data:') for img in session.get('results', [])):
+        session['results'] = []
+    if any(ref.startswith('data:') for ref in session.get('reference_images_list', [])):
+        session['reference_images_list'] = []
+
+    now = time.time()
+    last_activity = session.get('last_activity')
+    if last_activity is None or now - last_activity > SESSION_TIMEOUT_MIN * 60:
+        logging.info("New visit detected: cleaning old refs/results.")
+        session.clear()
+        session['last_activity'] = now
+    elif now - last_activity > SESSION_TOUCH_SECONDS:
+        session['last_activity'] = now
 
 @app.route('/')
 def index():
-    logging.info(f"Rendering index.html. Active tab: {session.get('active_tab')}, Results count: {len(session.get('results', []))}")
+    logging.debug("Rendering index.html. Active tab: %s, Results count: %d",
+                  session.get('active_tab'), len(session.get('results', [])), extra={'event': 'session'})
     return render_template('index.html',
                            model_names_list=MODEL_NAMES_LIST,
                            active_tab=session.get('active_tab', MODEL_NAMES_LIST[0]),
@@ -91,6 +388,8 @@ def index():
                            save_images=session.get('save_images', False),
                            MODEL_DISPLAY_NAMES=MODEL_DISPLAY_NAMES,
                            MODEL_NAMES_LIST=MODEL_NAMES_LIST,
+                           REFERENCE_LIMITS=reference_limits(),
+                           THUMBNAIL_MAX_SIDE=THUMBNAIL_MAX_SIDE,
                            last_prompt=session.get('last_prompt', ''))
 
 @app.route('/improve_prompt', methods=['POST'])
@@ -102,10 +401,10 @@ def improve_prompt():
     
     try:
         improved_en = improve_and_translate_to_english(prompt)
-        logging.info(f"Prompt improved & translated for session {session.sid}: '{improved_en[:100]}...'")
+        logging.info("Prompt improved & translated: '%.100s...'", improved_en)
         return jsonify({'status': 'success', 'improved_prompt': improved_en})
     except Exception as e:
-        logging.error(f"Error in improve_prompt for session {session.sid}: {e}")
+        logging.error("Error in improve_prompt: %s", e)
         return jsonify({'status': 'error', 'message': f'Error al mejorar prompt: {str(e)}. Usando el original.'}), 500
 
 @app.route('/generate_magic_prompt', methods=['POST'])
@@ -114,7 +413,7 @@ def generate_magic_prompt():
         magic_en = generate_magic_prompt_in_english()
         return jsonify({'status': 'success', 'magic_prompt': magic_en})
     except Exception as e:
-        logging.error(f"Error in generate_magic_prompt for session {session.sid}: {e}")
+        logging.error("Error in generate_magic_prompt: %s", e)
         return jsonify({'status': 'error', 'message': f'Error al generar prompt mágico: {str(e)}.'}), 500    
 
 @app.route('/generate', methods=['POST'])
@@ -127,17 +426,18 @@ def generate_images():
     selected_ratio = data.get('aspect_ratio', '1:1')
     model_name_display = data.get('model_name_display')
     save_images_flag = data.get('save_images', False)
-    ref_images_data_urls = data.get('reference_images', [])
+    ref_image_ids = data.get('reference_images', session.get('reference_images_list', []))
     model_type = MODEL_DISPLAY_NAMES.get(model_name_display)
 
     if not prompt_es.strip():
         return jsonify({'status': 'error', 'message': 'Por favor, escribe una descripción.'}), 400
 
-    prompt_en = translate_to_english(prompt_es)
+    if not all(isinstance(ref, str) and reference_images.exists(ref) for ref in ref_image_ids):
+        return jsonify({'status': 'error', 'message': 'Alguna imagen de referencia ya no está disponible. Quítala y vuelve a subirla.'}), 400
 
     is_ref_model = model_type in ["R2I", "GEM_PIX"]
-    final_ref_images = ref_images_data_urls
-    if is_ref_model and not bool(ref_images_data_urls):
+    final_ref_images = ref_image_ids
+    if is_ref_model and not bool(ref_image_ids):
         if model_type == "R2I":
             return jsonify({'status': 'error', 'message': f"El modelo '{model_name_display}' requiere una imagen de referencia."}), 400
         elif model_type == "GEM_PIX":
@@ -150,59 +450,137 @@ def generate_images():
     if not GOOGLE_SESSION_TOKEN:
          return jsonify({'status': 'error', 'message': 'auth_error: GOOGLE_SESSION_TOKEN no configurado en el servidor.'}), 500
 
+    return enqueue_task(generation_job, prompt_es, num_images, seed, selected_ratio, model_type, final_ref_images, save_images_flag)
+
+@app.route('/generate_batch', methods=['POST'])
+def generate_batch():
+    """
+    Lote de generaciones: 'prompts' (lista) y, opcionalmente, 'aspect_ratios'
+    y 'seeds' para pedir todas las combinaciones; el resto de campos como en
+    /generate. Se sigue igual que una tarea normal: por /tasks/<id>/events o
+    /wait llegan las imágenes de cada elemento en cuanto están (campo 'batch')
+    y /check_task devuelve al final todas, con el detalle en 'items'.
+    """
+    data = request.get_json(silent=True) or {}
+    status, items = expand_batch(data)
+    if status == 'error':
+        return jsonify({'status': 'error', 'message': items}), 400
+    status, num_images = parse_num_images(data.get('num_images', 4))
+    if status == 'error':
+        return jsonify({'status': 'error', 'message': num_images}), 400
+    session['last_prompt'] = '\n'.join(dict.fromkeys(item['prompt'] for item in items))
+    model_name_display = data.get('model_name_display')
+    model_type = MODEL_DISPLAY_NAMES.get(model_name_display)
+    ref_image_ids = data.get('reference_images', session.get('reference_images_list', []))
+
+    if not all(isinstance(ref, str) and reference_images.exists(ref) for ref in ref_image_ids):
+        return jsonify({'status': 'error', 'message': 'Alguna imagen de referencia ya no está disponible. Quítala y vuelve a subirla.'}), 400
+    if model_type == "R2I" and not ref_image_ids:
+        return jsonify({'status': 'error', 'message': f"El modelo '{model_name_display}' requiere una imagen de referencia."}), 400
+    # GEM_PIX sin referencias: build_generation_request pone el lienzo en blanco de cada relación de aspecto.
+    if not GOOGLE_SESSION_TOKEN:
+        return jsonify({'status': 'error', 'message': 'auth_error: GOOGLE_SESSION_TOKEN no configurado en el servidor.'}), 500
+
+    return enqueue_task(batch_job, items, num_images, model_type, ref_image_ids, data.get('save_images', False))
+
+def enqueue_task(job, *args):
+    """Encola job(task_id, *args, session_id) en el turno de la sesión; 202 con la posición o 429 si la cola está llena."""
     task_id = str(uuid.uuid4())
-    tasks[task_id] = {'status': 'PENDING'}
-    
-    thread_args = (task_id, prompt_en, num_images, seed, selected_ratio, model_type, final_ref_images, save_images_flag)
-    thread = Thread(target=run_generation_in_background, args=thread_args)
-    thread.daemon = True
-    thread.start()
-    
-    return jsonify({'status': 'processing', 'task_id': task_id}), 202
+    try:
+        queue_position = task_queue.submit(task_id, job, *args, session.sid, fair_key=session.sid)
+    except QueueFullError as e:
+        logging.warning("Generation queue full: position %d.", e.queue_position)
+        response = jsonify({
+            'status': 'error',
+            'message': f'Hay muchas solicitudes en espera (serías la número {e.queue_position}). Inténtalo de nuevo en unos segundos.',
+            'queue_position': e.queue_position
+        })
+        response.headers['Retry-After'] = '10'
+        return response, 429
+
+    return jsonify({
+        'status': 'processing', 'task_id': task_id, 'queue_position': queue_position,
+        'eta_seconds': upstream_scheduler.eta_for_position(queue_position)
+    }), 202
 
 @app.route('/check_task/<task_id>', methods=['GET'])
 def check_task_status(task_id):
-    task = tasks.get(task_id)
+    """Con ?timings=1 el resultado final incluye los segundos de cada etapa."""
+    task = task_store.get(task_id)
     if not task:
         return jsonify({'status': 'error', 'message': 'Tarea no encontrada o expirada.'}), 404
+    extra = {'timings': task.get('timings', {})} if request.args.get('timings') == '1' else {}
 
     if task['status'] == 'PENDING':
-        return jsonify({'status': 'processing'})
+        return jsonify({'status': 'processing', **queued_state(task_id)})
+
+    elif task['status'] == 'RUNNING':
+        # Turno en el backend o progreso del lote, como en task_state.
+        details = {k: v for k, v in task_state(task_id, task).items() if k != 'state'}
+        return jsonify({'status': 'processing', **details})
         
     elif task['status'] == 'SUCCESS':
         result = task['result']
-        tasks.pop(task_id, None) 
+        task_store.delete(task_id)
+        if 'items' in result:
+            extra['items'] = public_batch_items(result['items'])
         if result['status'] == 'success':
-            session['results'] = result['images']
+            # Para recargar la página basta con los últimos; el resto sigue en /images.
+            session['results'] = result['images'][-SESSION_MAX_RESULTS:]
             session['save_images'] = result.get('save_images', False)
-            return jsonify({'status': 'success', 'images': result['images']})
+            return jsonify({'status': 'success', 'images': result['images'], **extra})
         else:
-            detailed_error_messages = {
-                "minor_upload_error": "La imagen de referencia no pudo ser procesada. Podría infringir las políticas de contenido (menores, contenido explícito). Prueba con otra imagen.",
-                "prominent_people_error": "La imagen de referencia parece contener personas famosas o contenido sensible. Por favor, intenta con una imagen diferente.",
-                "child_exploitation_error": "Se ha detectado contenido inaceptable en la imagen. Esta acción está estrictamente prohibida y no será procesada.",
-                "harmful_content_error": "La imagen de referencia parece contener elementos dañinos y no puede ser procesada. Por favor, usa otra.",
-                "generic_upload_error": "Hubo un problema al subir tu imagen. Asegúrate de que es un archivo válido (JPG/PNG) y no está dañado.",
-                "image_too_large": "¡La imagen es muy grande! Por favor, intenta con una imagen de menos de 10MB.",
-                "upload_failed: no_media_ids": "Ocurrió un error al subir la imagen de referencia. Por favor, inténtalo de nuevo.",
-                "unsafe_generation_error": "Tu descripción parece infringir las políticas de contenido seguro. Por favor, modifica el texto para continuar.",
-                "no_images_returned": "La IA no pudo generar un resultado para tu descripción. ¡Intenta ser más específico o prueba con una idea diferente!",
-                "auth_error": "Tu sesión parece haber caducado. Por favor, recarga la página para continuar.",
-                "connection_error: timeout": "La solicitud tardó demasiado en responder. Esto puede pasar con imágenes muy pesadas o una conexión lenta. Inténtalo de nuevo.",
-                "connection_error": "No se pudo conectar con el servidor de IA. Revisa tu conexión a internet y vuelve a intentarlo.",
-                "generic_api_error": "Ocurrió un error inesperado con la IA. Si el problema persiste, prueba con una descripción o imagen diferente."
-            }
             message_key = result.get('message', 'generic_api_error')
-            final_user_message = detailed_error_messages.get(message_key, "Ocurrió un error inesperado.")
-            return jsonify({'status': 'error', 'message': final_user_message})
+            final_user_message = ERROR_MESSAGES.get(message_key, "Ocurrió un error inesperado.")
+            return jsonify({'status': 'error', 'message': final_user_message, **extra})
             
     elif task['status'] == 'FAILURE':
         result = task['result']
-        tasks.pop(task_id, None)
-        return jsonify({'status': 'error', 'message': result.get('message')})
+        task_store.delete(task_id)
+        return jsonify({'status': 'error', 'message': result.get('message'), **extra})
     
     return jsonify({'status': 'processing'})
 
+# --- AVISOS DE CAMBIO DE ESTADO (SSE + LONG-POLL) ---
+# El cliente mantiene una conexión abierta y, al recibir 'done' o 'error',
+# hace una única llamada a /check_task para recoger el resultado.
+TASK_EVENTS_MAX_SECONDS = 300
+
+@app.route('/tasks/<task_id>/events', methods=['GET'])
+def task_events(task_id):
+    def stream():
+        started = time.time()
+        last_state = None
+        task = task_store.get(task_id)
+        yield "retry: 3000\n\n"
+        while True:
+            state = task_state(task_id, task)
+            if state != last_state:
+                yield f"data: {json.dumps(state)}\n\n"
+                last_state = state
+            else:
+                yield ": keep-alive\n\n"
+            if state['state'] in TERMINAL_TASK_STATES or time.time() - started > TASK_EVENTS_MAX_SECONDS:
+                return
+            # En cola la posición cambia sin que cambie la tarea: se refresca más a menudo.
+            timeout = 2 if state['state'] == 'queued' else 15
+            task = task_store.wait_for_update(task_id, task['updated'], timeout)
+
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/tasks/<task_id>/wait', methods=['GET'])
+def wait_for_task(task_id):
+    """Long-poll: responde en cuanto la tarea cambia después de `since` (o a los `timeout` s)."""
+    since = request.args.get('since', default=0.0, type=float)
+    timeout = min(request.args.get('timeout', default=25.0, type=float), 30.0)
+    task = task_store.wait_for_update(task_id, since, timeout)
+    state = task_state(task_id, task)
+    state['cursor'] = task['updated'] if task else since
+    return jsonify(state), 404 if task is None else 200
+
 @app.route('/update_session_settings', methods=['POST'])
 def update_session_settings():
     data = request.json  
@@ -222,29 +600,163 @@ def update_session_settings():
 
 @app.route('/add_reference_image', methods=['POST'])
 def add_reference_image():
-    data = request.json
-    image_data_url = data.get('image') 
-    if image_data_url and len(session['reference_images_list']) < 3:
-        if image_data_url not in session['reference_images_list']: 
-            session['reference_images_list'].append(image_data_url)
-    return jsonify({'status': 'success', 'reference_images': session['reference_images_list']})
+    """
+    Recibe una referencia como fichero multipart (campo 'image'), como el ID
+    de una imagen generada ('image_id') o como data URL en JSON. Se normaliza
+    una sola vez y se guarda en disco por su hash; en la sesión sólo queda el ID.
+    """
+    references = list(session.get('reference_images_list', []))
+    if len(references) >= 3:
+        return jsonify({'status': 'success', 'reference_images': references})
+    # Margen de ~4/3 para los data URLs en base64.
+    if request.content_length and request.content_length > REFERENCE_MAX_UPLOAD_BYTES * 1.4:
+        return jsonify({'status': 'error', 'message': '¡La imagen es muy grande! Por favor, intenta con una imagen de menos de 10MB.'}), 413
+
+    upload = request.files.get('image')
+    try:
+        data = {} if upload else (request.get_json(silent=True) or {})
+        if upload:
+            source = upload.stream
+        elif data.get('image_id'):
+            source = generated_images.path(data['image_id'])
+            if source is None:
+                return jsonify({'status': 'error', 'message': 'La imagen ya no está disponible. Vuelve a generarla.'}), 404
+        elif data.get('image'):
+            header, encoded = data['image'].split(",", 1)
+            source = base64.b64decode(encoded)
+        else:
+            return jsonify({'status': 'success', 'reference_images': references})
+        with stage_timer('reference_normalize'):
+            jpeg_bytes = normalize_reference_image(source)
+    except Exception as e:
+        logging.error("Invalid reference image: %s", e)
+        return jsonify({'status': 'error', 'message': 'Hubo un problema al procesar tu imagen. Asegúrate de que es un archivo válido (JPG/PNG) y no está dañado.'}), 400
+
+    image_id = reference_images.put(jpeg_bytes)
+    if image_id not in references:
+        references.append(image_id)
+        session['reference_images_list'] = references
+    return jsonify({'status': 'success', 'reference_images': references})
+
+@app.route('/images/<image_id>', methods=['GET'])
+def get_generated_image(image_id):
+    path = generated_images.path(image_id)
+    if path is None:
+        return jsonify({'status': 'error', 'message': 'Imagen no encontrada o expirada.'}), 404
+    # El ID es el hash del contenido: la URL nunca cambia de contenido.
+    response = send_file(path, mimetype=generated_images.content_type, etag=image_id, conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/thumbnails/<image_id>', methods=['GET'])
+def get_thumbnail(image_id):
+    """Miniatura WebP de una imagen generada; se hace aquí si no se llegó a hacer al generarla."""
+    try:
+        path = ensure_thumbnail(image_id)
+    except Exception as e:
+        logging.error("Thumbnail for image %s failed: %s", image_id, e)
+        path = None
+    if path is None:
+        return jsonify({'status': 'error', 'message': 'Imagen no encontrada o expirada.'}), 404
+    response = send_file(path, mimetype=thumbnails.content_type, etag=image_id, conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/history', methods=['GET'])
+def get_history():
+    """
+    Historial de la sesión, de lo más reciente a lo más antiguo, por páginas:
+    'next' es el cursor para pedir la siguiente con ?before=<next> (null al final).
+    """
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', default=HISTORY_PAGE_SIZE, type=int), HISTORY_PAGE_SIZE * 4))
+    # La galería se recarga justo al terminar una tarea: que estén ya sus imágenes.
+    wait_for_history(session.sid, timeout=2)
+    items, next_cursor = generation_history.page(session.sid, before, limit)
+    response = jsonify({'status': 'success', 'items': items, 'next': next_cursor})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/reference_images/<image_id>', methods=['GET'])
+def get_reference_image(image_id):
+    path = reference_images.path(image_id)
+    if path is None:
+        return jsonify({'status': 'error', 'message': 'Imagen no encontrada.'}), 404
+    response = send_file(path, mimetype=reference_images.content_type, etag=image_id, conditional=True)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 @app.route('/remove_reference_image/<int:index>', methods=['POST'])
 def remove_reference_image(index):
-    if 0 <= index < len(session['reference_images_list']):
-        session['reference_images_list'].pop(index)
-    return jsonify({'status': 'success', 'reference_images': session['reference_images_list']})
+    references = list(session.get('reference_images_list', []))
+    if 0 <= index < len(references):
+        references.pop(index)
+        session['reference_images_list'] = references
+    return jsonify({'status': 'success', 'reference_images': references})
 
 @app.route('/clear_session_results', methods=['POST'])
 def clear_session_results():
-    if 'results' in session:
+    if session:
         session['results'] = []
         session['reference_images_list'] = []
         session['save_images'] = False
         session['aspect_ratio_index'] = 0
         session['last_prompt'] = ''
-        logging.info(f"Reset complete for session {session.sid}: cleared results, references, save_images, and last_prompt.")
+        logging.info("Reset complete: cleared results, references, save_images, and last_prompt.")
     return jsonify({'status': 'success'})
 
+# --- MÉTRICAS (PROMETHEUS) ---
+# Valores por proceso: cada worker de gunicorn expone los suyos.
+GEMINI_BREAKER_STATES = ('closed', 'open', 'half_open')
+CACHES = {'translations': translation_cache, 'media_ids': media_id_cache, 'results': result_cache, 'language': language_memo}
+# El cliente asíncrono sólo se usa en modo ASGI; en modo síncrono sus contadores quedan a cero.
+UPSTREAM_CLIENTS = (upstream, async_upstream)
+
+def upstream_call_counts():
+    counts = {}
+    for client in UPSTREAM_CLIENTS:
+        for name, phase in client.stats()['phases'].items():
+            counts[(name,)] = counts.get((name,), 0) + phase['count']
+    return counts
+
+registry.gauge('task_queue_depth', 'Tasks waiting for a worker (all processes sharing the task store).',
+               callback=lambda: task_store.count_by_status().get('PENDING', 0))
+registry.gauge('tasks_outstanding', 'Tasks in the store by status, including finished results not yet collected.', ['status'],
+               callback=lambda: {(status,): count for status, count in task_store.count_by_status().items()})
+registry.gauge('generation_jobs_in_flight', 'Generations currently running in this process.',
+               callback=lambda: task_queue.running)
+registry.gauge('generation_coalesced_in_flight', 'Distinct in-flight generations other requests can join.',
+               callback=lambda: len(generation_coalescer))
+registry.gauge('cache_entries', 'Entries per cache.', ['cache'],
+               callback=lambda: {(name,): len(cache) for name, cache in CACHES.items()})
+registry.counter('cache_hits_total', 'Cache hits in this process.', ['cache'],
+                 callback=lambda: {(name,): cache.hits for name, cache in CACHES.items()})
+registry.counter('cache_misses_total', 'Cache misses in this process.', ['cache'],
+                 callback=lambda: {(name,): cache.misses for name, cache in CACHES.items()})
+registry.counter('upstream_requests_total', 'Completed upstream HTTP calls by call name.', ['call'],
+                 callback=upstream_call_counts)
+registry.counter('upstream_retries_total', 'Upstream retries after transient failures.',
+                 callback=lambda: sum(client.stats()['retries'] for client in UPSTREAM_CLIENTS))
+registry.counter('upstream_failures_total', 'Upstream calls that failed after all retries.',
+                 callback=lambda: sum(client.stats()['failures'] for client in UPSTREAM_CLIENTS))
+registry.gauge('upstream_connections_opened', 'Connections opened by the upstream keep-alive pool.',
+               callback=lambda: upstream.stats()['connections_opened'])
+registry.gauge('upstream_scheduler_limit_units', 'Current adaptive limit of concurrent upstream cost units.',
+               callback=lambda: upstream_scheduler.stats()['limit_units'])
+registry.gauge('upstream_scheduler_in_use_units', 'Upstream cost units currently granted.',
+               callback=lambda: upstream_scheduler.stats()['in_use_units'])
+registry.gauge('upstream_scheduler_waiting', 'Generations waiting for their upstream turn.',
+               callback=lambda: upstream_scheduler.stats()['waiting'])
+registry.counter('upstream_scheduler_backoffs_total', 'Times the upstream limit was halved after errors or slow responses.',
+                 callback=lambda: upstream_scheduler.stats()['backoffs'])
+registry.gauge('gemini_circuit_state', 'Gemini circuit breaker state (1 for the current one).', ['state'],
+               callback=lambda: {(state,): int(prompt_service.breaker.state == state) for state in GEMINI_BREAKER_STATES})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({'status': 'error', 'message': 'No autorizado.'}), 401
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
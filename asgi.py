@@ -0,0 +1,408 @@
+# asgi.py
+"""
+Modo asíncrono (opcional). Las generaciones, las esperas de estado de las
+tareas (SSE y long-poll) y las llamadas a Gemini de /improve_prompt y
+/generate_magic_prompt corren como corrutinas en el bucle de eventos, así que
+miles de esperas al backend cuestan corrutinas y no hilos. El resto de rutas
+(/, /generate, /check_task, referencias, imágenes, /metrics...) siguen siendo
+las de Flask y se ejecutan en un pool de hilos (ASGI_WSGI_THREADS); /generate
+sólo encola la tarea, que luego corre en el bucle.
+
+    pip install httpx uvicorn
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+El modo síncrono (gunicorn app:app) no cambia y no necesita estas dependencias.
+"""
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+try:
+    import httpx  # noqa: F401 (lo usan http_client y async_generation)
+except ImportError as e:
+    raise ImportError("Async mode requires httpx and an ASGI server: pip install httpx uvicorn") from e
+
+import app as web
+from async_generation import (
+    main_generator_function_async, improve_and_translate_to_english_async,
+    generate_magic_prompt_in_english_async, translate_to_english_async
+)
+from batch import BatchProgress, pack_items
+from coalescing import AsyncInflightCoalescer
+from config import ASGI_WSGI_THREADS, BATCH_CONCURRENCY
+from http_client import async_upstream
+from metrics import stage_timer
+from scheduler import upstream_scheduler
+from task_queue import AsyncTaskQueue
+
+# httpx registra cada petición a nivel INFO.
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# --- GENERACIÓN EN EL BUCLE DE EVENTOS ---
+task_queue = AsyncTaskQueue(web.task_store)
+generation_coalescer = AsyncInflightCoalescer()
+
+# El almacén de tareas, las cachés y el historial (SQLite, disco) bloquean:
+# todo lo que los toca va a un hilo, para no frenar al resto de tareas del bucle.
+def report_stage_async(task_id, key):
+    """Como app.report_stage, para main_generator_function_async."""
+    async def on_stage(stage):
+        await asyncio.to_thread(web.task_store.update, task_id, stage=stage)
+        await generation_coalescer.update(key, stage=stage)
+    return on_stage
+
+def report_upstream_turn_async(task_id, key):
+    """Como app.report_upstream_turn, para upstream_scheduler.run_async."""
+    async def on_wait(position, eta):
+        fields = {'stage': 'waiting_upstream', 'queue_position': position, 'eta_seconds': eta}
+        await asyncio.to_thread(web.task_store.update, task_id, **fields)
+        await generation_coalescer.update(key, **fields)
+    return on_wait
+
+def follow_generation_async(task_id):
+    """Como app.follow_generation."""
+    return lambda **fields: asyncio.to_thread(web.task_store.update, task_id, **fields)
+
+async def run_generation_async(task_id, prompt_es, num_images, seed, selected_ratio, model_type, final_ref_images, save_images_flag, session_id=None):
+    """Corrutina equivalente a app.run_generation_in_background."""
+    logging.info("Worker for task %s started.", task_id, extra={'event': 'task'})
+    await asyncio.to_thread(web.task_store.update, task_id, stage='translating')
+    with stage_timer('translate'):
+        prompt_en = await translate_to_english_async(prompt_es)
+    ref_images = await asyncio.to_thread(web.load_reference_images, task_id, final_ref_images)
+    if ref_images is None:
+        return web.record_generation({'status': 'error', 'message': 'generic_upload_error'}, 'reference_store')
+
+    fingerprint = web.generation_fingerprint(prompt_en, num_images, seed, selected_ratio, model_type, final_ref_images)
+    cached = await asyncio.to_thread(web.cached_generation, task_id, fingerprint, seed)
+    if cached:
+        web.save_to_history(session_id, cached, prompt_es, model_type, selected_ratio)
+        return web.record_generation(cached, 'result_cache')
+
+    key = web.coalescing_key(fingerprint, seed, session_id)
+    result, shared = await generation_coalescer.run(key, lambda: upstream_scheduler.run_async(
+        session_id, model_type, num_images, lambda: main_generator_function_async(
+            prompt_en, num_images, seed, selected_ratio, model_type, ref_images, save_images_flag,
+            on_stage=report_stage_async(task_id, key)
+        ), on_wait=report_upstream_turn_async(task_id, key)
+    ), on_update=follow_generation_async(task_id))
+    result = await asyncio.to_thread(web.finish_generation, task_id, fingerprint, seed, result, shared)
+    # Sólo encola la escritura del historial (ver app.history_writer).
+    web.save_to_history(session_id, result, prompt_es, model_type, selected_ratio)
+    return result
+
+# Llamadas de lotes a la vez por sesión. Como en las generaciones, el turno
+# entre sesiones lo da el planificador del backend, al que llegan todas: un lote
+# grande no pasa por delante del de otra sesión.
+_batch_slots = {}
+
+@contextlib.asynccontextmanager
+async def batch_slot(session_id):
+    slot = _batch_slots.get(session_id)
+    if slot is None:
+        # [semáforo, lotes que lo usan]; se descarta cuando ya nadie lo usa.
+        slot = _batch_slots[session_id] = [asyncio.Semaphore(max(1, BATCH_CONCURRENCY)), 0]
+    slot[1] += 1
+    try:
+        async with slot[0]:
+            yield
+    finally:
+        slot[1] -= 1
+        if not slot[1]:
+            del _batch_slots[session_id]
+
+async def run_batch_async(task_id, items, num_images, model_type, final_ref_images, save_images_flag, session_id=None):
+    """Corrutina equivalente a app.run_batch_in_background."""
+    logging.info("Batch task %s started with %d item(s).", task_id, len(items))
+    ref_images = await asyncio.to_thread(web.load_reference_images, task_id, final_ref_images)
+    if ref_images is None:
+        return web.record_generation({'status': 'error', 'message': 'generic_upload_error'}, 'reference_store')
+    progress = BatchProgress(web.task_store, task_id, items)
+    await asyncio.to_thread(web.task_store.update, task_id, stage='generating', **progress.fields())
+
+    async def generate(call, prompts_en):
+        await asyncio.to_thread(progress.upstream_turn, call)
+        return await main_generator_function_async(
+            prompts_en, num_images, call[0]['seed'], call[0]['aspect_ratio'], model_type, ref_images, save_images_flag
+        )
+
+    async def run_call(call):
+        async def on_wait(position, eta):
+            await asyncio.to_thread(progress.upstream_turn, call, position, eta)
+
+        async with batch_slot(session_id):
+            try:
+                with stage_timer('translate'):
+                    prompts_en = [await translate_to_english_async(item['prompt']) for item in call]
+                result = await upstream_scheduler.run_async(session_id, model_type, num_images * len(call),
+                                                            lambda: generate(call, prompts_en), on_wait=on_wait)
+                web.save_panels_to_history(session_id, call, result, model_type)
+            except Exception as e:
+                await asyncio.to_thread(progress.fail, call, e)
+            else:
+                await asyncio.to_thread(progress.record, call, result)
+
+    calls = pack_items(items)
+    await asyncio.gather(*(run_call(call) for call in calls))
+    logging.info("Batch task %s finished: %d upstream call(s).", task_id, len(calls))
+    return web.record_generation(progress.result(), 'batch')
+
+# /generate y /generate_batch (Flask) encolan con task_queue, generation_job y
+# batch_job: se sustituyen por las versiones asíncronas. Las métricas leen
+# también estos nombres.
+web.task_queue = task_queue
+web.generation_job = run_generation_async
+web.batch_job = run_batch_async
+task_queue.register_job('generate', run_generation_async)
+task_queue.register_job('batch', run_batch_async)
+web.generation_coalescer = generation_coalescer
+
+
+# --- UTILIDADES ASGI ---
+class _ClientDisconnected(Exception):
+    pass
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise _ClientDisconnected()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _send_json(send, payload, status=200):
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+def _float_arg(scope, name, default):
+    values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(name)
+    try:
+        return float(values[0]) if values else default
+    except ValueError:
+        return default
+
+
+# --- RUTAS ASÍNCRONAS ---
+async def improve_prompt(scope, receive, send):
+    try:
+        data = json.loads(await _read_body(receive) or b'{}')
+    except ValueError:
+        data = {}
+    prompt = str(data.get('prompt', '')).strip()
+    if not prompt:
+        return await _send_json(send, {'status': 'error', 'message': 'Escribe un prompt para mejorar.'}, 400)
+
+    try:
+        improved_en = await improve_and_translate_to_english_async(prompt)
+        logging.info("Prompt improved & translated: '%.100s...'", improved_en)
+        await _send_json(send, {'status': 'success', 'improved_prompt': improved_en})
+    except Exception as e:
+        logging.error("Error in improve_prompt: %s", e)
+        await _send_json(send, {'status': 'error', 'message': f'Error al mejorar prompt: {str(e)}. Usando el original.'}, 500)
+
+async def generate_magic_prompt(scope, receive, send):
+    try:
+        magic_en = await generate_magic_prompt_in_english_async()
+        await _send_json(send, {'status': 'success', 'magic_prompt': magic_en})
+    except Exception as e:
+        logging.error("Error in generate_magic_prompt: %s", e)
+        await _send_json(send, {'status': 'error', 'message': f'Error al generar prompt mágico: {str(e)}.'}, 500)
+
+async def task_events(scope, receive, send, task_id):
+    """Mismo flujo SSE que app.task_events; termina también si el cliente se desconecta."""
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')
+    ]})
+
+    async def emit(text):
+        await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+    disconnected = asyncio.create_task(_wait_for_disconnect(receive))
+    try:
+        started = time.time()
+        last_state = None
+        task = await asyncio.to_thread(web.task_store.get, task_id)
+        await emit("retry: 3000\n\n")
+        while True:
+            # La posición en la cola se lee del almacén.
+            state = await asyncio.to_thread(web.task_state, task_id, task)
+            if state != last_state:
+                await emit(f"data: {json.dumps(state)}\n\n")
+                last_state = state
+            else:
+                await emit(": keep-alive\n\n")
+            if state['state'] in web.TERMINAL_TASK_STATES or time.time() - started > web.TASK_EVENTS_MAX_SECONDS:
+                break
+            timeout = 2 if state['state'] == 'queued' else 15
+            waiting = asyncio.create_task(web.task_store.wait_for_update_async(task_id, task['updated'], timeout))
+            await asyncio.wait({waiting, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not waiting.done():
+                waiting.cancel()
+                return
+            task = waiting.result()
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+
+async def wait_for_task(scope, receive, send, task_id):
+    """Long-poll: igual que app.wait_for_task."""
+    since = _float_arg(scope, 'since', 0.0)
+    timeout = min(_float_arg(scope, 'timeout', 25.0), 30.0)
+    task = await web.task_store.wait_for_update_async(task_id, since, timeout)
+    state = await asyncio.to_thread(web.task_state, task_id, task)
+    state['cursor'] = task['updated'] if task else since
+    await _send_json(send, state, 404 if task is None else 200)
+
+ROUTES = [
+    ('POST', re.compile(r'/improve_prompt'), improve_prompt),
+    ('POST', re.compile(r'/generate_magic_prompt'), generate_magic_prompt),
+    ('GET', re.compile(r'/tasks/(?P<task_id>[^/]+)/events'), task_events),
+    ('GET', re.compile(r'/tasks/(?P<task_id>[^/]+)/wait'), wait_for_task),
+]
+
+
+# --- PUENTE HACIA LA APP DE FLASK ---
+class WSGIBridge:
+    """
+    Ejecuta una app WSGI en un pool de hilos. El cuerpo de la respuesta se
+    envía por bloques de hasta `block_size` bytes, pidiendo cada bloque al
+    pool para no leer ficheros desde el bucle de eventos.
+    """
+
+    block_size = 256 * 1024
+
+    def __init__(self, wsgi_app, threads=ASGI_WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+    @staticmethod
+    def _environ(scope, body):
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _next_block(self, chunks):
+        block = bytearray()
+        for chunk in chunks:
+            block += chunk
+            if len(block) >= self.block_size:
+                break
+        return bytes(block)
+
+    async def __call__(self, scope, receive, send):
+        environ = self._environ(scope, await _read_body(receive))
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        def call_app():
+            result = self.wsgi_app(environ, start_response)
+            chunks = iter(result)
+            # Flask llama a start_response antes de devolver el cuerpo; se lee
+            # el primer bloque aquí por si otra app lo hace al iterar.
+            return result, chunks, self._next_block(chunks)
+
+        result, chunks, block = await loop.run_in_executor(self.executor, call_app)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while block:
+                await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+                block = await loop.run_in_executor(self.executor, self._next_block, chunks)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+
+
+# --- APLICACIÓN ASGI ---
+class AsyncApp:
+    def __init__(self, wsgi_app):
+        self.wsgi = WSGIBridge(wsgi_app)
+
+    def _start(self):
+        if task_queue.loop is None:
+            task_queue.start(asyncio.get_running_loop())
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_upstream.aclose()
+                self.wsgi.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        # Por si el servidor no envía eventos lifespan.
+        self._start()
+        try:
+            for method, pattern, handler in ROUTES:
+                match = pattern.fullmatch(scope['path'])
+                if match and scope['method'] == method:
+                    return await handler(scope, receive, send, **match.groupdict())
+            await self.wsgi(scope, receive, send)
+        except _ClientDisconnected:
+            logging.info("Client disconnected before sending the full request to %s.", scope['path'])
+
+
+application = AsyncApp(web.app)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host='0.0.0.0', port=int(os.getenv('PORT', '5000')))
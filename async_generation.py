@@ -0,0 +1,238 @@
+# async_generation.py
+"""
+Versión asíncrona del flujo de generación para el modo ASGI (ver asgi.py).
+Reutiliza de utils la construcción de peticiones y el tratamiento de
+respuestas; sólo cambia la espera al backend y a Gemini, que aquí son
+corrutinas (httpx y el cliente async del SDK) en lugar de hilos bloqueados.
+"""
+import asyncio
+import logging
+import time
+
+import httpx
+
+from config import UPLOAD_CONCURRENCY, MAX_RESPONSE_BYTES
+from blob_store import generated_images
+from http_client import async_upstream, generate_url
+from metrics import observe_stage, stage_timer
+from prompt_service import prompt_service, PromptServiceUnavailable
+from response_parser import EncodedImageExtractor, ResponseTooLarge, aiter_limited, aread_limited
+from utils import (
+    is_english, translation_cache, _prompt_cache_key,
+    build_upload_request, parse_upload_response, prepare_reference_upload, remember_media_id,
+    build_generation_request, set_reference_media, collect_generation_result, parse_generation_error,
+    _is_media_not_found
+)
+
+
+# --- TRADUCCIÓN / MEJORA / PROMPT MÁGICO ---
+# Las cachés (SQLite, Redis) y langdetect bloquean: van a un hilo para no
+# frenar al resto de tareas del bucle.
+async def translate_to_english_async(prompt: str) -> str:
+    if await asyncio.to_thread(is_english, prompt):
+        logging.debug("Prompt detected as English. Skipping translation.")
+        return prompt.strip()
+    if not prompt_service.enabled:
+        logging.warning("GEMINI_API_KEY not set. Using original prompt.")
+        return prompt.strip()
+    prompt = prompt.strip()
+    key = _prompt_cache_key('translate', prompt)
+    cached = await asyncio.to_thread(translation_cache.get, key)
+    if cached:
+        return cached
+    try:
+        translated = await prompt_service.translate_async(prompt)
+    except PromptServiceUnavailable as e:
+        logging.error("Gemini translation failed: %s", e)
+        return prompt
+    if not translated:
+        return prompt
+    await asyncio.to_thread(translation_cache.set, key, translated)
+    return translated
+
+
+async def improve_and_translate_to_english_async(original_prompt: str) -> str:
+    if not prompt_service.enabled:
+        logging.warning("GEMINI_API_KEY not set. Using original prompt.")
+        return original_prompt
+
+    key = _prompt_cache_key('improve', original_prompt)
+    cached = await asyncio.to_thread(translation_cache.get, key)
+    if cached:
+        return cached
+    try:
+        improved = await prompt_service.improve_async(original_prompt)
+        logging.info("Improved & translated: '%.50s...' → '%.50s...'", original_prompt, improved)
+    except PromptServiceUnavailable as e:
+        logging.error("Gemini improve+translate failed: %s", e)
+        return original_prompt
+    if not improved:
+        return original_prompt
+    await asyncio.to_thread(translation_cache.set, key, improved)
+    return improved
+
+
+async def generate_magic_prompt_in_english_async() -> str:
+    if not prompt_service.enabled:
+        logging.warning("GEMINI_API_KEY not set. Using fallback magic prompt.")
+        return "A surreal floating island with glowing waterfalls, ancient ruins, and a golden sky at sunset, ultra-detailed, cinematic lighting"
+
+    try:
+        magic_en = await prompt_service.magic_async()
+        logging.info("Magic prompt generated (EN): '%.100s...'", magic_en)
+        return magic_en if magic_en else "A majestic dragon soaring over a crystal lake at dawn, mist rising, ultra-realistic"
+    except PromptServiceUnavailable as e:
+        logging.error("Gemini magic prompt failed: %s", e)
+        return "A cyberpunk city at night with neon lights reflecting on wet streets, flying cars, ultra-detailed"
+
+
+# --- SUBIDA DE REFERENCIAS ---
+async def upload_image_bytes_async(bearer_token, x_client_data, jpeg_bytes):
+    status, request = build_upload_request(bearer_token, x_client_data, jpeg_bytes)
+    if status == 'error':
+        return (status, request)
+    real_upload_url, headers, payload = request
+
+    try:
+        response = await async_upstream.post('upload', real_upload_url, read_timeout=60, headers=headers, json=payload)
+        return parse_upload_response(response.status_code, response.content)
+    except httpx.TimeoutException:
+        return ('error', 'connection_error: upload_timeout')
+    except Exception as e:
+        logging.error("Upload exception: %s", e)
+        return ('error', f'connection_error: {str(e)}')
+
+
+async def upload_reference_images_async(bearer_token, x_client_data, ref_images, max_concurrency=UPLOAD_CONCURRENCY, use_cache=True):
+    """
+    Igual que utils.upload_reference_images. El preprocesado (CPU) va a un
+    hilo; las subidas son corrutinas y, tras el primer error, se cancelan.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def _upload_one(i, ref_image):
+        async with semaphore:
+            try:
+                media_id, jpeg_bytes, keys = await asyncio.to_thread(prepare_reference_upload, ref_image, use_cache)
+            except Exception as e:
+                logging.error("Error decoding ref image %d: %s", i, e)
+                return ('error', 'generic_upload_error')
+            if media_id:
+                return ('success', media_id)
+            with stage_timer('upload'):
+                status, msg = await upload_image_bytes_async(bearer_token, x_client_data, jpeg_bytes)
+            if status == 'error':
+                logging.info("Upload of reference image %d failed: %s", i, msg)
+            else:
+                await asyncio.to_thread(remember_media_id, keys, msg)
+            return (status, msg)
+
+    uploads = [asyncio.create_task(_upload_one(i, ref_image)) for i, ref_image in enumerate(ref_images)]
+    try:
+        for next_done in asyncio.as_completed(uploads):
+            status, msg = await next_done
+            if status == 'error':
+                return ('error', msg)
+        return ('success', [upload.result()[1] for upload in uploads])
+    finally:
+        for upload in uploads:
+            upload.cancel()
+
+
+# --- GENERACIÓN ---
+async def _extract_images(response):
+    # Decodificar el base64 y escribir los ficheros, en un hilo; los bloques
+    # se entregan en orden porque cada uno espera al anterior.
+    extractor = EncodedImageExtractor(generated_images.writer)
+    try:
+        async for chunk in aiter_limited(response, MAX_RESPONSE_BYTES):
+            await asyncio.to_thread(extractor.feed, chunk)
+        return await asyncio.to_thread(extractor.finish)
+    finally:
+        # Sólo borra el fichero a medias, si lo hay; síncrono para que también ocurra al cancelar.
+        extractor.abort()
+
+
+async def _read_generation_response(prompt, response, error_body, start_time):
+    logging.info("API responded in %.2f seconds, status: %s", time.time() - start_time, response.status_code,
+                 extra={'event': 'upstream'})
+    if response.status_code != 200:
+        if error_body is None:
+            error_body = await aread_limited(response, MAX_RESPONSE_BYTES)
+        return parse_generation_error(error_body)
+    try:
+        with stage_timer('decode'):
+            skeleton, stored_ids = await _extract_images(response)
+    except (ResponseTooLarge, httpx.HTTPError):
+        raise
+    except Exception as e:
+        logging.error("Error processing 200 OK API response: %s", e)
+        return {'status': 'error', 'message': f'generic_api_error: {str(e)}'}
+    return collect_generation_result(prompt, skeleton, stored_ids)
+
+
+async def _ignore_stage(stage):
+    pass
+
+
+async def main_generator_function_async(prompt, num_images, seed, aspect_ratio_str, model_type, ref_images, save_images_flag=False, on_stage=None):
+    """
+    Corrutina equivalente a utils.main_generator_function (mismos resultados y
+    errores); aquí on_stage es una corrutina.
+    """
+    on_stage = on_stage or _ignore_stage
+    status, request = build_generation_request(prompt, num_images, seed, aspect_ratio_str, model_type, ref_images)
+    if status == 'error':
+        return request
+    bearer_token, x_client_data = request['bearer_token'], request['x_client_data']
+    headers, payload, ref_images = request['headers'], request['payload'], request['ref_images']
+
+    if ref_images:
+        await on_stage('uploading')
+        status, result = await upload_reference_images_async(bearer_token, x_client_data, ref_images)
+        if status == 'error':
+            return {'status': 'error', 'message': result}
+        media_ids = result
+        if not media_ids:
+            logging.info("No media IDs after upload process for reference images.")
+            return {'status': 'error', 'message': 'upload_failed: no_media_ids'}
+        set_reference_media(payload, media_ids)
+        logging.debug("Payload includes %d reference image(s).", len(media_ids))
+
+    await on_stage('generating')
+    try:
+        real_generate_url = generate_url()
+        logging.debug("Sending request to: %s with payload: %s", real_generate_url, payload)
+        start_time = time.time()
+        sent = time.perf_counter()
+        async with async_upstream.stream('generate', real_generate_url, read_timeout=180, idempotent=False, headers=headers, json=payload) as response:
+            observe_stage('upstream', time.perf_counter() - sent)
+            error_body = None
+            if response.status_code != 200:
+                error_body = await aread_limited(response, MAX_RESPONSE_BYTES)
+            if not (ref_images and _is_media_not_found(response.status_code, error_body, payload)):
+                return await _read_generation_response(prompt, response, error_body, start_time)
+
+        # Algún mediaGenerationId cacheado ya no existe en el backend: se suben de nuevo.
+        logging.info("Upstream did not find the reference media IDs. Re-uploading without cache.")
+        status, result = await upload_reference_images_async(bearer_token, x_client_data, ref_images, use_cache=False)
+        if status == 'error':
+            return {'status': 'error', 'message': result}
+        set_reference_media(payload, result)
+        sent = time.perf_counter()
+        async with async_upstream.stream('generate', real_generate_url, read_timeout=180, idempotent=False, headers=headers, json=payload) as response:
+            observe_stage('upstream', time.perf_counter() - sent)
+            return await _read_generation_response(prompt, response, None, start_time)
+
+    except ResponseTooLarge as e:
+        logging.error("%s. Aborting read.", e)
+        return {'status': 'error', 'message': 'generic_api_error: response_too_large'}
+    except httpx.TimeoutException:
+        logging.error("API request timed out after 180 seconds.", extra={'event': 'upstream_timeout'})
+        return {'status': 'error', 'message': 'connection_error: timeout'}
+    except httpx.TransportError as e:
+        logging.error("API connection error: %s", e, extra={'event': 'upstream_error'})
+        return {'status': 'error', 'message': f'connection_error: {str(e)}'}
+    except Exception as e:
+        logging.error("Unhandled exception in main_generator_function_async: %s", e)
+        return {'status': 'error', 'message': f'connection_error: {str(e)}'}
@@ -0,0 +1,139 @@
+# batch.py
+"""
+Generación por lotes (/generate_batch): una lista de prompts, o todas las
+combinaciones prompt × relación de aspecto × semilla, en una sola tarea.
+Los elementos con la misma relación de aspecto y semilla se empaquetan en
+llamadas de hasta BATCH_PROMPTS_PER_CALL prompts (runImageFx devuelve un
+panel por prompt). Cada llamada publica sus imágenes en la tarea en cuanto
+termina, sin esperar al resto del lote.
+"""
+import itertools
+import logging
+import threading
+
+from config import BATCH_MAX_ITEMS, BATCH_PROMPTS_PER_CALL
+from utils import ASPECT_MAP
+
+# Imágenes por prompt (el control de la página va de 1 a 4).
+MAX_IMAGES_PER_PROMPT = 4
+
+
+def parse_num_images(value, max_images=MAX_IMAGES_PER_PROMPT):
+    """'num_images' de la petición: ('success', n) o ('error', mensaje)."""
+    try:
+        num_images = int(value)
+    except (TypeError, ValueError):
+        num_images = None
+    if num_images is None or not 1 <= num_images <= max_images:
+        return ('error', f"'num_images' debe ser un número entero entre 1 y {max_images}.")
+    return ('success', num_images)
+
+
+def expand_batch(data, max_items=BATCH_MAX_ITEMS):
+    """
+    Elementos del lote a partir del JSON de la petición: 'prompts' y,
+    opcionalmente, 'aspect_ratios' y 'seeds' (si faltan, 'aspect_ratio' y
+    'seed' como en /generate). Devuelve ('success', elementos) o ('error', mensaje).
+    """
+    prompts = data.get('prompts')
+    if not isinstance(prompts, list):
+        return ('error', "Envía las descripciones del lote como una lista en 'prompts'.")
+    # Sin duplicados y en el orden recibido.
+    prompts = list(dict.fromkeys(p.strip() for p in prompts if isinstance(p, str) and p.strip()))
+    if not prompts:
+        return ('error', 'Por favor, escribe al menos una descripción.')
+
+    ratios = data.get('aspect_ratios') or [data.get('aspect_ratio', '1:1')]
+    if not isinstance(ratios, list) or any(ratio not in ASPECT_MAP for ratio in ratios):
+        return ('error', f"Relación de aspecto no válida. Usa: {', '.join(ASPECT_MAP)}.")
+    try:
+        seeds = [int(seed) for seed in (data.get('seeds') or [data.get('seed', -1)])]
+    except (TypeError, ValueError):
+        return ('error', 'Las semillas deben ser números enteros (-1 para aleatoria).')
+
+    combinations = list(itertools.product(prompts, dict.fromkeys(ratios), dict.fromkeys(seeds)))
+    if len(combinations) > max_items:
+        return ('error', f'El lote tiene {len(combinations)} variaciones; el máximo es {max_items}.')
+    return ('success', [
+        {'index': i, 'prompt': prompt, 'aspect_ratio': ratio, 'seed': seed}
+        for i, (prompt, ratio, seed) in enumerate(combinations)
+    ])
+
+
+def pack_items(items, per_call=BATCH_PROMPTS_PER_CALL):
+    """Llamadas al backend: grupos de hasta `per_call` elementos con la misma relación de aspecto y semilla."""
+    groups = {}
+    for item in items:
+        groups.setdefault((item['aspect_ratio'], item['seed']), []).append(item)
+    return [group[i:i + per_call] for group in groups.values() for i in range(0, len(group), max(1, per_call))]
+
+
+class BatchProgress:
+    """
+    Estado de un lote en curso. Cada llamada terminada se apunta con record()
+    o fail() y se guarda en la tarea (batch_done / batch_items), lo que
+    despierta a quien la sigue por SSE o long-poll.
+    """
+
+    def __init__(self, store, task_id, items):
+        self.store = store
+        self.task_id = task_id
+        self.items = [{**item, 'status': 'pending', 'images': [], 'error': None} for item in items]
+        # Llamadas que esperan turno en el planificador: índice de su primer elemento -> (posición, eta).
+        self._turns = {}
+        self._lock = threading.Lock()
+
+    def fields(self):
+        position, eta = self._next_turn()
+        return {
+            'batch_total': len(self.items),
+            'batch_done': sum(1 for item in self.items if item['status'] != 'pending'),
+            'batch_items': [dict(item) for item in self.items],
+            'queue_position': position,
+            'eta_seconds': eta,
+        }
+
+    def _next_turn(self):
+        # La llamada en espera más cercana a su turno.
+        return min(self._turns.values(), default=(None, None))
+
+    def upstream_turn(self, call, position=None, eta=None):
+        """on_wait de una llamada en el planificador; sin posición, la llamada ya tiene su turno."""
+        with self._lock:
+            before = self._next_turn()
+            if position is None:
+                self._turns.pop(call[0]['index'], None)
+            else:
+                self._turns[call[0]['index']] = (position, eta)
+            position, eta = self._next_turn()
+        if (position, eta) != before:
+            self.store.update(self.task_id, queue_position=position, eta_seconds=eta)
+
+    def record(self, call, result):
+        """Reparte el resultado de una llamada (con 'panels', ver utils.collect_generated_panels) entre sus elementos."""
+        panels = result.get('panels', []) if result.get('status') == 'success' else []
+        with self._lock:
+            self._turns.pop(call[0]['index'], None)
+            for k, item in enumerate(call):
+                target = self.items[item['index']]
+                images = panels[k] if k < len(panels) else []
+                if images:
+                    target.update(status='done', images=images)
+                else:
+                    target.update(status='error', error=result.get('message') if not panels else 'no_images_returned')
+            fields = self.fields()
+        self.store.update(self.task_id, **fields)
+
+    def fail(self, call, error):
+        logging.error("Batch task %s: call for items %s raised: %s", self.task_id, [item['index'] for item in call], error)
+        self.record(call, {'status': 'error', 'message': 'generic_api_error'})
+
+    def result(self):
+        """Resultado final: todas las imágenes en 'images' y el detalle por elemento en 'items'."""
+        with self._lock:
+            items = [dict(item) for item in self.items]
+        images = [image_id for item in items for image_id in item['images']]
+        if not images:
+            errors = [item['error'] for item in items if item['error']]
+            return {'status': 'error', 'message': errors[0] if errors else 'no_images_returned', 'items': items}
+        return {'status': 'success', 'images': images, 'items': items}
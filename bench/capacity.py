@@ -0,0 +1,154 @@
+# bench/capacity.py
+"""
+Capacidad de generaciones concurrentes por worker: modo síncrono (gunicorn
+gthread, como en el Dockerfile) frente al asíncrono (asgi.py sobre uvicorn).
+Lanza `--jobs` generaciones a la vez contra un backend lento; cada cliente
+espera con long-poll (/tasks/<id>/wait) y recoge el resultado en /check_task.
+
+    python -m bench.capacity --jobs 200 --latency 5 --json capacity.txt
+
+Por modo informa del tiempo hasta completar todas, trabajos/s, pico de
+generaciones atendidas a la vez por el backend, pico de hilos y de RSS de la
+app (master y workers) y la latencia por trabajo. Requiere gunicorn, uvicorn
+y httpx instalados.
+"""
+import argparse
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from bench.common import (
+    bench_environment, emit, free_port, make_data_dir, proc_status, process_tree, start_process, stop_process,
+    summarize, wait_for_port
+)
+
+
+def app_command(mode, port, args):
+    if mode == 'sync':
+        return 'gunicorn', [
+            '--workers', '1', '--worker-class', 'gthread', '--threads', str(args.sync_threads),
+            '--bind', f"127.0.0.1:{port}", '--timeout', '300', '--log-level', 'warning', 'bench.serve_app:create_app()'
+        ]
+    return 'uvicorn', [
+        '--factory', 'bench.serve_app:create_asgi_app', '--host', '127.0.0.1', '--port', str(port),
+        '--workers', '1', '--log-level', 'warning'
+    ]
+
+
+class Sampler(threading.Thread):
+    """Pico de hilos y de RSS del árbol de procesos de la app, muestreado cada `interval` s."""
+
+    def __init__(self, pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_mb = 0.0
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            pids = process_tree(self.pid)
+            self.peak_threads = max(self.peak_threads, sum(proc_status(pid, 'Threads') for pid in pids))
+            rss_kb = sum(proc_status(pid, 'VmRSS') for pid in pids)
+            self.peak_rss_mb = max(self.peak_rss_mb, round(rss_kb / 1024, 1))
+            self.stop.wait(self.interval)
+
+
+def run_job(base_url, index, results, lock):
+    http = requests.Session()
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        http.get(f"{base_url}/", timeout=300)
+        response = http.post(f"{base_url}/generate", json={'prompt': f"capacity job {index}", 'num_images': 1}, timeout=300)
+        if response.status_code != 202:
+            outcome = f"http_{response.status_code}"
+        else:
+            task_id, cursor = response.json()['task_id'], 0.0
+            while True:
+                state = http.get(f"{base_url}/tasks/{task_id}/wait", params={'since': cursor, 'timeout': 25}, timeout=300).json()
+                cursor = state.get('cursor', cursor)
+                if state['state'] in ('done', 'error', 'not_found'):
+                    break
+            outcome = http.get(f"{base_url}/check_task/{task_id}", timeout=300).json().get('status', 'unknown')
+    except requests.RequestException as e:
+        outcome = type(e).__name__
+    with lock:
+        results.append((outcome, time.perf_counter() - start))
+
+
+def measure(mode, args):
+    upstream_port, app_port = free_port(), free_port()
+    env = {
+        **bench_environment(make_data_dir(), upstream_port),
+        # Sin rechazos por cola llena: se mide cuánto se tarda en atender todos.
+        'TASK_QUEUE_MAX': str(args.jobs), 'ASYNC_TASK_QUEUE_MAX': str(args.jobs),
+        'TASK_WORKERS': str(args.sync_task_workers), 'ASYNC_TASK_CONCURRENCY': str(args.async_concurrency),
+        # Se mide lo que aguanta el servidor, no el límite que pone el planificador al backend real.
+        'UPSTREAM_MAX_UNITS': str(args.jobs * 8), 'UPSTREAM_RATE_PER_MINUTE': str(args.jobs * 60 * 8),
+    }
+    upstream = start_process('bench.fake_upstream', [
+        '--port', str(upstream_port), '--latency', str(args.latency), '--gemini-latency', str(args.gemini_latency),
+        '--image-px', str(args.image_px)
+    ])
+    module, app_args = app_command(mode, app_port, args)
+    app_process = start_process(module, app_args, env=env)
+    try:
+        wait_for_port(upstream_port, timeout=120)
+        wait_for_port(app_port, timeout=60)
+        base_url = f"http://127.0.0.1:{app_port}"
+        requests.get(f"{base_url}/", timeout=60)
+        sampler = Sampler(app_process.pid)
+        sampler.start()
+        results, lock = [], threading.Lock()
+        clients = [threading.Thread(target=run_job, args=(base_url, i, results, lock)) for i in range(args.jobs)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+        sampler.stop.set()
+        sampler.join()
+        upstream_stats = requests.get(f"http://127.0.0.1:{upstream_port}/stats", timeout=10).json()
+    finally:
+        stop_process(app_process, timeout=30)
+        stop_process(upstream)
+
+    outcomes = Counter(outcome for outcome, _ in results)
+    return {
+        'server': module,
+        'wall_seconds': round(elapsed, 2),
+        'completed_jobs_per_second': round(outcomes.get('success', 0) / elapsed, 2),
+        'outcomes': dict(outcomes),
+        'peak_concurrent_upstream_generations': upstream_stats['generate_peak_in_flight'],
+        'peak_app_threads': sampler.peak_threads,
+        'peak_app_rss_mb': sampler.peak_rss_mb,
+        'job_seconds': summarize([seconds for _, seconds in results]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=100, help='generaciones lanzadas a la vez')
+    parser.add_argument('--latency', type=float, default=3.0, help='segundos de runImageFx en el backend falso')
+    parser.add_argument('--gemini-latency', type=float, default=0.2)
+    parser.add_argument('--image-px', type=int, default=256)
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--sync-threads', type=int, default=32, help='hilos de gunicorn (Dockerfile: 32)')
+    parser.add_argument('--sync-task-workers', type=int, default=4, help='TASK_WORKERS del modo síncrono')
+    parser.add_argument('--async-concurrency', type=int, default=256, help='ASYNC_TASK_CONCURRENCY')
+    parser.add_argument('--json', help='además de imprimirlo, guarda el informe en este fichero')
+    args = parser.parse_args()
+
+    report = {'config': vars(args)}
+    for mode in args.modes.split(','):
+        report[mode] = measure(mode, args)
+    emit(report, args.json)
+
+
+if __name__ == '__main__':
+    main()
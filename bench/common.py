@@ -0,0 +1,169 @@
+# bench/common.py
+"""Utilidades compartidas por los benchmarks: percentiles, memoria, puertos y procesos."""
+import base64
+import io
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    low, high = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 4) if values else 0.0,
+        'p50': round(percentile(values, 50), 4),
+        'p95': round(percentile(values, 95), 4),
+        'p99': round(percentile(values, 99), 4),
+        'max': round(max(values), 4) if values else 0.0,
+    }
+
+
+def timeit(func, repeat):
+    """Ejecuta func `repeat` veces y devuelve el resumen de tiempos en segundos."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def peak_rss_mb(pid=None):
+    """Pico de memoria residente (VmHWM) de `pid`, o del proceso actual."""
+    if pid is None:
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def process_tree(pid):
+    """`pid` y todos sus descendientes (p. ej. el master de gunicorn y sus workers)."""
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return pids
+
+
+def proc_status(pid, field):
+    """Valor numérico de un campo de /proc/<pid>/status (Threads, VmRSS en kB...)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return 0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def bench_environment(data_dir, upstream_port):
+    """Variables de entorno para ejecutar la app contra el backend falso, con datos en `data_dir`."""
+    base = f"http://127.0.0.1:{upstream_port}"
+    return {
+        'GENERATE_URL': f"{base}/v1:runImageFx",
+        'UPLOAD_URL': f"{base}/v1:uploadUserImage",
+        'BENCH_GEMINI_URL': f"{base}/gemini",
+        'GOOGLE_SESSION_TOKEN': base64.b64encode(b"bench-bearer:bench-client-data").decode(),
+        'GEMINI_API_KEY': 'bench',
+        'SESSION_DB_PATH': os.path.join(data_dir, 'sessions.sqlite3'),
+        'TASK_DB_PATH': os.path.join(data_dir, 'tasks.sqlite3'),
+        'CACHE_DB_PATH': os.path.join(data_dir, 'cache.sqlite3'),
+        'REFERENCE_IMAGES_DIR': os.path.join(data_dir, 'references'),
+        'GENERATED_IMAGES_DIR': os.path.join(data_dir, 'generated'),
+        'THUMBNAILS_DIR': os.path.join(data_dir, 'thumbnails'),
+        'HISTORY_DB_PATH': os.path.join(data_dir, 'history.sqlite3'),
+    }
+
+
+def start_process(module, args, env=None):
+    pythonpath = os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')]))
+    full_env = {**os.environ, **(env or {}), 'PYTHONPATH': pythonpath}
+    return subprocess.Popen([sys.executable, '-m', module, *args], cwd=REPO_ROOT, env=full_env)
+
+
+def stop_process(process, timeout=10):
+    """Para un proceso de start_process con SIGTERM; si no sale a tiempo, SIGKILL."""
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def make_data_dir():
+    return tempfile.mkdtemp(prefix='bench-')
+
+
+def noise_png(width, height, seed=0):
+    """PNG de ruido: no comprime, así que pesa lo que pesaría una foto real."""
+    from PIL import Image
+    rnd = random.Random(seed)
+    img = Image.frombytes('RGB', (width, height), rnd.randbytes(width * height * 3))
+    buffered = io.BytesIO()
+    img.save(buffered, format='PNG', compress_level=1)
+    return buffered.getvalue()
+
+
+def photo_jpeg(width, height, seed=0):
+    """JPEG grande con degradados y algo de ruido, parecido a una foto de móvil."""
+    from PIL import Image, ImageFilter
+    rnd = random.Random(seed)
+    small = Image.frombytes('RGB', (64, 48), rnd.randbytes(64 * 48 * 3))
+    img = small.resize((width, height), Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+    buffered = io.BytesIO()
+    img.save(buffered, format='JPEG', quality=92)
+    return buffered.getvalue()
+
+
+def emit(report, output=None):
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
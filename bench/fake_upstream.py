@@ -0,0 +1,147 @@
+# bench/fake_upstream.py
+"""
+Backend falso para benchmarks: imita uploadUserImage, runImageFx y Gemini
+con latencia, tasa de errores y tamaño de imagen configurables.
+
+    python -m bench.fake_upstream --port 8900 --latency 2 --error-rate 0.05 --image-px 1536
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from bench.common import noise_png
+
+
+class FakeUpstream:
+    def __init__(self, latency=1.0, jitter=0.25, upload_latency=0.3, gemini_latency=0.3,
+                 error_rate=0.0, image_px=1024, distinct_images=4):
+        self.latency = latency
+        self.jitter = jitter
+        self.upload_latency = upload_latency
+        self.gemini_latency = gemini_latency
+        self.error_rate = error_rate
+        # Se pregeneran para que el coste de CPU del backend falso no cuente.
+        self.images_b64 = [base64.b64encode(noise_png(image_px, image_px, seed=i)).decode('ascii')
+                           for i in range(distinct_images)]
+        self.counters = {'upload': 0, 'generate': 0, 'gemini': 0, 'errors': 0,
+                         'generate_in_flight': 0, 'generate_peak_in_flight': 0}
+        self._lock = threading.Lock()
+
+    def _sleep(self, base):
+        time.sleep(max(0.0, random.gauss(base, base * self.jitter)))
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _fail(self):
+        if self.error_rate and random.random() < self.error_rate:
+            self._count('errors')
+            return True
+        return False
+
+    def upload(self, body):
+        self._count('upload')
+        self._sleep(self.upload_latency)
+        if self._fail():
+            return 503, {'error': {'code': 503, 'status': 'UNAVAILABLE'}}
+        return 200, {'mediaGenerationId': {'mediaGenerationId': f"media-{uuid.uuid4().hex}"}}
+
+    def generate(self, body):
+        self._count('generate')
+        # Generaciones atendiéndose a la vez: la concurrencia real que consigue la app.
+        with self._lock:
+            self.counters['generate_in_flight'] += 1
+            self.counters['generate_peak_in_flight'] = max(
+                self.counters['generate_peak_in_flight'], self.counters['generate_in_flight'])
+        try:
+            self._sleep(self.latency)
+        finally:
+            with self._lock:
+                self.counters['generate_in_flight'] -= 1
+        if self._fail():
+            return 400, {'error': {'code': 400, 'details': [{'reason': 'PUBLIC_ERROR_UNSAFE_GENERATION'}]}}
+        user_input = body.get('userInput', {})
+        count = int(user_input.get('candidatesCount', 1))
+        panels = []
+        for p, prompt in enumerate(user_input.get('prompts', [''])):
+            images = [{'encodedImage': self.images_b64[(p + i) % len(self.images_b64)], 'seed': user_input.get('seed')}
+                      for i in range(count)]
+            panels.append({'prompt': prompt, 'generatedImages': images})
+        return 200, {'imagePanels': panels}
+
+    def gemini(self, body):
+        self._count('gemini')
+        self._sleep(self.gemini_latency)
+        prompt = body.get('prompt', '')
+        return 200, {'text': f"An English image prompt ({len(prompt)} chars of input)"}
+
+
+def make_handler(upstream):
+    routes = {'/v1:uploadUserImage': upstream.upload, '/v1:runImageFx': upstream.generate, '/gemini': upstream.gemini}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            route = routes.get(self.path)
+            status, payload = route(body) if route else (404, {'error': {'status': 'NOT_FOUND'}})
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                data = json.dumps(upstream.counters).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self.send_error(404)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class _Server(ThreadingHTTPServer):
+    # Con el valor por defecto (5) las ráfagas de cientos de conexiones pierden SYN.
+    request_queue_size = 1024
+
+
+def serve(port, upstream):
+    server = _Server(('127.0.0.1', port), make_handler(upstream))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=1.0, help='segundos de runImageFx')
+    parser.add_argument('--upload-latency', type=float, default=0.3)
+    parser.add_argument('--gemini-latency', type=float, default=0.3)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--image-px', type=int, default=1024, help='lado de cada imagen PNG devuelta')
+    args = parser.parse_args()
+    upstream = FakeUpstream(latency=args.latency, upload_latency=args.upload_latency,
+                            gemini_latency=args.gemini_latency, error_rate=args.error_rate, image_px=args.image_px)
+    server = serve(args.port, upstream)
+    print(f"Fake upstream listening on 127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
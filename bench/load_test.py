@@ -0,0 +1,193 @@
+# bench/load_test.py
+"""
+Prueba de carga de extremo a extremo: levanta el backend falso y la app en
+procesos aparte y lanza usuarios concurrentes que recorren
+/ → (/add_reference_image) → /generate → /check_task.
+
+    python -m bench.load_test --users 20 --jobs 3 --latency 2 --image-px 1536 --json bench_output.txt
+
+Informa de throughput, p50/p95/p99 por fase y por etapa del pipeline
+(/check_task?timings=1), pico de RSS de la app, E/S de sesión, coste de los
+logs (registros, bytes y tiempo en los hilos que registran, por generación) y
+llamadas recibidas por el backend falso. --log-format/--log-level fijan
+LOG_FORMAT y LOG_LEVEL de la app para comparar.
+"""
+import argparse
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from bench.common import (
+    bench_environment, emit, free_port, make_data_dir, peak_rss_mb, photo_jpeg,
+    start_process, stop_process, summarize, wait_for_port
+)
+
+PROMPTS = [
+    "Un astronauta montando a caballo en Marte al atardecer",
+    "Retrato de una anciana sonriendo bajo la lluvia, luz cálida",
+    "Una ciudad flotante entre nubes doradas, estilo acuarela",
+    "Un zorro rojo durmiendo sobre la nieve en un bosque de pinos",
+    "Mercado nocturno con farolillos de papel y puestos de comida",
+    "A lighthouse on a cliff during a violent storm, cinematic",
+]
+
+
+class LoadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {'job': [], 'generate_request': [], 'check_task_request': [], 'add_reference_request': []}
+        self.outcomes = Counter()
+        self.stages = {}
+        self.requests = 0
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.timings[name].append(seconds)
+            self.requests += 1
+
+    def outcome(self, name):
+        with self.lock:
+            self.outcomes[name] += 1
+
+    def task_timings(self, timings):
+        with self.lock:
+            for stage, seconds in timings.items():
+                self.stages.setdefault(stage, []).append(seconds)
+
+
+def virtual_user(base_url, args, stats, ref_jpeg, user_index):
+    http = requests.Session()
+    http.get(f"{base_url}/", timeout=30)
+    model = "Texto a Imagen"
+    if args.ref_images:
+        model = "Imagen desde Referencia"
+        http.post(f"{base_url}/update_session_settings", json={'active_tab': model}, timeout=30)
+        for i in range(args.ref_images):
+            start = time.perf_counter()
+            http.post(f"{base_url}/add_reference_image", files={'image': (f'ref{i}.jpg', ref_jpeg(user_index * 10 + i), 'image/jpeg')}, timeout=60)
+            stats.record('add_reference_request', time.perf_counter() - start)
+
+    for job in range(args.jobs):
+        if random.random() < args.duplicate_ratio:
+            prompt = PROMPTS[0]
+        else:
+            prompt = f"{random.choice(PROMPTS)} #{user_index}-{job}"
+        body = {'prompt': prompt, 'num_images': args.num_images, 'seed': -1, 'aspect_ratio': '1:1',
+                'model_name_display': model}
+        job_start = time.perf_counter()
+        response = http.post(f"{base_url}/generate", json=body, timeout=60)
+        stats.record('generate_request', time.perf_counter() - job_start)
+        if response.status_code == 429:
+            stats.outcome('rejected_429')
+            time.sleep(args.poll)
+            continue
+        if response.status_code != 202:
+            stats.outcome(f"generate_http_{response.status_code}")
+            continue
+        task_id = response.json()['task_id']
+        while True:
+            time.sleep(args.poll)
+            start = time.perf_counter()
+            result = http.get(f"{base_url}/check_task/{task_id}", params={'timings': '1'}, timeout=60)
+            stats.record('check_task_request', time.perf_counter() - start)
+            data = result.json()
+            if data.get('status') != 'processing':
+                stats.record('job', time.perf_counter() - job_start)
+                stats.outcome(data.get('status', f"http_{result.status_code}"))
+                stats.task_timings(data.get('timings', {}))
+                break
+
+
+def log_report(log_stats, jobs):
+    """Contadores de log_setup.log_stats() más lo que toca a cada generación."""
+    if not jobs:
+        return log_stats
+    return {**log_stats, 'per_job': {
+        'records': round(log_stats['records'] / jobs, 1),
+        'bytes': round(log_stats['bytes_written'] / jobs),
+        'hot_path_ms': round(log_stats['hot_path_seconds'] * 1000 / jobs, 3),
+    }}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=3, help='generaciones por usuario')
+    parser.add_argument('--num-images', type=int, default=4)
+    parser.add_argument('--ref-images', type=int, default=0, help='referencias por usuario (usa el modelo R2I)')
+    parser.add_argument('--ref-px', type=int, default=4000, help='lado largo de las referencias subidas')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='fracción de prompts repetidos')
+    parser.add_argument('--poll', type=float, default=1.0, help='intervalo de sondeo de /check_task')
+    parser.add_argument('--latency', type=float, default=1.0)
+    parser.add_argument('--upload-latency', type=float, default=0.3)
+    parser.add_argument('--gemini-latency', type=float, default=0.3)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--image-px', type=int, default=1024)
+    parser.add_argument('--mode', choices=['sync', 'async'], default='sync', help='app Flask o asgi.py')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--json', help='además de imprimirlo, guarda el informe en este fichero')
+    args = parser.parse_args()
+
+    upstream_port, app_port = free_port(), free_port()
+    data_dir = make_data_dir()
+    env = {**bench_environment(data_dir, upstream_port), 'LOG_FORMAT': args.log_format, 'LOG_LEVEL': args.log_level}
+    upstream = start_process('bench.fake_upstream', [
+        '--port', str(upstream_port), '--latency', str(args.latency), '--upload-latency', str(args.upload_latency),
+        '--gemini-latency', str(args.gemini_latency), '--error-rate', str(args.error_rate), '--image-px', str(args.image_px)
+    ])
+    app_process = start_process('bench.serve_app', ['--port', str(app_port), '--mode', args.mode], env=env)
+    try:
+        wait_for_port(upstream_port, timeout=120)
+        wait_for_port(app_port, timeout=60)
+        base_url = f"http://127.0.0.1:{app_port}"
+        ref_cache = {}
+
+        def ref_jpeg(seed):
+            if seed not in ref_cache:
+                ref_cache[seed] = photo_jpeg(args.ref_px, args.ref_px * 3 // 4, seed=seed)
+            return ref_cache[seed]
+
+        if args.ref_images:
+            for u in range(args.users):
+                for i in range(args.ref_images):
+                    ref_jpeg(u * 10 + i)
+
+        stats = LoadStats()
+        threads = [threading.Thread(target=virtual_user, args=(base_url, args, stats, ref_jpeg, u), daemon=True)
+                   for u in range(args.users)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        app_stats = requests.get(f"{base_url}/__bench__/stats", timeout=10).json()
+        upstream_stats = requests.get(f"http://127.0.0.1:{upstream_port}/stats", timeout=10).json()
+        completed = len(stats.timings['job'])
+        report = {
+            'config': vars(args),
+            'elapsed_seconds': round(elapsed, 2),
+            'jobs_completed': completed,
+            'throughput_jobs_per_second': round(completed / elapsed, 3) if elapsed else 0.0,
+            'requests_sent': stats.requests,
+            'outcomes': dict(stats.outcomes),
+            'latency_seconds': {name: summarize(values) for name, values in stats.timings.items() if values},
+            'stage_seconds': {stage: summarize(values) for stage, values in sorted(stats.stages.items())},
+            'app_peak_rss_mb': peak_rss_mb(app_process.pid),
+            'session_io': app_stats['session_io'],
+            'logging': log_report(app_stats['logging'], completed),
+            'upstream_calls': upstream_stats,
+        }
+        emit(report, args.json)
+    finally:
+        stop_process(app_process)
+        stop_process(upstream)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# bench/micro.py
+"""
+Microbenchmarks sin red: preprocesado de referencias y decodificación de la
+respuesta de runImageFx (main_generator_function contra el backend falso sin
+latencia), con el pico de memoria asignada por generación.
+
+El preprocesado compara el camino anterior (prepare_upload_image: decodificar
+la foto completa y recodificar siempre) con image_processing (draft para fotos
+que doblan 2048 px, JPEG ya válidos sin recodificar), y el throughput con
+`--threads` hilos procesando a la vez en el propio proceso frente al pool de
+procesos. `ticker_p99_ms` es el retraso de un hilo que se despierta cada 5 ms
+mientras tanto: lo que notaría un hilo atendiendo peticiones.
+
+    python -m bench.micro --repeat 10 --ref-px 4000 --image-px 1536 --threads 4 --json micro.txt
+"""
+import argparse
+import io
+import os
+import threading
+import time
+import tracemalloc
+
+import requests
+
+from bench.common import (
+    bench_environment, emit, free_port, make_data_dir, peak_rss_mb, percentile, photo_jpeg, start_process, timeit,
+    wait_for_port
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--ref-px', type=int, default=4000, help='lado largo de la foto de referencia')
+    parser.add_argument('--image-px', type=int, default=1024, help='lado de cada imagen devuelta')
+    parser.add_argument('--num-images', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4, help='hilos simultáneos en la prueba de throughput')
+    parser.add_argument('--json', help='además de imprimirlo, guarda el informe en este fichero')
+    args = parser.parse_args()
+
+    # El entorno tiene que estar listo antes de importar utils/config. El backend
+    # falso va en otro proceso para que sus buffers no cuenten en la memoria medida.
+    port = free_port()
+    os.environ.update(bench_environment(make_data_dir(), port))
+    upstream = start_process('bench.fake_upstream', [
+        '--port', str(port), '--latency', '0', '--upload-latency', '0', '--gemini-latency', '0',
+        '--image-px', str(args.image_px)
+    ])
+    try:
+        wait_for_port(port, timeout=120)
+        report = run(args)
+        report['upstream_calls'] = requests.get(f"http://127.0.0.1:{port}/stats", timeout=10).json()
+    finally:
+        upstream.terminate()
+        upstream.wait(timeout=10)
+    emit(report, args.json)
+
+
+def concurrent_throughput(func, inputs, threads):
+    """Imágenes/s procesando `inputs` con `threads` hilos, y el retraso de un hilo testigo."""
+    pending = list(inputs)
+    lock = threading.Lock()
+    done = threading.Event()
+    delays = []
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                data = pending.pop()
+            func(data)
+
+    def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            time.sleep(0.005)
+            delays.append(time.perf_counter() - start - 0.005)
+
+    watcher = threading.Thread(target=ticker)
+    watcher.start()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    watcher.join()
+    return {
+        'images_per_second': round(len(inputs) / elapsed, 2),
+        'ticker_p99_ms': round(percentile(delays, 99) * 1000, 2),
+    }
+
+
+def run(args):
+    from PIL import Image
+    import utils
+    from image_processing import image_pool, normalize_image_bytes
+
+    photo = photo_jpeg(args.ref_px, args.ref_px * 3 // 4)
+    # Ya cumple (JPEG RGB de 2048 px): el camino nuevo lo sube tal cual.
+    compliant = utils.prepare_upload_image(Image.open(io.BytesIO(photo)))
+    report = {'config': vars(args), 'reference_jpeg_bytes': len(photo)}
+
+    report['preprocess_seconds'] = {
+        'current_path': timeit(lambda: utils.prepare_upload_image(Image.open(io.BytesIO(photo))), args.repeat),
+        'fast_path': timeit(lambda: normalize_image_bytes(photo), args.repeat),
+        'compliant_jpeg_current_path': timeit(lambda: utils.prepare_upload_image(Image.open(io.BytesIO(compliant))), args.repeat),
+        'compliant_jpeg_fast_path': timeit(lambda: normalize_image_bytes(compliant), args.repeat),
+    }
+    image_pool.normalize(photo)  # arranca los procesos del pool antes de medir
+    inputs = [photo] * max(args.repeat, args.threads * 2)
+    report['preprocess_throughput'] = {
+        'threads': args.threads,
+        'pool_workers': image_pool.workers,
+        'current_path_in_threads': concurrent_throughput(
+            lambda data: utils.prepare_upload_image(Image.open(io.BytesIO(data))), inputs, args.threads),
+        'fast_path_in_threads': concurrent_throughput(normalize_image_bytes, inputs, args.threads),
+        'fast_path_process_pool': concurrent_throughput(utils.normalize_reference_image, inputs, args.threads),
+    }
+    image_pool.shutdown()
+
+    def generate():
+        result = utils.main_generator_function("bench prompt", args.num_images, 1, "1:1", "IMAGEN_3_5", [])
+        assert result['status'] == 'success', result
+
+    report['generate_and_decode'] = timeit(generate, args.repeat)
+    # Pico de memoria Python asignada durante una sola generación (respuesta + imágenes).
+    tracemalloc.start()
+    generate()
+    report['generate_peak_alloc_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+    tracemalloc.stop()
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+if __name__ == '__main__':
+    main()
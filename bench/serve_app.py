@@ -0,0 +1,122 @@
+# bench/serve_app.py
+"""
+Arranca la app contra el backend falso (variables de bench.common.bench_environment)
+y añade /__bench__/stats con la E/S de sesión, el coste de los logs y la memoria
+del proceso.
+
+    python -m bench.serve_app --port 5050
+    python -m bench.serve_app --port 5050 --mode async      # asgi.py sobre uvicorn
+
+Con gunicorn/uvicorn directamente: 'bench.serve_app:create_app()' y
+'uvicorn --factory bench.serve_app:create_asgi_app'.
+"""
+import argparse
+import os
+import signal
+import sys
+import threading
+import types
+
+import requests
+
+
+class FakeGeminiModel:
+    """Cliente compatible con PromptService que habla con /gemini del backend falso."""
+
+    def __init__(self, url):
+        self.url = url
+        self.http = requests.Session()
+        self.async_http = None
+
+    def generate_content(self, text, request_options=None):
+        timeout = (request_options or {}).get('timeout', 10)
+        response = self.http.post(self.url, json={'prompt': text}, timeout=timeout)
+        response.raise_for_status()
+        return types.SimpleNamespace(text=response.json()['text'])
+
+    async def generate_content_async(self, text, request_options=None):
+        import httpx
+        if self.async_http is None:
+            self.async_http = httpx.AsyncClient()
+        timeout = (request_options or {}).get('timeout', 10)
+        response = await self.async_http.post(self.url, json={'prompt': text}, timeout=timeout)
+        response.raise_for_status()
+        return types.SimpleNamespace(text=response.json()['text'])
+
+
+def instrument_session_io(app):
+    """Cuenta lecturas y escrituras del almacén de sesiones y los bytes escritos."""
+    interface = app.session_interface
+    stats = {'reads': 0, 'writes': 0, 'bytes_written': 0}
+    lock = threading.Lock()
+    retrieve, upsert = interface._retrieve_session_data, interface._upsert_session
+
+    def counted_retrieve(store_id):
+        with lock:
+            stats['reads'] += 1
+        return retrieve(store_id)
+
+    def counted_upsert(session_lifetime, session, store_id):
+        size = len(interface.serializer.encode(session))
+        with lock:
+            stats['writes'] += 1
+            stats['bytes_written'] += size
+        return upsert(session_lifetime, session, store_id)
+
+    interface._retrieve_session_data = counted_retrieve
+    interface._upsert_session = counted_upsert
+    return stats
+
+
+def create_app():
+    from bench.common import peak_rss_mb
+    from prompt_service import prompt_service
+
+    # Antes de importar la app: su arranque (prompt_service.preload) sólo
+    # importa el SDK real de Gemini si el cliente es el de por defecto.
+    gemini_url = os.environ['BENCH_GEMINI_URL']
+    prompt_service.model_factory = lambda api_key, model_name: FakeGeminiModel(gemini_url)
+    import app as app_module
+    from log_setup import log_stats
+
+    flask_app = app_module.app
+    session_stats = instrument_session_io(flask_app)
+
+    @flask_app.route('/__bench__/stats')
+    def bench_stats():
+        from flask import jsonify
+        return jsonify({'session_io': dict(session_stats), 'logging': log_stats(), 'peak_rss_mb': peak_rss_mb()})
+
+    app_module.SESSIONLESS_ENDPOINTS.add('bench_stats')
+    return flask_app
+
+
+def create_asgi_app():
+    create_app()
+    import asgi
+    return asgi.application
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--mode', choices=['sync', 'async'], default='sync')
+    args = parser.parse_args()
+    # El SIGTERM del bench (ver common.stop_process) sale por el finally: el
+    # servidor de desarrollo no lo atiende y el proceso moriría sin parar el
+    # pool de imágenes, cuyos procesos seguirían con el stdout del bench abierto.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.mode == 'async':
+            import uvicorn
+            uvicorn.run(create_asgi_app(), host='127.0.0.1', port=args.port, log_level='warning')
+            return
+        from werkzeug.serving import run_simple
+        run_simple('127.0.0.1', args.port, create_app(), threaded=True, use_reloader=False)
+    finally:
+        from image_processing import image_pool
+        image_pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
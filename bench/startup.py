@@ -0,0 +1,177 @@
+# bench/startup.py
+"""
+Arranque en frío de un worker y latencia de la detección de idioma (is_english).
+
+Arranque, cada caso en procesos nuevos:
+- `worker`: importar la app en el propio worker (sin --preload), con y sin
+  WARM_UP_AT_BOOT, y lo que tarda después la primera detección de idioma
+  (sin precarga, ahí se cargan los perfiles de langdetect, dentro de una petición);
+- `preload`: la app se importa una vez en un proceso "máster" y `--workers`
+  hijos nacen con fork, como con gunicorn --preload; se mide el fork, la
+  primera detección en cada hijo y su memoria propia (Pss).
+
+Detección, en este proceso: langdetect.detect en cada llamada (lo de antes)
+frente a is_english la primera vez que ve cada prompt y al repetirlo, y qué
+parte de los prompts resuelve la heurística sin llamar a langdetect.
+
+    python -m bench.startup --repeat 5 --workers 4 --json startup.txt
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bench.common import REPO_ROOT, bench_environment, emit, free_port, make_data_dir, summarize, timeit
+
+PROMPTS = [
+    "Un astronauta montando a caballo en Marte al atardecer",
+    "Retrato de una anciana sonriendo bajo la lluvia, luz cálida",
+    "Una ciudad flotante entre nubes doradas, estilo acuarela",
+    "Un zorro rojo durmiendo sobre la nieve en un bosque de pinos",
+    "Mercado nocturno con farolillos de papel y puestos de comida",
+    "¿Puedes dibujar un dragón?",
+    "A lighthouse on a cliff during a violent storm, cinematic",
+    "Portrait of an old fisherman with a pipe, dramatic lighting",
+    "A cat floating in space wearing an astronaut suit, Earth in background",
+    "cyberpunk samurai, neon, rain, 8k",
+    "Paisaje montañoso al amanecer",
+    "Sunset over Kyoto temples",
+    "Gato naranja durmiendo",
+    "Ein Hund im Park bei Sonnenuntergang",
+]
+# Prompt sin palabras vacías de ningún idioma: siempre pasa por langdetect.
+AMBIGUOUS_PROMPT = "Dragon dorado volando, acuarela minimalista"
+
+
+def child_worker():
+    """Un worker sin --preload: importa la app y atiende su primera detección."""
+    started = time.perf_counter()
+    import app  # noqa: F401
+    imported = time.perf_counter()
+    from language import is_english
+    is_english(AMBIGUOUS_PROMPT)
+    detected = time.perf_counter()
+    return {'import_seconds': round(imported - started, 3), 'first_detection_ms': round((detected - imported) * 1000, 2)}
+
+
+def smaps_pss_mb():
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def child_preload(workers):
+    """Un máster con la app precargada que hace fork de `workers` hijos."""
+    started = time.perf_counter()
+    import app  # noqa: F401
+    from language import is_english
+    report = {'master_import_seconds': round(time.perf_counter() - started, 3), 'workers': []}
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        forked = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            ready = time.perf_counter()
+            is_english(AMBIGUOUS_PROMPT)
+            result = {'fork_ms': round((ready - forked) * 1000, 2),
+                      'first_detection_ms': round((time.perf_counter() - ready) * 1000, 2), 'pss_mb': smaps_pss_mb()}
+            os.write(write_fd, json.dumps(result).encode())
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as pipe:
+            report['workers'].append(json.loads(pipe.read()))
+        os.waitpid(pid, 0)
+    return report
+
+
+def run_child(mode, env, workers):
+    pythonpath = os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')]))
+    output = subprocess.run(
+        [sys.executable, '-m', 'bench.startup', '--child', mode, '--workers', str(workers)],
+        cwd=REPO_ROOT, env={**os.environ, **env, 'PYTHONPATH': pythonpath, 'LOG_LEVEL': 'WARNING'},
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def cold_start(args):
+    env = bench_environment(make_data_dir(), free_port())
+    report = {}
+    for warm in ('0', '1'):
+        runs = [run_child('worker', {**env, 'WARM_UP_AT_BOOT': warm}, 0) for _ in range(args.repeat)]
+        report[f"worker_warm_up_{'on' if warm == '1' else 'off'}"] = {
+            'import_seconds': summarize([r['import_seconds'] for r in runs]),
+            'first_detection_ms': summarize([r['first_detection_ms'] for r in runs]),
+        }
+    preload = run_child('preload', {**env, 'WARM_UP_AT_BOOT': '1'}, args.workers)
+    report['preload'] = {
+        'master_import_seconds': preload['master_import_seconds'],
+        'fork_ms': summarize([w['fork_ms'] for w in preload['workers']]),
+        'first_detection_ms': summarize([w['first_detection_ms'] for w in preload['workers']]),
+        'worker_pss_mb': summarize([w['pss_mb'] for w in preload['workers'] if w['pss_mb'] is not None]),
+    }
+    return report
+
+
+def detection_latency(args):
+    os.environ.update(bench_environment(make_data_dir(), free_port()))
+    from langdetect import detect
+    from language import is_english, language_memo, quick_is_english, warm_up
+    warm_up()
+    prompts = PROMPTS + [AMBIGUOUS_PROMPT]
+
+    def per_call_ms(func):
+        summary = timeit(func, args.repeat * 20)
+        return {key: value if key == 'count' else round(value * 1000 / len(prompts), 4) for key, value in summary.items()}
+
+    def first_time():
+        for prompt in prompts:
+            language_memo.delete(' '.join(prompt.split()))
+            is_english(prompt)
+
+    def repeated():
+        for prompt in prompts:
+            is_english(prompt)
+
+    def old_path():
+        for prompt in prompts:
+            detect(prompt)
+
+    return {
+        'prompts': len(prompts),
+        'heuristic_decided': sum(1 for prompt in prompts if quick_is_english(' '.join(prompt.split())) is not None),
+        'per_call_ms': {
+            'langdetect_every_call': per_call_ms(old_path),
+            'is_english_first_time': per_call_ms(first_time),
+            'is_english_repeated': per_call_ms(repeated),
+        },
+        'answers': {prompt: is_english(prompt) for prompt in prompts},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4, help='hijos del máster en el caso preload')
+    parser.add_argument('--child', choices=['worker', 'preload'], help=argparse.SUPPRESS)
+    parser.add_argument('--json', help='además de imprimirlo, guarda el informe en este fichero')
+    args = parser.parse_args()
+    if args.child == 'worker':
+        print(json.dumps(child_worker()))
+        return
+    if args.child == 'preload':
+        print(json.dumps(child_preload(args.workers)))
+        return
+    emit({'config': vars(args), 'cold_start': cold_start(args), 'detection': detection_latency(args)}, args.json)
+
+
+if __name__ == '__main__':
+    main()
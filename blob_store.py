@@ -0,0 +1,149 @@
+# blob_store.py
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from config import (
+    REFERENCE_IMAGES_DIR, REFERENCE_IMAGES_TTL, GENERATED_IMAGES_DIR, GENERATED_IMAGES_TTL, THUMBNAILS_DIR
+)
+
+_BLOB_ID_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+# --- ALMACÉN DE FICHEROS DIRECCIONADO POR CONTENIDO ---
+class BlobStore:
+    """
+    Guarda binarios en disco con su SHA-256 como identificador. Al estar en un
+    directorio compartido, cualquier worker de gunicorn puede servirlos. Cada
+    almacén tiene un único Content-Type. Los ficheros que llevan más de `ttl`
+    segundos sin escribirse ni reutilizarse se borran en `cleanup`.
+    """
+
+    CLEANUP_INTERVAL = 300
+
+    def __init__(self, directory, content_type, ttl):
+        self.directory = directory
+        self.content_type = content_type
+        self.ttl = ttl
+        self._last_cleanup = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, blob_id):
+        if not blob_id or not _BLOB_ID_RE.match(blob_id):
+            return None
+        return os.path.join(self.directory, blob_id[:2], blob_id)
+
+    def put(self, data: bytes) -> str:
+        writer = self.writer()
+        writer.write(data)
+        return writer.commit()
+
+    def put_as(self, blob_id, data: bytes) -> str:
+        """Guarda `data` con el ID de otro blob (p. ej. la miniatura de una imagen) en vez de con su hash."""
+        if self._path(blob_id) is None:
+            raise ValueError(f"Invalid blob id: {blob_id!r}")
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return self._commit(tmp_path, blob_id)
+
+    def writer(self):
+        """Escritura por trozos (ver BlobWriter) para no tener el binario entero en memoria."""
+        return BlobWriter(self)
+
+    def _commit(self, tmp_path, blob_id):
+        path = self._path(blob_id)
+        if os.path.exists(path):
+            os.utime(path)
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        self._maybe_cleanup()
+        return blob_id
+
+    def path(self, blob_id):
+        """Ruta del fichero si existe, o None."""
+        path = self._path(blob_id)
+        return path if path and os.path.exists(path) else None
+
+    def get(self, blob_id):
+        path = self.path(blob_id)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, blob_id):
+        return self.path(blob_id) is not None
+
+    def _maybe_cleanup(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < self.CLEANUP_INTERVAL:
+                return
+            self._last_cleanup = now
+        try:
+            removed = self.cleanup()
+            if removed:
+                logging.info("Blob store %s: removed %d expired file(s).", self.directory, removed)
+        except OSError as e:
+            logging.error("Blob store cleanup failed for %s: %s", self.directory, e)
+
+    def cleanup(self):
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
+
+
+class BlobWriter:
+    """
+    Escribe un blob en un temporal mientras calcula su hash. commit() lo mueve
+    a su ruta definitiva y devuelve el ID; abort() lo descarta.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=store.directory, prefix='.tmp-')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self) -> str:
+        self._file.close()
+        return self.store._commit(self._tmp_path, self._hash.hexdigest())
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+reference_images = BlobStore(REFERENCE_IMAGES_DIR, 'image/jpeg', REFERENCE_IMAGES_TTL)
+generated_images = BlobStore(GENERATED_IMAGES_DIR, 'image/png', GENERATED_IMAGES_TTL)
+# Miniaturas WebP de las imágenes generadas, con el mismo ID que su original.
+thumbnails = BlobStore(THUMBNAILS_DIR, 'image/webp', GENERATED_IMAGES_TTL)
@@ -0,0 +1,142 @@
+# cache.py
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from config import CACHE_BACKEND, CACHE_DB_PATH
+from storage import sqlite_connection
+
+
+# --- CACHÉ EN MEMORIA (LRU + TTL, POR PROCESO) ---
+class MemoryTTLCache:
+    def __init__(self, namespace, maxsize, ttl):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'backend': 'memory', 'size': len(self), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0}
+
+
+# --- CACHÉ EN SQLITE (COMPARTIDA ENTRE WORKERS Y REINICIOS) ---
+class SQLiteTTLCache:
+    """
+    Misma interfaz que MemoryTTLCache, pero en un fichero SQLite compartido.
+    La expulsión LRU se hace por lotes cada TRIM_EVERY escrituras para no
+    pagar un COUNT(*) en cada `set`. Un acierto sólo actualiza last_used si
+    hace más de TOUCH_FRACTION del TTL que no se tocaba: así leer no es escribir
+    en cada petición y el orden LRU sigue siendo aproximado. Los contadores de
+    aciertos son por proceso.
+    """
+
+    TRIM_EVERY = 50
+    TOUCH_FRACTION = 0.1
+
+    def __init__(self, namespace, maxsize, ttl, path=CACHE_DB_PATH):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._table = f"cache_{namespace}"
+        self._conn().execute(
+            f"CREATE TABLE IF NOT EXISTS {self._table} ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn().execute(f"CREATE INDEX IF NOT EXISTS {self._table}_last_used ON {self._table} (last_used)")
+
+    def _conn(self):
+        return sqlite_connection(self.path)
+
+    def get(self, key):
+        now = time.time()
+        row = self._conn().execute(
+            f"SELECT value, last_used FROM {self._table} WHERE key = ? AND expires > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        if now - row[1] > self.ttl * self.TOUCH_FRACTION:
+            self._conn().execute(f"UPDATE {self._table} SET last_used = ? WHERE key = ?", (now, key))
+        with self._lock:
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        self._conn().execute(
+            f"INSERT OR REPLACE INTO {self._table} (key, value, expires, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + self.ttl, now)
+        )
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % self.TRIM_EVERY == 0
+        if trim:
+            self.trim()
+
+    def delete(self, key):
+        self._conn().execute(f"DELETE FROM {self._table} WHERE key = ?", (key,))
+
+    def trim(self):
+        conn = self._conn()
+        conn.execute(f"DELETE FROM {self._table} WHERE expires <= ?", (time.time(),))
+        conn.execute(
+            f"DELETE FROM {self._table} WHERE key IN ("
+            f" SELECT key FROM {self._table} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,)
+        )
+
+    def __len__(self):
+        return self._conn().execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {'backend': 'sqlite', 'size': len(self), 'hits': hits, 'misses': misses,
+                'hit_rate': round(hits / total, 3) if total else 0.0}
+
+
+def create_cache(namespace, maxsize, ttl, backend=CACHE_BACKEND):
+    if backend == 'sqlite':
+        return SQLiteTTLCache(namespace, maxsize, ttl)
+    return MemoryTTLCache(namespace, maxsize, ttl)
@@ -0,0 +1,176 @@
+# coalescing.py
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import Future
+
+
+def request_fingerprint(prompt_en, model_type, aspect_ratio, seed, num_images, ref_keys):
+    """Huella de una generación; se calcula con el prompt ya traducido y las referencias normalizadas."""
+    payload = [' '.join(prompt_en.split()), model_type, aspect_ratio, int(seed), int(num_images), list(ref_keys)]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+# --- UNIFICACIÓN DE GENERACIONES IDÉNTICAS EN CURSO ---
+class _Inflight:
+    __slots__ = ('future', 'followers', 'last', 'version')
+
+    def __init__(self, future):
+        self.future = future
+        # on_update de quienes esperan y lo último publicado con update().
+        self.followers = []
+        self.last = {}
+        # Cuenta las publicaciones para no entregar una anterior después de otra más reciente.
+        self.version = 0
+
+
+class _Follower:
+    """on_update de quien espera; se llama fuera del lock del coalescer, de una en una."""
+    __slots__ = ('callback', 'lock', 'version')
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.version = 0
+
+    def deliver(self, version, fields):
+        with self.lock:
+            self._deliver_locked(version, fields)
+
+    def _deliver_locked(self, version, fields):
+        if version > self.version:
+            self.version = version
+            _notify(self.callback, fields)
+
+
+def _notify(callback, fields):
+    try:
+        callback(**fields)
+    except Exception as e:
+        logging.error("Coalesced follower update failed: %s", e)
+
+
+async def _notify_async(callback, fields):
+    try:
+        await callback(**fields)
+    except Exception as e:
+        logging.error("Coalesced follower update failed: %s", e)
+
+
+class InflightCoalescer:
+    """
+    Si llega una generación con la misma clave que otra que ya se está
+    ejecutando en este proceso, espera su resultado en lugar de repetir la
+    llamada al backend. Lo que la ejecución publique con update() (su etapa,
+    su turno) llega también a quienes la esperan. Los workers de gunicorn no
+    comparten este registro.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func, on_update=None):
+        """
+        Devuelve (resultado, compartido). `compartido` es True si se reutilizó
+        otra ejecución; en ese caso `on_update(**campos)` recibe lo que ya había
+        publicado y lo que publique hasta terminar.
+        """
+        follower = None
+        with self._lock:
+            entry = self._inflight.get(key)
+            leader = entry is None
+            if leader:
+                entry = self._inflight[key] = _Inflight(Future())
+            elif on_update is not None:
+                follower = _Follower(on_update)
+                entry.followers.append(follower)
+                replay = (entry.version, dict(entry.last))
+                # Retenido hasta reenviar lo ya publicado: lo que llegue después espera su turno.
+                follower.lock.acquire()
+        # Las llamadas a on_update (escrituras en el almacén de tareas) van fuera del lock.
+        if follower is not None:
+            try:
+                if replay[1]:
+                    follower._deliver_locked(*replay)
+            finally:
+                follower.lock.release()
+        if not leader:
+            return entry.future.result(), True
+        try:
+            result = func()
+            entry.future.set_result(result)
+            return result, False
+        except BaseException as e:
+            entry.future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def update(self, key, **fields):
+        """Publica campos de la ejecución en curso con esta clave para quienes la esperan."""
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is None:
+                return
+            entry.last.update(fields)
+            entry.version += 1
+            version = entry.version
+            followers = list(entry.followers)
+        for follower in followers:
+            follower.deliver(version, fields)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._inflight)
+
+
+class AsyncInflightCoalescer:
+    """
+    Igual que InflightCoalescer, para corrutinas de un mismo bucle de eventos
+    (modo ASGI). Aquí on_update es una corrutina y update() se espera.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def run(self, key, func, on_update=None):
+        """`func` es una función sin argumentos que devuelve la corrutina a ejecutar."""
+        entry = self._inflight.get(key)
+        if entry is not None:
+            if on_update is not None:
+                entry.followers.append(on_update)
+                if entry.last:
+                    await _notify_async(on_update, dict(entry.last))
+            # shield: si se cancela quien espera, la ejecución compartida sigue.
+            return await asyncio.shield(entry.future), True
+        future = asyncio.get_running_loop().create_future()
+        entry = self._inflight[key] = _Inflight(future)
+        # Evita el aviso "exception was never retrieved" si nadie más la esperaba.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            result = await func()
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def update(self, key, **fields):
+        """Como InflightCoalescer.update, desde el bucle de eventos."""
+        entry = self._inflight.get(key)
+        if entry is None:
+            return
+        entry.last.update(fields)
+        await asyncio.gather(*(_notify_async(callback, fields) for callback in list(entry.followers)))
+
+    def __len__(self):
+        return len(self._inflight)
@@ -19,6 +19,9 @@ load_dotenv()
 GENERATE_URL_OBFUSCATED = "aHR0cHM6Ly9haXNhbmRib3gtcGEuZ29vZ2xlYXBpcy5jb20vdjE6cnVuSW1hZ2VGeA=="
 UPLOAD_URL_OBFUSCATED = "aHR0cHM6Ly9haXNhbmRib3gtcGEuZ29vZ2xlYXBpcy5jb20vdjE6dXBsb2FkVXNlckltYWdl"
 BASE_HEADERS = {"Content-Type": "application/json", "User-Agent": "Mozilla/5.0"}
+# Permiten apuntar a un backend local, p. ej. el de bench/fake_upstream.py.
+GENERATE_URL_OVERRIDE = os.getenv("GENERATE_URL")
+UPLOAD_URL_OVERRIDE = os.getenv("UPLOAD_URL")
 
 MODEL_DISPLAY_NAMES = {
     "Texto a Imagen": "IMAGEN_3_1",
@@ -33,4 +36,144 @@ MODEL_NAMES_LIST = list(MODEL_DISPLAY_NAMES.keys())
 GOOGLE_SESSION_TOKEN = os.getenv("GOOGLE_SESSION_TOKEN")
 
 # Nueva adición para Gemini API key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
\ No newline at end of file
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+# --- COLA DE GENERACIÓN ---
+# TASK_STORE: "sqlite" (compartido entre workers de gunicorn) o "memory" (un solo proceso).
+TASK_STORE = os.getenv("TASK_STORE", "sqlite")
+TASK_DB_PATH = os.getenv("TASK_DB_PATH", "/tmp/generador_data/tasks.sqlite3")
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "4"))
+TASK_QUEUE_MAX = int(os.getenv("TASK_QUEUE_MAX", "20"))
+TASK_RESULT_TTL = int(os.getenv("TASK_RESULT_TTL", "900"))
+# Modo asíncrono (asgi.py): las generaciones son corrutinas, no hilos, así que
+# pueden esperar al backend muchas más a la vez.
+ASYNC_TASK_CONCURRENCY = int(os.getenv("ASYNC_TASK_CONCURRENCY", "256"))
+ASYNC_TASK_QUEUE_MAX = int(os.getenv("ASYNC_TASK_QUEUE_MAX", "1000"))
+# Hilos que ejecutan las rutas de Flask que no tienen versión asíncrona.
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))
+
+# Lotes (/generate_batch): variaciones por lote, prompts por llamada al backend
+# (runImageFx acepta varios) y llamadas de lotes en curso a la vez en cada
+# proceso (hilos compartidos por todos los lotes, que se turnan por sesión y se
+# suman a los de la cola de tareas; en modo asíncrono, por sesión).
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "48"))
+BATCH_PROMPTS_PER_CALL = int(os.getenv("BATCH_PROMPTS_PER_CALL", "4"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "3"))
+
+# --- CLIENTE HTTP DEL BACKEND DE IMÁGENES ---
+# Cada tarea puede subir hasta 3 referencias a la vez además de la generación.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(TASK_WORKERS * 4)))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+# Tope del cuerpo de una respuesta del backend; por encima se aborta la lectura.
+MAX_RESPONSE_BYTES = int(os.getenv("MAX_RESPONSE_BYTES", str(64 * 1024 * 1024)))
+# Subidas simultáneas de imágenes de referencia por tarea (hasta 3 referencias).
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "3"))
+# Conexiones simultáneas al backend en el modo asíncrono (un solo pool por proceso).
+ASYNC_HTTP_POOL_SIZE = int(os.getenv("ASYNC_HTTP_POOL_SIZE", "512"))
+
+# --- REPARTO DEL BACKEND ENTRE SESIONES (ver scheduler.py) ---
+# Una llamada cuesta el peso de su modelo por el número de imágenes. Se limitan
+# las unidades en curso a la vez y las unidades por minuto (con ráfagas de
+# hasta UPSTREAM_BURST_UNITS); si el backend falla o tarda más de
+# UPSTREAM_SLOW_SECONDS, el límite baja a la mitad y se recupera poco a poco.
+UPSTREAM_MAX_UNITS = float(os.getenv("UPSTREAM_MAX_UNITS", "16"))
+UPSTREAM_RATE_PER_MINUTE = float(os.getenv("UPSTREAM_RATE_PER_MINUTE", "96"))
+UPSTREAM_BURST_UNITS = float(os.getenv("UPSTREAM_BURST_UNITS", str(UPSTREAM_MAX_UNITS)))
+UPSTREAM_SLOW_SECONDS = float(os.getenv("UPSTREAM_SLOW_SECONDS", "90"))
+# Formato "MODELO:peso,..."; los modelos que no aparecen pesan 1.
+UPSTREAM_MODEL_WEIGHTS = {
+    model.strip(): float(weight)
+    for model, _, weight in (item.partition(':') for item in
+                             os.getenv("UPSTREAM_MODEL_WEIGHTS", "IMAGEN_3_1:1,IMAGEN_3_5:2,R2I:1.5,GEM_PIX:1.5").split(','))
+    if model.strip() and weight.strip()
+}
+
+# --- SESIONES (ver session_store.py) ---
+# SESSION_BACKEND: "sqlite" (WAL, compartida entre workers), "redis" (compartida
+# entre contenedores; requiere `pip install redis`) o "filesystem" (la de antes).
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "/tmp/generador_data/sessions.sqlite3")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/1")
+SESSION_FILE_DIR = os.getenv("SESSION_FILE_DIR", "/tmp/flask_session")
+# Una sesión caduca si no se modifica en este tiempo; las caducadas se borran
+# cada SESSION_SWEEP_INTERVAL segundos (SQLite) o solas (Redis).
+SESSION_LIFETIME = int(os.getenv("SESSION_LIFETIME", str(24 * 3600)))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "600"))
+# IDs de resultados que se recuerdan para volver a pintarlos al recargar la página.
+SESSION_MAX_RESULTS = int(os.getenv("SESSION_MAX_RESULTS", "48"))
+
+# --- CACHÉS COMPARTIDAS ---
+# CACHE_BACKEND: "sqlite" (compartida entre workers y reinicios) o "memory".
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "/tmp/generador_data/cache.sqlite3")
+# mediaGenerationId de las referencias ya subidas, por hash de la imagen normalizada.
+MEDIA_CACHE_MAX = int(os.getenv("MEDIA_CACHE_MAX", "2000"))
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", str(6 * 3600)))
+
+# --- IMÁGENES DE REFERENCIA EN EL SERVIDOR ---
+# Se guardan una vez normalizadas; la sesión y /generate sólo llevan su ID.
+REFERENCE_IMAGES_DIR = os.getenv("REFERENCE_IMAGES_DIR", "/tmp/generador_data/references")
+REFERENCE_IMAGES_TTL = int(os.getenv("REFERENCE_IMAGES_TTL", str(24 * 3600)))
+REFERENCE_MAX_UPLOAD_BYTES = int(os.getenv("REFERENCE_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Procesos que decodifican y redimensionan las referencias (0: en el hilo de la petición)
+# y cuántas pueden estar en curso o esperando a la vez.
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+IMAGE_QUEUE_MAX = int(os.getenv("IMAGE_QUEUE_MAX", str(IMAGE_WORKERS * 4)))
+
+# --- IMÁGENES GENERADAS ---
+# Se sirven desde /images/<id>; la sesión y las respuestas JSON sólo llevan el ID.
+GENERATED_IMAGES_DIR = os.getenv("GENERATED_IMAGES_DIR", "/tmp/generador_data/generated")
+GENERATED_IMAGES_TTL = int(os.getenv("GENERATED_IMAGES_TTL", str(24 * 3600)))
+
+# --- HISTORIAL DE GENERACIONES ---
+# Cada imagen generada queda en el historial de su sesión con una miniatura WebP
+# (hecha en segundo plano tras publicar el resultado; /thumbnails/<id> la rehace
+# si falta); la galería pide el historial por páginas.
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "/tmp/generador_data/history.sqlite3")
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "24"))
+HISTORY_MAX_PER_SESSION = int(os.getenv("HISTORY_MAX_PER_SESSION", "500"))
+THUMBNAILS_DIR = os.getenv("THUMBNAILS_DIR", "/tmp/generador_data/thumbnails")
+THUMBNAIL_MAX_SIDE = int(os.getenv("THUMBNAIL_MAX_SIDE", "384"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "75"))
+
+# --- GEMINI (TRADUCCIÓN / MEJORA / PROMPT MÁGICO) ---
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# Plazo máximo por llamada; si se supera se usa el prompt original.
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "10"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "3"))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+
+# Traducciones y mejoras de prompts, por prompt normalizado (espacios y mayúsculas).
+TRANSLATION_CACHE_MAX = int(os.getenv("TRANSLATION_CACHE_MAX", "5000"))
+TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", str(7 * 24 * 3600)))
+# Prompts cuyo idioma ya se detectó (por proceso, ver language.py).
+LANGUAGE_MEMO_MAX = int(os.getenv("LANGUAGE_MEMO_MAX", "2048"))
+# Cargar al importar la app los perfiles de langdetect y el SDK de Gemini, en
+# lugar de en la primera petición que los necesite. Con gunicorn --preload
+# (ver gunicorn.conf.py) se cargan una vez en el máster y los workers los heredan.
+WARM_UP_AT_BOOT = os.getenv("WARM_UP_AT_BOOT", "1") == "1"
+
+# Resultados de generaciones con semilla fija (deterministas). No debe superar
+# GENERATED_IMAGES_TTL: las imágenes cacheadas tienen que seguir en disco.
+RESULT_CACHE_MAX = int(os.getenv("RESULT_CACHE_MAX", "1000"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(12 * 3600)))
+
+# --- LOGS (ver log_setup.py) ---
+# LOG_FORMAT: "text" (el de siempre, con tarea y sesión al final) o "json".
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# Registros pendientes de escribir; si la cola se llena se descartan.
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+# Eventos frecuentes que se muestrean: se escribe 1 de cada N ("evento:N,...").
+LOG_SAMPLE = {
+    event.strip(): int(every)
+    for event, _, every in (item.partition(':') for item in os.getenv("LOG_SAMPLE", "poll:20,session:20").split(','))
+    if event.strip() and every.strip()
+}
+
+# --- MÉTRICAS ---
+# Si se define, /metrics exige la cabecera "Authorization: Bearer <token>".
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
@@ -0,0 +1,32 @@
+# gunicorn.conf.py
+"""
+Gunicorn lo lee solo al arrancar desde este directorio; las opciones de la
+línea de comandos (Dockerfile) mandan sobre las de aquí.
+
+La app se importa una vez en el máster (preload) y cada worker nace con un
+fork que ya la tiene cargada: perfiles de langdetect, SDK de Gemini, Flask...
+Arrancar o reciclar un worker (--max-requests) no repite esas importaciones, y
+la memoria de lo cargado se comparte entre workers mientras nadie la escriba
+(copy-on-write). Lo que no sobrevive a un fork se crea ya en cada worker:
+conexiones SQLite por proceso, hilos de la cola de tareas, pool de procesos de
+imágenes, hilo de los logs y el cliente de Gemini. El pool de imágenes se para
+al salir cada worker (worker_exit).
+
+GUNICORN_PRELOAD=0 vuelve a importar la app en cada worker.
+"""
+import gc
+import os
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def pre_fork(server, worker):
+    # Lo que ya está cargado pasa a la generación permanente: el GC de cada
+    # worker no lo recorre, y recorrerlo tocaría sus páginas y las copiaría.
+    gc.freeze()
+
+
+def worker_exit(server, worker):
+    # Los procesos del pool de imágenes son del worker: no deben quedar huérfanos.
+    from image_processing import image_pool
+    image_pool.shutdown()
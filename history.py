@@ -0,0 +1,103 @@
+# history.py
+"""
+Historial de generaciones por sesión. Cada imagen generada se apunta con su
+prompt, modelo y relación de aspecto, y su miniatura WebP se hace una sola vez,
+al generarla (en segundo plano, ver app.save_to_history). La galería lo pide
+por páginas (de la más reciente a la más antigua) con un cursor, así que el coste de cada página no crece con el
+historial; el original a resolución completa sólo se pide al abrir o descargar.
+"""
+import logging
+import time
+
+from blob_store import generated_images, thumbnails
+from config import HISTORY_DB_PATH, HISTORY_PAGE_SIZE, HISTORY_MAX_PER_SESSION, GENERATED_IMAGES_TTL
+from image_processing import image_pool
+from metrics import stage_timer
+from storage import sqlite_connection
+
+
+def ensure_thumbnail(image_id):
+    """Ruta de la miniatura de una imagen generada, creándola si falta; None si la imagen ya no está."""
+    path = thumbnails.path(image_id)
+    if path is not None:
+        return path
+    data = generated_images.get(image_id)
+    if data is None:
+        return None
+    with stage_timer('thumbnails'):
+        thumbnails.put_as(image_id, image_pool.thumbnail(data))
+    return thumbnails.path(image_id)
+
+
+class GenerationHistory:
+    """
+    Historial en SQLite (WAL), compartido entre workers. Las entradas duran lo
+    mismo que las imágenes generadas (GENERATED_IMAGES_TTL) y cada sesión
+    guarda como mucho `max_per_session`; las más antiguas se descartan.
+    """
+
+    PURGE_INTERVAL = 600
+
+    def __init__(self, path=HISTORY_DB_PATH, ttl=GENERATED_IMAGES_TTL, max_per_session=HISTORY_MAX_PER_SESSION):
+        self.path = path
+        self.ttl = ttl
+        self.max_per_session = max_per_session
+        self._last_purge = 0
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, image_id TEXT NOT NULL,"
+            " prompt TEXT NOT NULL, model_type TEXT, aspect_ratio TEXT, created REAL NOT NULL)"
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS history_session ON history (session_id, id)")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS history_image ON history (session_id, image_id)")
+
+    def _conn(self):
+        return sqlite_connection(self.path)
+
+    def add(self, session_id, image_ids, prompt, model_type, aspect_ratio):
+        """
+        Apunta las imágenes de una generación. Las que la sesión ya tiene (un
+        resultado de la caché o compartido que ya recibió) no se repiten.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.executemany(
+            "INSERT INTO history (session_id, image_id, prompt, model_type, aspect_ratio, created)"
+            " SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM history WHERE session_id = ? AND image_id = ?)",
+            [(session_id, image_id, prompt, model_type, aspect_ratio, now, session_id, image_id) for image_id in image_ids]
+        )
+        conn.execute(
+            "DELETE FROM history WHERE session_id = ? AND id <= ("
+            " SELECT id FROM history WHERE session_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (session_id, session_id, self.max_per_session)
+        )
+        self._maybe_purge(now)
+
+    def page(self, session_id, before=None, limit=HISTORY_PAGE_SIZE):
+        """(entradas, cursor de la página siguiente o None). Se omiten las imágenes que ya caducaron."""
+        rows = self._conn().execute(
+            "SELECT id, image_id, prompt, model_type, aspect_ratio, created FROM history"
+            " WHERE session_id = ? AND id < ? AND created > ? ORDER BY id DESC LIMIT ?",
+            (session_id, before if before is not None else 2 ** 63 - 1, time.time() - self.ttl, limit + 1)
+        ).fetchall()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        items = [
+            {'id': row[0], 'image_id': row[1], 'prompt': row[2], 'model_type': row[3],
+             'aspect_ratio': row[4], 'created': row[5]}
+            for row in rows[:limit] if generated_images.exists(row[1])
+        ]
+        return items, next_cursor
+
+    def _maybe_purge(self, now):
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        try:
+            purged = self._conn().execute("DELETE FROM history WHERE created <= ?", (now - self.ttl,)).rowcount
+            if purged:
+                logging.info("Purged %d expired history entries.", purged)
+        except Exception as e:
+            logging.error("History purge failed: %s", e)
+
+
+generation_history = GenerationHistory()
@@ -0,0 +1,257 @@
+# http_client.py
+import asyncio
+import base64
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from config import (
+    GENERATE_URL_OBFUSCATED, UPLOAD_URL_OBFUSCATED, GENERATE_URL_OVERRIDE, UPLOAD_URL_OVERRIDE,
+    HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_MAX_RETRIES, HTTP_RETRY_BACKOFF, ASYNC_HTTP_POOL_SIZE
+)
+
+# Estados que suelen indicar que el backend no llegó a procesar la petición.
+# Un 504 también puede llegar mientras el backend sigue trabajando, así que
+# sólo se reintentan en llamadas idempotentes.
+RETRYABLE_STATUS = {502, 503, 504}
+
+
+def _failed_to_connect(error):
+    """True si la petición no llegó a enviarse (conexión rechazada o timeout al conectar)."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)  # urllib3 envuelve la causa en MaxRetryError
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+# --- URLS DEL BACKEND (SE DECODIFICAN UNA SOLA VEZ POR PROCESO) ---
+@lru_cache(maxsize=None)
+def _decode_url(obfuscated: str) -> str:
+    return base64.b64decode(obfuscated).decode('utf-8')
+
+def generate_url() -> str:
+    return GENERATE_URL_OVERRIDE or _decode_url(GENERATE_URL_OBFUSCATED)
+
+def upload_url() -> str:
+    return UPLOAD_URL_OVERRIDE or _decode_url(UPLOAD_URL_OBFUSCATED)
+
+
+# --- CLIENTE HTTP COMPARTIDO CON KEEP-ALIVE ---
+class _RetryingClient:
+    """Política de reintentos y contadores comunes a los clientes síncrono y asíncrono."""
+
+    def __init__(self, pool_size, connect_timeout, max_retries, backoff):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._stats_lock = threading.Lock()
+        self._retries = 0
+        self._failures = 0
+        self._phases = {}
+
+    def _retry_delay(self, name, attempt, reason):
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        with self._stats_lock:
+            self._retries += 1
+        logging.warning("Upstream '%s' transient failure (%s). Retry %d/%d in %.2fs.", name, reason, attempt + 1, self.max_retries, delay,
+                        extra={'event': 'upstream_retry'})
+        return delay
+
+    def _count_failure(self):
+        with self._stats_lock:
+            self._failures += 1
+
+    def _record(self, name, wait_s, total_s):
+        with self._stats_lock:
+            phase = self._phases.setdefault(name, {'count': 0, 'wait_seconds': 0.0, 'total_seconds': 0.0})
+            phase['count'] += 1
+            phase['wait_seconds'] += wait_s
+            phase['total_seconds'] += total_s
+
+    def _counters(self):
+        with self._stats_lock:
+            return {
+                'retries': self._retries,
+                'failures': self._failures,
+                'phases': {name: dict(p) for name, p in self._phases.items()},
+            }
+
+
+class UpstreamClient(_RetryingClient):
+    """
+    Sesión de requests compartida por todos los hilos del proceso, con un pool
+    de conexiones keep-alive por host. Reintenta con backoff exponencial y
+    jitter sólo los fallos transitorios. En las llamadas no idempotentes
+    (`idempotent=False`, la generación: repetirla gasta otra vez la cuota) sólo
+    los fallos al conectar, en que la petición no llegó a salir; en las demás,
+    también las conexiones reseteadas y los 502-504. Un timeout de lectura
+    nunca se reintenta porque la generación puede estar en curso en el backend.
+    """
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 max_retries=HTTP_MAX_RETRIES, backoff=HTTP_RETRY_BACKOFF):
+        super().__init__(pool_size, connect_timeout, max_retries, backoff)
+        self._session = None
+        self._adapter = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_session(self) -> requests.Session:
+        # Las conexiones abiertas no se pueden compartir tras un fork.
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session, self._adapter, self._pid = session, adapter, os.getpid()
+            return self._session
+
+    def post(self, name: str, url: str, read_timeout: float, idempotent=True, **kwargs) -> requests.Response:
+        """POST con timeouts (conexión, lectura) separados. `name` agrupa las métricas."""
+        session = self._get_session()
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = session.post(url, timeout=(self.connect_timeout, read_timeout), **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.max_retries or not (idempotent or _failed_to_connect(e)):
+                    self._count_failure()
+                    raise
+                time.sleep(self._retry_delay(name, attempt, type(e).__name__))
+                attempt += 1
+                continue
+            except requests.exceptions.RequestException:
+                self._count_failure()
+                raise
+
+            if idempotent and response.status_code in RETRYABLE_STATUS and attempt < self.max_retries:
+                response.close()
+                time.sleep(self._retry_delay(name, attempt, f"HTTP {response.status_code}"))
+                attempt += 1
+                continue
+
+            # `elapsed` mide envío + espera hasta las cabeceras; el total incluye
+            # además la preparación de la petición y, salvo con stream=True, la
+            # descarga del cuerpo.
+            self._record(name, response.elapsed.total_seconds(), time.perf_counter() - start)
+            return response
+
+    def stats(self) -> dict:
+        connections = requests_sent = 0
+        with self._lock:
+            adapter = self._adapter if self._pid == os.getpid() else None
+        if adapter is not None:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_sent += pool.num_requests
+        return {
+            'requests': requests_sent,
+            'connections_opened': connections,
+            'reuse_ratio': round(1 - connections / requests_sent, 3) if requests_sent else 0.0,
+            **self._counters(),
+        }
+
+
+upstream = UpstreamClient()
+
+
+# --- CLIENTE ASÍNCRONO (MODO ASGI) ---
+class AsyncUpstreamClient(_RetryingClient):
+    """
+    Equivalente de UpstreamClient para corrutinas, sobre httpx (dependencia
+    opcional: sólo se importa en el modo asíncrono, ver asgi.py). Mismos
+    timeouts y misma política de reintentos. Hay un httpx.AsyncClient por
+    bucle de eventos; todas las tareas del proceso comparten su pool.
+    """
+
+    def __init__(self, pool_size=ASYNC_HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 max_retries=HTTP_MAX_RETRIES, backoff=HTTP_RETRY_BACKOFF):
+        super().__init__(pool_size, connect_timeout, max_retries, backoff)
+        self._client = None
+        self._loop = None
+        self._requests = 0
+
+    def _get_client(self):
+        import httpx
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            self._client = httpx.AsyncClient(limits=limits)
+            self._loop = loop
+        return self._client
+
+    @asynccontextmanager
+    async def stream(self, name: str, url: str, read_timeout: float, idempotent=True, **kwargs):
+        """
+        POST cuyo cuerpo se lee dentro del bloque `async with` (aiter_bytes);
+        la respuesta se cierra al salir. Reintenta igual que UpstreamClient.post.
+        """
+        import httpx
+        client = self._get_client()
+        timeout = httpx.Timeout(read_timeout, connect=self.connect_timeout)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                request = client.build_request('POST', url, timeout=timeout, **kwargs)
+                response = await client.send(request, stream=True)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                # RemoteProtocolError: el backend cerró la conexión sin responder, quizá
+                # con la petición ya enviada; sólo se reintenta si es idempotente.
+                connect_failed = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if attempt >= self.max_retries or not (idempotent or connect_failed):
+                    self._count_failure()
+                    raise
+                await asyncio.sleep(self._retry_delay(name, attempt, type(e).__name__))
+                attempt += 1
+                continue
+            except httpx.HTTPError:
+                self._count_failure()
+                raise
+            self._requests += 1
+
+            if idempotent and response.status_code in RETRYABLE_STATUS and attempt < self.max_retries:
+                await response.aclose()
+                await asyncio.sleep(self._retry_delay(name, attempt, f"HTTP {response.status_code}"))
+                attempt += 1
+                continue
+
+            wait_s = time.perf_counter() - start
+            try:
+                yield response
+            finally:
+                await response.aclose()
+                self._record(name, wait_s, time.perf_counter() - start)
+            return
+
+    async def post(self, name: str, url: str, read_timeout: float, idempotent=True, **kwargs):
+        """POST con el cuerpo ya leído (respuestas pequeñas, como la de la subida)."""
+        async with self.stream(name, url, read_timeout, idempotent=idempotent, **kwargs) as response:
+            await response.aread()
+            return response
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {'requests': self._requests, **self._counters()}
+
+
+async_upstream = AsyncUpstreamClient()
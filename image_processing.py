@@ -0,0 +1,165 @@
+# image_processing.py
+import atexit
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from config import IMAGE_WORKERS, IMAGE_QUEUE_MAX, REFERENCE_MAX_UPLOAD_BYTES, THUMBNAIL_MAX_SIDE, THUMBNAIL_QUALITY
+
+# Lo que espera el backend: RGB, lado máximo 2048 px, JPEG q85.
+MAX_SIDE = 2048
+JPEG_QUALITY = 85
+# Un JPEG que ya cumple se sube tal cual si no pesa más que esto.
+PASSTHROUGH_MAX_BYTES = 3 * 1024 * 1024
+
+_EXIF_ORIENTATION = 0x0112
+_EXIF_GPS_IFD = 0x8825
+
+
+# --- NORMALIZACIÓN DE REFERENCIAS ---
+def _is_compliant_jpeg(image, size_bytes):
+    """
+    JPEG RGB que ya cabe en MAX_SIDE: recodificarlo sólo perdería calidad.
+    Se exige además que no dependa de la orientación EXIF y que no lleve GPS,
+    porque la recodificación descarta el EXIF y así se comporta igual.
+    """
+    if image.format != 'JPEG' or image.mode != 'RGB' or max(image.size) > MAX_SIDE:
+        return False
+    if size_bytes > PASSTHROUGH_MAX_BYTES:
+        return False
+    exif = image.getexif()
+    return exif.get(_EXIF_ORIENTATION, 1) == 1 and _EXIF_GPS_IFD not in exif
+
+
+def reference_limits():
+    """
+    Objetivo de normalización que se publica al navegador para que reduzca y
+    codifique igual antes de subir; lo que llega así pasa sin recodificar.
+    """
+    return {
+        'max_side': MAX_SIDE,
+        'mime_type': 'image/jpeg',
+        'quality': JPEG_QUALITY / 100,
+        'passthrough_max_bytes': PASSTHROUGH_MAX_BYTES,
+        'max_upload_bytes': REFERENCE_MAX_UPLOAD_BYTES,
+    }
+
+
+def _fit(size, max_side):
+    width, height = size
+    scale = min(1.0, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def normalize_image_bytes(data: bytes) -> bytes:
+    """
+    Deja una imagen lista para subir al backend. Los JPEG que ya cumplen se
+    devuelven sin tocar; los que doblan MAX_SIDE se decodifican ya reducidos
+    (draft: escalado 1/2, 1/4 u 1/8 en la propia descompresión) antes del
+    LANCZOS final, en vez de descomprimir la foto completa.
+    """
+    image = Image.open(io.BytesIO(data))
+    if _is_compliant_jpeg(image, len(data)):
+        return bytes(data)
+    if image.format == 'JPEG' and max(image.size) >= 2 * MAX_SIDE:
+        image.draft('RGB', _fit(image.size, MAX_SIDE))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((MAX_SIDE, MAX_SIDE), Image.Resampling.LANCZOS)
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buffered.getvalue()
+
+
+# --- MINIATURAS DEL HISTORIAL ---
+def thumbnail_webp(data: bytes) -> bytes:
+    """Miniatura WebP de una imagen generada, con lado máximo THUMBNAIL_MAX_SIDE."""
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    image.thumbnail((THUMBNAIL_MAX_SIDE, THUMBNAIL_MAX_SIDE), Image.Resampling.LANCZOS)
+    buffered = io.BytesIO()
+    image.save(buffered, format="WEBP", quality=THUMBNAIL_QUALITY, method=4)
+    return buffered.getvalue()
+
+
+# --- POOL DE PROCESOS ---
+class ImagePool:
+    """
+    Ejecuta normalize_image_bytes en un pool de `workers` procesos para que
+    la decodificación y el redimensionado no compitan por el GIL con los hilos
+    que atienden peticiones. Como mucho `max_queued` trabajos a la vez (en
+    curso o esperando); el resto de llamadas se bloquean hasta que haya hueco.
+    Con workers=0 se procesa en el propio hilo.
+
+    Los procesos salen de un forkserver, no de un fork del worker de
+    gunicorn, que tiene hilos y conexiones abiertas. Como con cualquier
+    forkserver, un script lanzado con `python script.py` necesita su
+    `if __name__ == '__main__'` (gunicorn, uvicorn y `python -m` ya cumplen).
+    """
+
+    def __init__(self, workers=IMAGE_WORKERS, max_queued=IMAGE_QUEUE_MAX):
+        self.workers = workers
+        self.max_queued = max(max_queued, workers, 1)
+        self._slots = threading.BoundedSemaphore(self.max_queued)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                    # El forkserver importa PIL una vez; sus hijos nacen con él cargado.
+                    context.set_forkserver_preload(['image_processing'])
+                else:
+                    context = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, func, data: bytes) -> bytes:
+        if self.workers <= 0:
+            return func(data)
+        with self._slots:
+            executor = self._get_executor()
+            try:
+                return executor.submit(func, data).result()
+            except BrokenProcessPool as e:
+                # Un proceso murió (p. ej. por memoria): se rehace el pool y esta imagen se procesa aquí.
+                logging.error("Image process pool broke (%s). Restarting it; processing this image in-thread.", e)
+                self._reset(executor)
+                return func(data)
+
+    def normalize(self, data: bytes) -> bytes:
+        return self._run(normalize_image_bytes, data)
+
+    def thumbnail(self, data: bytes) -> bytes:
+        return self._run(thumbnail_webp, data)
+
+    def shutdown(self):
+        """Para los procesos del pool (si los arrancó este proceso); se vuelven a crear si hacen falta."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            owned = self._pid == os.getpid()
+        if executor is not None and owned:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+image_pool = ImagePool()
+# Sin esto los procesos del pool sobreviven al worker y se quedan con su
+# stdout/stderr abiertos. Gunicorn lo llama además en worker_exit.
+atexit.register(image_pool.shutdown)
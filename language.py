@@ -0,0 +1,84 @@
+# language.py
+"""
+¿El prompt ya está en inglés? (si lo está, no se traduce). Primero una
+heurística barata: escritura no latina, signos propios del español y palabras
+vacías de cada idioma. Sólo si no es concluyente se recurre a langdetect, y su
+respuesta se memoriza por proceso, así que repetir un prompt no cuesta otra
+detección.
+
+langdetect carga sus perfiles de idioma (decenas de MB) en la primera
+detección; warm_up() los carga al arrancar (en el máster con gunicorn
+--preload, de modo que los workers los heredan) en vez de en la primera
+petición.
+"""
+import logging
+import re
+import time
+
+from langdetect import DetectorFactory, LangDetectException, detect
+from langdetect.detector_factory import init_factory
+
+from cache import MemoryTTLCache
+from config import LANGUAGE_MEMO_MAX
+
+DetectorFactory.seed = 0
+
+# Palabras muy frecuentes en prompts de cada idioma y que no existen en el
+# otro ("a" y "no" se descartan: valen en los dos).
+ENGLISH_STOPWORDS = frozenset((
+    'the', 'an', 'of', 'with', 'and', 'in', 'on', 'at', 'to', 'for', 'from', 'by', 'is', 'are', 'under', 'over',
+    'during', 'his', 'her', 'their', 'its', 'this', 'that', 'into', 'while', 'wearing', 'style', 'lighting',
+))
+SPANISH_STOPWORDS = frozenset((
+    'el', 'la', 'los', 'las', 'un', 'una', 'unos', 'unas', 'de', 'del', 'con', 'y', 'en', 'por', 'para', 'al',
+    'que', 'se', 'su', 'sus', 'bajo', 'sobre', 'entre', 'es', 'muy', 'estilo', 'luz', 'como', 'sin', 'hacia',
+))
+SPANISH_MARKS = frozenset('ñ¿¡')
+# Palabras: letras latinas (con acentos) y apóstrofo.
+_WORDS = re.compile(r"[a-zà-ÿ']+")
+
+# Memoria de la detección completa, por proceso (no merece la pena compartirla).
+language_memo = MemoryTTLCache('language', LANGUAGE_MEMO_MAX, ttl=float('inf'))
+
+
+def quick_is_english(text):
+    """True o False si la heurística basta para decidir; None si hay que detectar."""
+    lowered = text.casefold()
+    if any(ch in SPANISH_MARKS for ch in lowered):
+        return False
+    if not lowered.isascii() and any(ch.isalpha() and ord(ch) > 0x24F for ch in lowered):
+        return False  # escritura no latina (cirílico, CJK, árabe...)
+    words = _WORDS.findall(lowered)
+    english = sum(1 for word in words if word in ENGLISH_STOPWORDS)
+    spanish = sum(1 for word in words if word in SPANISH_STOPWORDS)
+    if english >= 2 and spanish == 0 and lowered.isascii():
+        return True
+    if spanish >= 2 and english == 0:
+        return False
+    return None
+
+
+def is_english(prompt: str) -> bool:
+    if not prompt or len(prompt.strip()) < 5:
+        return False
+    text = ' '.join(prompt.split())
+    guess = quick_is_english(text)
+    if guess is not None:
+        return guess
+    cached = language_memo.get(text)
+    if cached is not None:
+        return cached
+    try:
+        result = detect(text) == 'en'
+    except LangDetectException:
+        logging.warning("Language detection failed for prompt: '%.50s...'. Assuming non-English.", text)
+        return False
+    language_memo.set(text, result)
+    return result
+
+
+def warm_up():
+    """Carga los perfiles de langdetect; devuelve los segundos que tardó."""
+    started = time.perf_counter()
+    init_factory()
+    return time.perf_counter() - started
@@ -0,0 +1,239 @@
+# log_setup.py
+"""
+Logs de la app fuera del camino caliente: quien registra sólo encola el
+registro (QueueHandler) y un hilo aparte (QueueListener) construye el mensaje,
+lo formatea (texto o JSON, LOG_FORMAT) y lo escribe en stderr. Además:
+
+- cada línea lleva la tarea y la sesión en curso (ver log_fields); la sesión
+  va como un hash corto, porque su ID es una credencial;
+- los eventos muy frecuentes (extra={'event': ...}) se muestrean según
+  LOG_SAMPLE; los sondeos de tareas del servidor de desarrollo son 'poll';
+- con los argumentos al estilo %s, un mensaje de un nivel desactivado no se
+  llega a construir.
+
+Como el mensaje se construye en el otro hilo, no hay que registrar objetos que
+se vayan a modificar justo después.
+"""
+import atexit
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_MAX, LOG_SAMPLE
+
+# --- CAMPOS DE CORRELACIÓN ---
+_fields = contextvars.ContextVar('log_fields', default=None)
+CORRELATION_FIELDS = ('task_id', 'session')
+
+
+@contextlib.contextmanager
+def log_fields(**fields):
+    """Añade campos (task_id, session) a todas las líneas que se registren dentro del bloque."""
+    token = _fields.set({**(_fields.get() or {}), **fields})
+    try:
+        yield
+    finally:
+        _fields.reset(token)
+
+
+def bind_log_fields(**fields):
+    """Como log_fields pero sin bloque, para una petición: la siguiente del mismo hilo los sustituye."""
+    _fields.set(fields)
+
+
+def session_tag(sid):
+    """Identificador de una sesión para los logs, sin revelar su ID."""
+    return hashlib.sha256(sid.encode('utf-8')).hexdigest()[:12] if sid else None
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        fields = _fields.get() or {}
+        for name in CORRELATION_FIELDS:
+            if getattr(record, name, None) is None:
+                setattr(record, name, fields.get(name))
+        return True
+
+
+# --- MUESTREO ---
+class SamplingFilter(logging.Filter):
+    """Deja pasar 1 de cada N registros de cada evento de `every`; WARNING y superiores pasan siempre."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = dict(every)
+        self.sampled_out = 0
+        self._counts = {}
+
+    def filter(self, record):
+        n = self.every.get(getattr(record, 'event', None))
+        if not n or n <= 1 or record.levelno >= logging.WARNING:
+            return True
+        count = self._counts.get(record.event, 0)
+        self._counts[record.event] = count + 1
+        if count % n == 0:
+            record.sample_rate = n
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class PollAccessFilter(logging.Filter):
+    """Marca como event='poll' las líneas de acceso de werkzeug de /check_task y /tasks/<id>/..."""
+
+    POLL_PATHS = (' /check_task/', ' /tasks/')
+
+    def filter(self, record):
+        if any(isinstance(arg, str) and any(path in arg for path in self.POLL_PATHS) for arg in record.args or ()):
+            record.event = 'poll'
+        return True
+
+
+# --- FORMATOS ---
+class TextFormatter(logging.Formatter):
+    """El formato de siempre, con la tarea y la sesión al final si las hay."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        tags = ' '.join(f"{name}={getattr(record, name)}" for name in CORRELATION_FIELDS if getattr(record, name, None))
+        return f"{line} [{tags}]" if tags else line
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in ('event', 'sample_rate', *CORRELATION_FIELDS):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# --- COLA HACIA EL HILO ESCRITOR ---
+class DeferredQueueHandler(QueueHandler):
+    """
+    Encola el registro tal cual: el mensaje se construye y se formatea en el
+    hilo del QueueListener. Si la cola está llena (stderr atascado) el registro
+    se descarta en vez de bloquear. Cuenta los registros y el tiempo que cuesta
+    encolarlos, que es lo único que paga el hilo que registra.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.records = 0
+        self.dropped = 0
+        self.seconds = 0.0
+
+    def handle(self, record):
+        started = time.perf_counter()
+        try:
+            return super().handle(record)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.records += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+class CountingStreamHandler(logging.StreamHandler):
+    """StreamHandler que cuenta los bytes escritos (en el hilo escritor)."""
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.bytes_written = 0
+
+    def format(self, record):
+        line = super().format(record)
+        self.bytes_written += len(line) + 1
+        return line
+
+
+_handler = None
+_writer = None
+_listener = None
+_sampling = None
+_lock = threading.Lock()
+
+
+def _start_listener():
+    global _listener
+    _listener = QueueListener(_handler.queue, _writer, respect_handler_level=False)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _restart_after_fork():
+    # El hilo escritor no sobrevive a un fork (gunicorn --preload): el hijo
+    # empieza con una cola vacía y su propio hilo.
+    if _handler is not None:
+        _handler.queue = queue.Queue(LOG_QUEUE_MAX)
+        _start_listener()
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, sample=LOG_SAMPLE):
+    """Instala el logging de la app en el logger raíz, una vez por proceso."""
+    global _handler, _writer, _sampling
+    with _lock:
+        if _handler is not None:
+            return
+        _writer = CountingStreamHandler(sys.stderr)
+        _writer.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+        _sampling = SamplingFilter(sample)
+        _handler = DeferredQueueHandler(queue.Queue(LOG_QUEUE_MAX))
+        _handler.addFilter(_sampling)
+        _handler.addFilter(ContextFilter())
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_handler)
+        root.setLevel(level)
+        logging.getLogger('werkzeug').addFilter(PollAccessFilter())
+        _start_listener()
+        atexit.register(_stop_listener)
+        os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def log_stats():
+    """Contadores del proceso: registros escritos, muestreados, descartados, bytes y segundos en el hilo que registra."""
+    if _handler is None:
+        return {}
+    return {
+        'records': _handler.records,
+        'sampled_out': _sampling.sampled_out,
+        'dropped': _handler.dropped,
+        'bytes_written': _writer.bytes_written,
+        'hot_path_seconds': round(_handler.seconds, 6),
+        'queued': _handler.queue.qsize(),
+    }
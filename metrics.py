@@ -0,0 +1,191 @@
+# metrics.py
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Segundos: desde un acierto de caché hasta una generación lenta con reintentos.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# --- MÉTRICAS (FORMATO DE TEXTO DE PROMETHEUS) ---
+class _Metric:
+    """
+    Base común. Los valores viven en el proceso; con varios workers de
+    gunicorn cada uno expone los suyos. Si se pasa `callback`, el valor se
+    calcula al hacer scrape: devuelve un número o, con etiquetas, un dict
+    {tupla_de_valores: número}.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _current(self):
+        if self.callback is None:
+            with self._lock:
+                return dict(self._values)
+        value = self.callback()
+        return value if isinstance(value, dict) else {(): value}
+
+    def samples(self):
+        for key, value in sorted(self._current().items()):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", labels + [('le', _format_value(float(bound)))], count
+            yield f"{self.name}_sum", labels, round(total, 6)
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=(), callback=None):
+        return self._register(Counter(name, help_text, labelnames, callback))
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        return self._register(Gauge(name, help_text, labelnames, callback))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                # Un callback roto no debe tumbar el resto del scrape.
+                logging.error("Metric %s could not be collected: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'generation_stage_seconds', 'Time spent in each stage of the generation pipeline.', ['stage'])
+generation_errors = registry.counter(
+    'generation_errors_total', 'Failed generations by mapped error key.', ['error'])
+generations = registry.counter(
+    'generations_total', 'Finished generations by where the result came from.', ['source', 'status'])
+tasks = registry.counter(
+    'tasks_total', 'Background tasks by final status (FAILURE means the worker raised).', ['status'])
+
+
+# --- TIEMPOS POR ETAPA (GLOBALES Y POR TAREA) ---
+# La tarea en curso guarda sus tiempos en un dict de contexto; los hilos
+# auxiliares (subidas en paralelo) lo heredan con contextvars.copy_context().
+_task_timings = contextvars.ContextVar('task_timings', default=None)
+_timings_lock = threading.Lock()
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    timings = _task_timings.get()
+    if timings is not None:
+        with _timings_lock:
+            timings[stage] = round(timings.get(stage, 0.0) + seconds, 4)
+
+
+@contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_timings():
+    """Acumula en el dict devuelto los segundos de cada etapa ejecutada dentro del bloque."""
+    timings = {}
+    token = _task_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _task_timings.reset(token)
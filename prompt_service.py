@@ -0,0 +1,195 @@
+# prompt_service.py
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from config import (
+    GEMINI_API_KEY, GEMINI_MODEL, GEMINI_TIMEOUT, GEMINI_MAX_CONCURRENCY,
+    GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET
+)
+
+TRANSLATE_TEMPLATE = (
+    "Translate this image generation prompt to English. Keep exact meaning, style, and details. "
+    "Respond ONLY with the translation:\n\n{prompt}"
+)
+IMPROVE_TEMPLATE = (
+    "Improve this image prompt: add vivid, subtle details, optimize for high-quality AI generation. "
+    "Keep original idea exactly. If it is not in English, translate it to English. "
+    "Respond ONLY with the final English prompt. NO explanations.\n\nPrompt: {prompt}"
+)
+MAGIC_TEMPLATE = (
+    "Generate ONE short (20-40 words) random image prompt in ENGLISH. Photorealistic or artistic style, vivid scenes. "
+    "Examples: 'A cat floating in space wearing an astronaut suit, Earth in background' or "
+    "'Hyperrealistic portrait of a woman with elaborate earrings, front lighting, full body'. "
+    "Include sensory and narrative details. Respond ONLY with the prompt."
+)
+
+
+class PromptServiceUnavailable(Exception):
+    """Gemini no respondió a tiempo, falló o el circuito está abierto."""
+
+
+# --- CIRCUIT BREAKER ---
+class CircuitBreaker:
+    """
+    Tras `failure_threshold` fallos seguidos deja de llamar a Gemini durante
+    `reset_timeout` segundos. Pasado ese tiempo deja pasar una llamada de
+    prueba: si sale bien se cierra, si falla vuelve a abrirse. `clock` (por
+    defecto time.time) permite a las pruebas avanzar el tiempo.
+    """
+
+    def __init__(self, failure_threshold=GEMINI_BREAKER_FAILURES, reset_timeout=GEMINI_BREAKER_RESET, clock=time.time):
+        self.now = clock
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half_open' if self.now() - self._opened_at >= self.reset_timeout else 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self.now() - self._opened_at >= self.reset_timeout and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logging.warning("Gemini circuit opened after %d consecutive failures.", self._failures)
+                self._opened_at = self.now()
+
+
+# --- SERVICIO DE PROMPTS ---
+def _default_model_factory(api_key, model_name):
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+
+class PromptService:
+    """
+    Un único modelo de Gemini por proceso, llamadas con plazo máximo y circuit
+    breaker. `model_factory(api_key, model_name)` debe devolver un objeto con
+    `generate_content(texto, request_options=...)` cuya respuesta tenga `.text`
+    (y `generate_content_async` para el modo asíncrono); en pruebas basta con
+    un cliente falso.
+    """
+
+    def __init__(self, api_key=GEMINI_API_KEY, model_name=GEMINI_MODEL, timeout=GEMINI_TIMEOUT,
+                 model_factory=_default_model_factory, breaker=None, max_concurrency=GEMINI_MAX_CONCURRENCY):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.timeout = timeout
+        self.model_factory = model_factory
+        self.breaker = breaker or CircuitBreaker()
+        self._model = None
+        self._lock = threading.Lock()
+        # Las llamadas que superan el plazo siguen ocupando un hilo hasta que
+        # el SDK corta por su propio timeout; el pool acota cuántas pueden ser.
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+
+    @property
+    def enabled(self):
+        return bool(self.api_key)
+
+    def preload(self):
+        """
+        Importa el SDK de Gemini si se va a usar (clave y cliente por defecto).
+        No crea el cliente: eso se hace en cada proceso. Si el SDK falta, el
+        error llegará con la primera llamada, no al arrancar.
+        """
+        if self.enabled and self.model_factory is _default_model_factory:
+            try:
+                import google.generativeai  # noqa: F401
+            except ImportError as e:
+                logging.warning("Gemini SDK could not be preloaded: %s", e)
+
+    def _get_model(self):
+        with self._lock:
+            if self._model is None:
+                self._model = self.model_factory(self.api_key, self.model_name)
+            return self._model
+
+    def _call(self, text, timeout):
+        response = self._get_model().generate_content(text, request_options={'timeout': timeout})
+        return response.text.strip()
+
+    def generate(self, text, timeout=None):
+        """Devuelve el texto de la respuesta o lanza PromptServiceUnavailable."""
+        timeout = timeout or self.timeout
+        if not self.breaker.allow():
+            raise PromptServiceUnavailable("circuit open")
+        future = self._executor.submit(self._call, text, timeout)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self.breaker.record_failure()
+            raise PromptServiceUnavailable(f"timed out after {timeout}s")
+        except Exception as e:
+            self.breaker.record_failure()
+            raise PromptServiceUnavailable(str(e)) from e
+        self.breaker.record_success()
+        return result
+
+    async def generate_async(self, text, timeout=None):
+        """Como generate, pero sin ocupar un hilo del pool mientras espera a Gemini."""
+        timeout = timeout or self.timeout
+        if not self.breaker.allow():
+            raise PromptServiceUnavailable("circuit open")
+        try:
+            response = await asyncio.wait_for(
+                self._get_model().generate_content_async(text, request_options={'timeout': timeout}), timeout)
+            result = response.text.strip()
+        except asyncio.TimeoutError:
+            self.breaker.record_failure()
+            raise PromptServiceUnavailable(f"timed out after {timeout}s")
+        except Exception as e:
+            self.breaker.record_failure()
+            raise PromptServiceUnavailable(str(e)) from e
+        self.breaker.record_success()
+        return result
+
+    def translate(self, prompt):
+        return self.generate(TRANSLATE_TEMPLATE.format(prompt=prompt))
+
+    def improve(self, prompt):
+        """Mejora y, si hace falta, traduce al inglés en una sola llamada."""
+        return self.generate(IMPROVE_TEMPLATE.format(prompt=prompt))
+
+    def magic(self):
+        return self.generate(MAGIC_TEMPLATE)
+
+    async def translate_async(self, prompt):
+        return await self.generate_async(TRANSLATE_TEMPLATE.format(prompt=prompt))
+
+    async def improve_async(self, prompt):
+        return await self.generate_async(IMPROVE_TEMPLATE.format(prompt=prompt))
+
+    async def magic_async(self):
+        return await self.generate_async(MAGIC_TEMPLATE)
+
+
+prompt_service = PromptService()
@@ -0,0 +1,182 @@
+# response_parser.py
+import binascii
+import re
+
+# Valor que se extrae en streaming: cada imagen viene como base64 dentro del JSON.
+ENCODED_IMAGE_KEY = b'"encodedImage"'
+_VALUE_START_RE = re.compile(rb'\s*:\s*"')
+# Lo que puede preceder al inicio del valor si el trozo se cortó justo ahí.
+_PARTIAL_VALUE_START_RE = re.compile(rb'\s*(?::\s*)?\Z')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ResponseTooLarge(Exception):
+    """La respuesta del backend supera el tamaño máximo permitido."""
+
+
+# --- LECTURA ACOTADA ---
+def iter_limited(response, max_bytes, chunk_size=CHUNK_SIZE):
+    """Trozos del cuerpo de `response` (pedida con stream=True); corta al pasar de `max_bytes`."""
+    received = 0
+    for chunk in response.iter_content(chunk_size):
+        received += len(chunk)
+        if received > max_bytes:
+            raise ResponseTooLarge(f"Upstream response exceeded {max_bytes} bytes")
+        yield chunk
+
+
+def read_limited(response, max_bytes) -> bytes:
+    return b''.join(iter_limited(response, max_bytes))
+
+
+async def aiter_limited(response, max_bytes, chunk_size=CHUNK_SIZE):
+    """Igual que iter_limited para una respuesta de httpx abierta en streaming."""
+    received = 0
+    async for chunk in response.aiter_bytes(chunk_size):
+        received += len(chunk)
+        if received > max_bytes:
+            raise ResponseTooLarge(f"Upstream response exceeded {max_bytes} bytes")
+        yield chunk
+
+
+async def aread_limited(response, max_bytes) -> bytes:
+    return b''.join([chunk async for chunk in aiter_limited(response, max_bytes)])
+
+
+# --- EXTRACCIÓN DE IMÁGENES SIN CARGAR EL JSON COMPLETO ---
+class _Base64Sink:
+    """Decodifica base64 en bloques de 4 caracteres y escribe el binario en `writer` según llega."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.failed = False
+        self._carry = b''
+
+    def feed(self, data):
+        if self.failed:
+            return
+        if b'\\' in data:
+            # Escapes JSON posibles dentro de un base64: '\/' y saltos de línea.
+            data = data.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+        data = self._carry + data
+        cut = len(data) - len(data) % 4
+        self._carry = data[cut:]
+        if cut:
+            try:
+                self.writer.write(binascii.a2b_base64(data[:cut]))
+            except binascii.Error:
+                self.failed = True
+
+    def close(self):
+        """Devuelve writer.commit(), o None si el valor estaba vacío o no era base64 válido."""
+        if self._carry and not self.failed:
+            try:
+                self.writer.write(binascii.a2b_base64(self._carry + b'=' * (-len(self._carry) % 4)))
+            except binascii.Error:
+                self.failed = True
+        if self.failed or self.writer.size == 0:
+            self.writer.abort()
+            return None
+        return self.writer.commit()
+
+    def abort(self):
+        self.writer.abort()
+
+
+class EncodedImageExtractor:
+    """
+    Recorre un JSON por trozos (feed) y vuelca cada valor de "encodedImage",
+    decodificado, en un writer nuevo (`open_writer()`, p. ej. BlobStore.writer).
+    finish() devuelve (esqueleto, resultados): el documento con esos valores
+    vacíos, ya pequeño para json.loads, y lo que devolvió cada commit() en
+    orden de aparición (None si la imagen no se pudo decodificar). Sirve igual
+    para lecturas síncronas (iter_content) que asíncronas (aiter_bytes).
+    """
+
+    _KEEP = len(ENCODED_IMAGE_KEY) - 1
+
+    def __init__(self, open_writer):
+        self.open_writer = open_writer
+        self.results = []
+        self._skeleton = bytearray()
+        self._pending = b''
+        self._sink = None
+
+    def feed(self, chunk):
+        pending = self._pending + chunk
+        while pending:
+            if self._sink is None:
+                i = pending.find(ENCODED_IMAGE_KEY)
+                if i < 0:
+                    # La clave podría estar partida entre este trozo y el siguiente.
+                    if len(pending) > self._KEEP:
+                        self._skeleton += pending[:-self._KEEP]
+                        pending = pending[-self._KEEP:]
+                    break
+                value_at = i + len(ENCODED_IMAGE_KEY)
+                match = _VALUE_START_RE.match(pending, value_at)
+                if match is None:
+                    if _PARTIAL_VALUE_START_RE.match(pending, value_at):
+                        self._skeleton += pending[:i]
+                        pending = pending[i:]
+                        break
+                    self._skeleton += pending[:value_at]
+                    pending = pending[value_at:]
+                    continue
+                self._skeleton += pending[:match.end()]
+                pending = pending[match.end():]
+                self._sink = _Base64Sink(self.open_writer())
+            else:
+                end = pending.find(b'"')
+                if end < 0:
+                    # Un escape partido ('\' al final) se completa con el siguiente trozo.
+                    tail = 1 if pending.endswith(b'\\') else 0
+                    self._sink.feed(pending[:len(pending) - tail])
+                    pending = pending[len(pending) - tail:]
+                    break
+                self._sink.feed(pending[:end])
+                sink, self._sink = self._sink, None
+                self.results.append(sink.close())
+                self._skeleton += b'"'
+                pending = pending[end + 1:]
+        self._pending = pending
+
+    def finish(self):
+        if self._sink is not None:
+            self.abort()
+            raise ValueError("Upstream response ended inside an encoded image")
+        self._skeleton += self._pending
+        self._pending = b''
+        return bytes(self._skeleton), self.results
+
+    def abort(self):
+        """Descarta la imagen a medio escribir (las ya guardadas se quedan)."""
+        if self._sink is not None:
+            self._sink.abort()
+            self._sink = None
+
+
+def extract_encoded_images(chunks, open_writer):
+    """Versión de una sola llamada de EncodedImageExtractor para un iterable de trozos."""
+    extractor = EncodedImageExtractor(open_writer)
+    try:
+        for chunk in chunks:
+            extractor.feed(chunk)
+        return extractor.finish()
+    finally:
+        extractor.abort()
+
+
+def panel_images(response_json, results):
+    """
+    Reparte los resultados de extract_encoded_images entre los paneles de la
+    respuesta: una lista por panel, alineada con sus generatedImages (None
+    donde una imagen no traía 'encodedImage' o no se pudo guardar).
+    """
+    results = iter(results)
+    panels = []
+    for panel in response_json.get("imagePanels", []):
+        panels.append([next(results, None) if "encodedImage" in img else None
+                       for img in panel.get("generatedImages", [])])
+    return panels
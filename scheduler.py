@@ -0,0 +1,322 @@
+# scheduler.py
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from config import (
+    UPSTREAM_MAX_UNITS, UPSTREAM_RATE_PER_MINUTE, UPSTREAM_BURST_UNITS, UPSTREAM_MODEL_WEIGHTS,
+    UPSTREAM_SLOW_SECONDS
+)
+
+# Errores que indican que el backend está saturado o no responde (no los de
+# contenido, que dependen del prompt): ante ellos se reduce el límite.
+OVERLOAD_ERRORS = ('connection_error', 'generic_api_error')
+
+
+def is_overload(result):
+    if not isinstance(result, dict) or result.get('status') != 'error':
+        return False
+    return (result.get('message') or '').startswith(OVERLOAD_ERRORS)
+
+
+class _Ticket:
+    __slots__ = ('session', 'cost', 'seq', 'granted', 'event', 'loop', 'future')
+
+    def __init__(self, session, cost, seq):
+        self.session = session
+        self.cost = cost
+        self.seq = seq
+        self.granted = False
+        self.event = threading.Event()
+        self.loop = None
+        self.future = None
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+# --- REPARTO DEL BACKEND ENTRE SESIONES ---
+class UpstreamScheduler:
+    """
+    Turno de acceso al backend de imágenes, que todas las sesiones comparten
+    a través del mismo GOOGLE_SESSION_TOKEN. Cada llamada cuesta el peso de su
+    modelo por el número de imágenes, y se limitan:
+
+    - las unidades en curso a la vez (`max_units`);
+    - las unidades por minuto, con un token bucket de capacidad `burst`;
+    - el reparto entre sesiones: se atiende primero a la sesión que menos
+      unidades ha consumido (start-time fair queuing), así que quien lanza
+      muchas generaciones caras no deja sin turno a los demás.
+
+    Si el backend devuelve errores de saturación o tarda más de `slow_seconds`,
+    el límite se reduce a la mitad (y la tasa con él); cada llamada que va bien
+    lo recupera poco a poco hasta `max_units`.
+
+    El estado es del proceso: con varios workers de gunicorn cada uno tiene el
+    suyo y los límites se multiplican por el número de workers. `clock` (por
+    defecto time.monotonic) marca el ritmo del token bucket y de la espera
+    entre reducciones; las pruebas pasan uno propio.
+    """
+
+    poll_interval = 1.0
+    # Duración estimada de una llamada mientras no haya medidas.
+    initial_seconds = 15.0
+    # Tras reducir el límite, no se vuelve a reducir hasta pasado este tiempo:
+    # las llamadas que ya estaban en curso fallan a la vez por la misma causa.
+    backoff_cooldown = 5.0
+
+    def __init__(self, max_units=UPSTREAM_MAX_UNITS, rate_per_minute=UPSTREAM_RATE_PER_MINUTE,
+                 burst=UPSTREAM_BURST_UNITS, weights=UPSTREAM_MODEL_WEIGHTS, slow_seconds=UPSTREAM_SLOW_SECONDS,
+                 clock=time.monotonic):
+        self.now = clock
+        self.max_units = float(max_units)
+        self.rate = rate_per_minute / 60.0
+        self.burst = float(burst)
+        self.weights = dict(weights)
+        self.slow_seconds = slow_seconds
+        self.limit = self.max_units
+        self.in_use = 0.0
+        self.backoffs = 0
+        self._tokens = self.burst
+        self._refilled = self.now()
+        self._last_backoff = 0.0
+        self._avg_seconds = self.initial_seconds
+        self._avg_cost = 4.0
+        # sesión -> tickets en espera (FIFO) y tiempo virtual de cada sesión.
+        self._waiting = {}
+        self._vtime = {}
+        self._clock = 0.0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def cost(self, model_type, num_images):
+        return self.weights.get(model_type, 1.0) * max(1, int(num_images))
+
+    # --- Estado interno (siempre con self._lock) ---
+    def _refill(self, now):
+        rate = self.rate * self.limit / self.max_units
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+
+    def _effective_cost(self, ticket):
+        # Una llamada más cara que el límite actual pasa sola, sin esperar a que suba.
+        return min(ticket.cost, self.limit, self.burst)
+
+    def _next_session(self):
+        return min(self._waiting, key=lambda s: (self._vtime[s], self._waiting[s][0].seq), default=None)
+
+    def _dispatch(self):
+        """Concede turno a los tickets que quepan; devuelve los concedidos y cuándo reintentar."""
+        granted, retry_in = [], self.poll_interval
+        self._refill(self.now())
+        while True:
+            session = self._next_session()
+            if session is None:
+                break
+            ticket = self._waiting[session][0]
+            cost = self._effective_cost(ticket)
+            if self.in_use > 0 and self.in_use + cost > self.limit + 1e-9:
+                break
+            if self._tokens < cost:
+                rate = self.rate * self.limit / self.max_units
+                retry_in = min(retry_in, (cost - self._tokens) / rate) if rate > 0 else retry_in
+                break
+            self._waiting[session].popleft()
+            if not self._waiting[session]:
+                del self._waiting[session]
+            self._clock = self._vtime[session]
+            self._vtime[session] += ticket.cost
+            self._tokens -= cost
+            self.in_use += cost
+            ticket.cost = cost
+            ticket.granted = True
+            granted.append(ticket)
+        # Las sesiones sin nada en espera no necesitan recordar su tiempo virtual.
+        for session in [s for s, v in self._vtime.items() if s not in self._waiting and v <= self._clock]:
+            del self._vtime[session]
+        return granted, max(0.05, retry_in)
+
+    def _throughput(self):
+        """Unidades por segundo que se pueden atender con el límite actual."""
+        return max(1e-6, min(self.limit / self._avg_seconds, self.rate * self.limit / self.max_units))
+
+    def _ahead_of(self, ticket):
+        """(posición, unidades por delante) de un ticket, simulando el orden de reparto."""
+        heap = [(self._vtime[s], q[0].seq, s, 0) for s, q in self._waiting.items()]
+        heapq.heapify(heap)
+        position, units = 1, 0.0
+        while heap:
+            vtime, _, session, index = heapq.heappop(heap)
+            current = self._waiting[session][index]
+            if current is ticket:
+                return position, units
+            position += 1
+            units += current.cost
+            if index + 1 < len(self._waiting[session]):
+                following = self._waiting[session][index + 1]
+                heapq.heappush(heap, (vtime + current.cost, following.seq, session, index + 1))
+        return position, units
+
+    def _eta(self, units_ahead):
+        # Lo que queda de las llamadas en curso cuenta como media duración.
+        return round((units_ahead + self.in_use / 2) / self._throughput())
+
+    # --- Entrada y salida ---
+    def _enqueue(self, session, cost):
+        with self._lock:
+            ticket = _Ticket(session, cost, next(self._seq))
+            if session not in self._waiting:
+                self._vtime[session] = max(self._vtime.get(session, 0.0), self._clock)
+                self._waiting[session] = deque()
+            self._waiting[session].append(ticket)
+            granted, _ = self._dispatch()
+        self._wake(granted)
+        return ticket
+
+    def _poll(self, ticket):
+        """Reintenta el reparto y devuelve (posición, eta, segundos hasta reintentar)."""
+        with self._lock:
+            granted, retry_in = self._dispatch()
+            status = None if ticket.granted else (*self._waiting_status(ticket), retry_in)
+        self._wake(granted)
+        return status
+
+    def _waiting_status(self, ticket):
+        position, units = self._ahead_of(ticket)
+        return position, self._eta(units)
+
+    def _cancel(self, ticket):
+        with self._lock:
+            if ticket.granted:
+                self.in_use = max(0.0, self.in_use - ticket.cost)
+            else:
+                queue = self._waiting.get(ticket.session)
+                if queue and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._waiting[ticket.session]
+            granted, _ = self._dispatch()
+        self._wake(granted)
+
+    def _complete(self, ticket, seconds, overloaded):
+        backed_off = None
+        with self._lock:
+            self.in_use = max(0.0, self.in_use - ticket.cost)
+            now = self.now()
+            slow = seconds > self.slow_seconds
+            if overloaded or slow:
+                if now - self._last_backoff > self.backoff_cooldown:
+                    self._last_backoff = now
+                    self.backoffs += 1
+                    self.limit = max(1.0, self.limit / 2)
+                    backed_off = self.limit
+            else:
+                self._avg_seconds += 0.2 * (seconds - self._avg_seconds)
+                self.limit = min(self.max_units, self.limit + ticket.cost / self.limit)
+            self._avg_cost += 0.2 * (ticket.cost - self._avg_cost)
+            granted, _ = self._dispatch()
+        self._wake(granted)
+        if backed_off is not None:
+            # Fuera del lock: el resto de tareas no espera a este registro.
+            logging.warning("Upstream %s (%.1fs). Backing off to %.1f/%.0f units.",
+                            'slow' if slow else 'overloaded', seconds, backed_off, self.max_units)
+
+    @staticmethod
+    def _wake(tickets):
+        for ticket in tickets:
+            ticket.event.set()
+            if ticket.future is not None:
+                ticket.loop.call_soon_threadsafe(_wake, ticket.future)
+
+    # --- API ---
+    def run(self, session, model_type, num_images, func, on_wait=None):
+        """
+        Ejecuta func() cuando le toque a `session`. Mientras espera llama a
+        on_wait(posición, eta_segundos) cada vez que alguno de los dos cambia.
+        """
+        ticket = self._enqueue(session, self.cost(model_type, num_images))
+        try:
+            last = None
+            while not ticket.granted:
+                status = self._poll(ticket)
+                if status is None:
+                    break
+                position, eta, retry_in = status
+                if on_wait and (position, eta) != last:
+                    on_wait(position, eta)
+                    last = (position, eta)
+                ticket.event.wait(retry_in)
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        return self._run_granted(ticket, func)
+
+    def _run_granted(self, ticket, func):
+        started = time.perf_counter()
+        try:
+            result = func()
+        except BaseException:
+            self._complete(ticket, time.perf_counter() - started, True)
+            raise
+        self._complete(ticket, time.perf_counter() - started, is_overload(result))
+        return result
+
+    async def run_async(self, session, model_type, num_images, func, on_wait=None):
+        """
+        Como run(), para corrutinas: `func` devuelve la corrutina a ejecutar y
+        on_wait también es una corrutina.
+        """
+        loop = asyncio.get_running_loop()
+        ticket = self._enqueue(session, self.cost(model_type, num_images))
+        ticket.loop, ticket.future = loop, loop.create_future()
+        if ticket.granted:
+            ticket.future.set_result(None)
+        try:
+            last = None
+            while not ticket.granted:
+                status = self._poll(ticket)
+                if status is None:
+                    break
+                position, eta, retry_in = status
+                if on_wait and (position, eta) != last:
+                    await on_wait(position, eta)
+                    last = (position, eta)
+                await asyncio.wait({ticket.future}, timeout=retry_in)
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        started = time.perf_counter()
+        try:
+            result = await func()
+        except BaseException as e:
+            # Una cancelación (cliente o apagado) no dice nada del backend.
+            self._complete(ticket, time.perf_counter() - started, not isinstance(e, asyncio.CancelledError))
+            raise
+        self._complete(ticket, time.perf_counter() - started, is_overload(result))
+        return result
+
+    def eta_for_position(self, position):
+        """Espera estimada de una tarea que aún está en la cola de tareas, por delante del turno."""
+        with self._lock:
+            waiting_units = sum(t.cost for q in self._waiting.values() for t in q)
+            return self._eta(waiting_units + max(0, position - 1) * self._avg_cost)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit_units': round(self.limit, 2),
+                'in_use_units': round(self.in_use, 2),
+                'waiting': sum(len(q) for q in self._waiting.values()),
+                'waiting_sessions': len(self._waiting),
+                'backoffs': self.backoffs,
+                'avg_seconds': round(self._avg_seconds, 2),
+            }
+
+
+upstream_scheduler = UpstreamScheduler()
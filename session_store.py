@@ -0,0 +1,231 @@
+# session_store.py
+"""
+Sesiones de servidor (Flask-Session) que sólo tocan el almacén cuando hace falta:
+
+- los endpoints sin sesión (estáticos, imágenes, SSE/long-poll, métricas)
+  reciben una sesión nula: no se lee, no se guarda y no se envía cookie;
+- en el resto, la sesión no se lee hasta que la vista la usa, así que un
+  sondeo de /check_task que no cambia nada no cuesta ninguna lectura;
+- sólo se guarda si su contenido cambió de verdad: asignar el valor que ya
+  tenía no cuenta, y leerla tampoco renueva nada.
+
+Almacenes: SQLite en WAL (por defecto; compartido entre los workers de una
+máquina y la alternativa local a Redis), Redis (compartido entre contenedores)
+o ficheros (el comportamiento anterior).
+"""
+import hashlib
+import logging
+import time
+from datetime import timedelta
+
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+from itsdangerous import BadSignature
+from werkzeug.exceptions import HTTPException
+
+from config import (
+    SESSION_BACKEND, SESSION_DB_PATH, SESSION_REDIS_URL, SESSION_FILE_DIR, SESSION_LIFETIME,
+    SESSION_SWEEP_INTERVAL
+)
+from storage import sqlite_connection
+
+
+# --- SESIÓN PEREZOSA ---
+class LazySession(ServerSideSession):
+    """
+    Sesión cuyo contenido se lee del almacén la primera vez que se consulta o
+    se modifica. Hasta entonces sólo se conoce el `sid` de la cookie.
+    """
+
+    def __init__(self, initial=None, sid=None, permanent=None, loader=None):
+        self._loader = None
+        super().__init__(initial, sid=sid, permanent=permanent)
+        self._loader = loader
+        # Huella del contenido tal como está guardado (None: nada guardado).
+        self.stored_digest = None
+
+    @property
+    def sid(self):
+        # El ID definitivo depende de si la sesión sigue en el almacén (ver _load_session).
+        if self._loader is not None:
+            self._load()
+        return self._sid
+
+    @sid.setter
+    def sid(self, value):
+        self._sid = value
+
+    @property
+    def known_sid(self):
+        """ID de la cookie (o el recién generado) sin cargar la sesión; puede cambiar al cargarla."""
+        return self._sid
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def _load(self):
+        loader, self._loader = self._loader, None
+        loader(self)
+
+
+def _loading(name):
+    method = getattr(ServerSideSession, name)
+
+    def wrapper(self, *args, **kwargs):
+        if self._loader is not None:
+            self._load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+# Todo acceso al contenido (lectura o escritura) carga antes la sesión.
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__', '__bool__',
+              '__repr__', 'get', 'setdefault', 'pop', 'popitem', 'update', 'clear', 'keys', 'items', 'values', 'copy'):
+    setattr(LazySession, _name, _loading(_name))
+
+
+class LazySessionMixin:
+    """
+    Carga perezosa y escritura sólo si hay cambios, sobre cualquier
+    ServerSideSessionInterface de Flask-Session.
+    """
+
+    session_class = LazySession
+    # Endpoints que nunca usan la sesión; se puede pasar un set mutable para añadir más después.
+    sessionless_endpoints = frozenset()
+
+    def _endpoint(self, app, request):
+        # La sesión se abre antes de que Flask resuelva la ruta.
+        try:
+            rule, _ = app.create_url_adapter(request).match(return_rule=True)
+        except HTTPException:
+            return None  # 404, 405, redirecciones: nada que leer de la sesión
+        return rule.endpoint
+
+    def _digest(self, session):
+        return hashlib.blake2b(self.serializer.encode(session), digest_size=16).digest()
+
+    def _load_session(self, session):
+        data = self._retrieve_session_data(self._get_store_id(session.sid))
+        if data is None:
+            # Caducada o desconocida: sesión nueva con otro ID, como hace Flask-Session.
+            session.sid = self._generate_sid(self.sid_length)
+            return
+        dict.update(session, data)  # sin marcarla como modificada
+        session.stored_digest = self._digest(session)
+
+    def open_session(self, app, request):
+        endpoint = self._endpoint(app, request)
+        if endpoint is None or endpoint in self.sessionless_endpoints:
+            return None  # Flask usa entonces una NullSession y no llama a save_session
+        sid = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+        if sid and self.use_signer:
+            try:
+                sid = self._unsign(app, sid)
+            except BadSignature:
+                sid = None
+        if not sid:
+            return self.session_class(sid=self._generate_sid(self.sid_length), permanent=self.permanent)
+        return self.session_class(sid=sid, loader=self._load_session)
+
+    def should_set_storage(self, app, session):
+        return session.modified and self._digest(session) != session.stored_digest
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            return  # la vista no la ha usado: nada que guardar
+        super().save_session(app, session, response)
+
+
+# --- ALMACÉN SQLITE ---
+class SQLiteSessionInterface(LazySessionMixin, ServerSideSessionInterface):
+    """
+    Sesiones en un fichero SQLite en modo WAL, compartido entre los workers de
+    gunicorn. Las caducadas se borran al guardar, como mucho cada
+    `sweep_interval` segundos, o con `flask session_cleanup`.
+    """
+
+    ttl = False
+
+    def __init__(self, app, path=SESSION_DB_PATH, sweep_interval=SESSION_SWEEP_INTERVAL, **kwargs):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.time()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL, expiry REAL NOT NULL)"
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)")
+        super().__init__(app, **kwargs)
+
+    def _conn(self):
+        return sqlite_connection(self.path)
+
+    def _retrieve_session_data(self, store_id):
+        row = self._conn().execute(
+            "SELECT data FROM sessions WHERE id = ? AND expiry > ?", (store_id, time.time())
+        ).fetchone()
+        return self.serializer.decode(row[0]) if row else None
+
+    def _delete_session(self, store_id):
+        self._conn().execute("DELETE FROM sessions WHERE id = ?", (store_id,))
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO sessions (id, data, expiry) VALUES (?, ?, ?)",
+            (store_id, self.serializer.encode(session), now + session_lifetime.total_seconds())
+        )
+        if now - self._last_sweep > self.sweep_interval:
+            self._last_sweep = now
+            self._delete_expired_sessions()
+
+    def _delete_expired_sessions(self):
+        try:
+            deleted = self._conn().execute("DELETE FROM sessions WHERE expiry <= ?", (time.time(),)).rowcount
+        except Exception as e:
+            logging.error("Session sweep failed: %s", e)
+            return
+        if deleted:
+            logging.info("Deleted %d expired session(s).", deleted)
+
+
+# --- SELECCIÓN DEL ALMACÉN ---
+def _redis_session_interface(app, **kwargs):
+    try:
+        import redis
+        from flask_session.redis import RedisSessionInterface
+    except ImportError as e:
+        raise ImportError("SESSION_BACKEND=redis requires the redis package: pip install redis") from e
+
+    class LazyRedisSessionInterface(LazySessionMixin, RedisSessionInterface):
+        """Sesiones en Redis (con caducidad propia de Redis)."""
+
+    return LazyRedisSessionInterface(app, client=redis.Redis.from_url(SESSION_REDIS_URL), **kwargs)
+
+
+def _filesystem_session_interface(app, **kwargs):
+    from flask_session.filesystem import FileSystemSessionInterface
+
+    class LazyFileSystemSessionInterface(LazySessionMixin, FileSystemSessionInterface):
+        """Sesiones en ficheros (un pickle por sesión), como antes de session_store."""
+
+    return LazyFileSystemSessionInterface(app, cache_dir=SESSION_FILE_DIR, **kwargs)
+
+
+def create_session_interface(app, sessionless_endpoints=(), backend=SESSION_BACKEND):
+    """Interfaz de sesiones de `app` según SESSION_BACKEND ("sqlite", "redis" o "filesystem")."""
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(seconds=SESSION_LIFETIME)
+    # Firmar el ID mantiene válidas las cookies emitidas con la configuración anterior.
+    kwargs = {'use_signer': True, 'permanent': False}
+    if backend == 'sqlite':
+        interface = SQLiteSessionInterface(app, **kwargs)
+    elif backend == 'redis':
+        interface = _redis_session_interface(app, **kwargs)
+    elif backend == 'filesystem':
+        interface = _filesystem_session_interface(app, **kwargs)
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+    interface.sessionless_endpoints = sessionless_endpoints
+    return interface
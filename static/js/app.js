@@ -25,6 +25,10 @@ document.addEventListener('DOMContentLoaded', function() {
     window.initialSessionState = JSON.parse(body.getAttribute('data-initial-session-state'));
     window.MODEL_DISPLAY_NAMES_JS = JSON.parse(body.getAttribute('data-model-display-names'));
     window.MODEL_NAMES_LIST_JS = JSON.parse(body.getAttribute('data-model-names-list'));
+    // Objetivo de preprocesado de referencias que publica el servidor (image_processing.reference_limits).
+    window.REFERENCE_LIMITS_JS = JSON.parse(body.getAttribute('data-reference-limits'));
+    // Lado máximo de las miniaturas WebP de /thumbnails (el original se pide sólo al abrir o descargar).
+    window.THUMBNAIL_MAX_SIDE_JS = parseInt(body.getAttribute('data-thumbnail-max-side'), 10) || 384;
 
     const promptTextarea = document.getElementById('prompt-textarea');
     const numImagesSlider = document.getElementById('num-images-slider');
@@ -32,6 +36,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const seedInput = document.getElementById('seed-input');
     const aspectRatioSelect = document.getElementById('aspect-ratio-select');
     const saveImagesCheckbox = document.getElementById('save_images_checkbox');
+    const batchModeCheckbox = document.getElementById('batch-mode-checkbox');
     const improvePromptButton = document.getElementById('improve-prompt-button');
     const magicPromptButton = document.getElementById('magic-prompt-button');
     const loadingSpinner = document.getElementById('loading-spinner');
@@ -197,17 +202,20 @@ document.addEventListener('DOMContentLoaded', function() {
     if (captureButton) {
         captureButton.addEventListener('click', async () => {
             if (!cameraStream.srcObject) return;
+            // El fotograma se dibuja ya reducido al tamaño que acepta el servidor.
+            const [width, height] = fitWithin(cameraStream.videoWidth, cameraStream.videoHeight, window.REFERENCE_LIMITS_JS.max_side);
             const canvas = document.createElement('canvas');
-            canvas.width = cameraStream.videoWidth;
-            canvas.height = cameraStream.videoHeight;
+            canvas.width = width;
+            canvas.height = height;
             const context = canvas.getContext('2d');
+            context.imageSmoothingQuality = 'high';
             if (currentFacingMode === 'user') {
                 context.translate(canvas.width, 0);
                 context.scale(-1, 1);
             }
             context.drawImage(cameraStream, 0, 0, canvas.width, canvas.height);
-            const imageDataUrl = canvas.toDataURL('image/jpeg');
-            await window.addReferenceImage(imageDataUrl, null, true);
+            const imageBlob = await canvasToReferenceBlob(canvas);
+            if (imageBlob) await window.addReferenceImage(imageBlob, null, true);
             window.closeCameraModal();
         });
     }
@@ -338,52 +346,140 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     } 
 
-    // --- LÓGICA DE SONDEO SIMPLIFICADA (SIN TURNOS) ---
-    function pollTaskStatus(taskId) {
+    // --- SEGUIMIENTO DE TAREAS: SSE CON LONG-POLL DE RESPALDO ---
+    const TASK_STAGE_LABELS = {
+        queued: 'En cola...',
+        running: 'Preparando la generación...',
+        translating: 'Traduciendo la descripción...',
+        waiting_upstream: 'Esperando turno en el servidor de IA...',
+        uploading: 'Subiendo imágenes de referencia...',
+        generating: 'Generando imágenes...'
+    };
+    const TERMINAL_TASK_STATES = ['done', 'error', 'not_found'];
+
+    function finishTaskWithError(message) {
+        if (loadingSpinner) loadingSpinner.style.display = 'none';
+        enableAllButtons();
+        showMessage(errorMessage, message);
+        showInitialMessage();
+    }
+
+    function formatEta(seconds) {
+        if (seconds < 60) return `${Math.max(1, Math.round(seconds))} s`;
+        return `${Math.round(seconds / 60)} min`;
+    }
+
+    function showTaskStage(state) {
+        const queueStatusDebug = document.getElementById('queue-status-debug');
+        if (!queueStatusDebug) return;
+        let label = TASK_STAGE_LABELS[state.state] || '';
+        if (state.state === 'queued' && state.queue_position) {
+            label = `En cola (posición ${state.queue_position})...`;
+        } else if (state.state === 'waiting_upstream' && state.queue_position) {
+            label = `Esperando turno en el servidor de IA (posición ${state.queue_position})...`;
+        }
+        if (label && state.eta_seconds) {
+            label += ` Espera estimada: ~${formatEta(state.eta_seconds)}.`;
+        }
+        queueStatusDebug.textContent = label;
+    }
+
+    // Una única petición a /check_task cuando la tarea ha terminado.
+    async function collectTaskResult(taskId) {
+        try {
+            const response = await fetch(`/check_task/${taskId}`);
+            if (response.status === 404) {
+                finishTaskWithError('La tarea expiró o no se encontró. Inténtalo de nuevo.');
+                return;
+            }
+            if (!response.ok) throw new Error('La respuesta del servidor no fue OK');
+            const result = await response.json();
+
+            if (result.status === 'success') {
+                if (loadingSpinner) loadingSpinner.style.display = 'none';
+                enableAllButtons();
+                renderGeneratedImages(result.images);
+                showMessage(successMessage, `🎉 ¡Tus imágenes están listas!`, 'success');
+                reloadHistory();
+            } else if (result.status === 'error') {
+                finishTaskWithError(result.message);
+            } else {
+                // Aún en proceso (no debería pasar): seguimos esperando.
+                longPollTask(taskId);
+            }
+        } catch (error) {
+            finishTaskWithError('Error de conexión al verificar el resultado.');
+        }
+    }
+
+    // Lote en curso: se muestran las imágenes de cada elemento según van llegando.
+    function showBatchProgress(batch) {
         const queueStatusDebug = document.getElementById('queue-status-debug');
         if (queueStatusDebug) {
-            queueStatusDebug.textContent = ''; // Limpiamos el texto de depuración
+            let label = `Lote: ${batch.done} de ${batch.total} variaciones listas...`;
+            if (batch.queue_position) {
+                label += ` Siguiente turno en el servidor de IA: posición ${batch.queue_position}.`;
+                if (batch.eta_seconds) label += ` Espera estimada: ~${formatEta(batch.eta_seconds)}.`;
+            }
+            queueStatusDebug.textContent = label;
         }
+        const images = batch.items.flatMap(item => item.images);
+        if (images.length > 0) renderGeneratedImages(images);
+    }
 
-        const intervalId = setInterval(async () => {
+    function handleTaskState(taskId, state) {
+        if (state.state === 'not_found') {
+            finishTaskWithError('La tarea expiró o no se encontró. Inténtalo de nuevo.');
+        } else if (TERMINAL_TASK_STATES.includes(state.state)) {
+            collectTaskResult(taskId);
+        } else if (state.batch) {
+            showBatchProgress(state.batch);
+        } else {
+            showTaskStage(state);
+        }
+    }
+
+    async function longPollTask(taskId) {
+        let cursor = 0;
+        while (true) {
+            let state;
             try {
-                const response = await fetch(`/check_task/${taskId}`);
-                if (!response.ok) {
-                    if (response.status === 404) {
-                        clearInterval(intervalId);
-                        showMessage(errorMessage, 'La tarea expiró o no se encontró. Inténtalo de nuevo.');
-                        if (loadingSpinner) loadingSpinner.style.display = 'none';
-                        enableAllButtons();
-                        showInitialMessage();
-                        return;
-                    }
-                    throw new Error('La respuesta del servidor no fue OK');
-                }
-                const result = await response.json();
-
-                if (result.status === 'success') {
-                    clearInterval(intervalId);
-                    if (loadingSpinner) loadingSpinner.style.display = 'none';
-                    enableAllButtons();
-                    renderGeneratedImages(result.images);
-                    showMessage(successMessage, `🎉 ¡Tus imágenes están listas!`, 'success');
-
-                } else if (result.status === 'error') {
-                    clearInterval(intervalId);
-                    if (loadingSpinner) loadingSpinner.style.display = 'none';
-                    enableAllButtons();
-                    showMessage(errorMessage, result.message);
-                    showInitialMessage();
-                }
-                // Si el status es 'processing', simplemente esperamos
+                const response = await fetch(`/tasks/${taskId}/wait?since=${cursor}&timeout=25`);
+                state = await response.json();
             } catch (error) {
-                clearInterval(intervalId);
-                if (loadingSpinner) loadingSpinner.style.display = 'none';
-                enableAllButtons();
-                showMessage(errorMessage, 'Error de conexión al verificar el resultado.');
-                showInitialMessage();
+                finishTaskWithError('Error de conexión al verificar el resultado.');
+                return;
+            }
+            cursor = state.cursor || cursor;
+            handleTaskState(taskId, state);
+            if (TERMINAL_TASK_STATES.includes(state.state)) return;
+        }
+    }
+
+    function watchTask(taskId) {
+        const queueStatusDebug = document.getElementById('queue-status-debug');
+        if (queueStatusDebug) {
+            queueStatusDebug.textContent = '';
+        }
+        if (!window.EventSource) {
+            longPollTask(taskId);
+            return;
+        }
+        const source = new EventSource(`/tasks/${taskId}/events`);
+        let finished = false;
+        source.onmessage = function(event) {
+            const state = JSON.parse(event.data);
+            if (TERMINAL_TASK_STATES.includes(state.state)) {
+                finished = true;
+                source.close();
             }
-        }, 3000);
+            handleTaskState(taskId, state);
+        };
+        source.onerror = function() {
+            // Conexión cortada (proxy, límite de tiempo...): seguimos con long-poll.
+            source.close();
+            if (!finished) longPollTask(taskId);
+        };
     }
 
     generateButton.addEventListener('click', async function(event) {
@@ -415,27 +511,33 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
 
+        // En modo lote cada línea no vacía es una descripción distinta (ver /generate_batch).
+        const batchPrompts = batchModeCheckbox && batchModeCheckbox.checked
+            ? prompt.split('\n').map(line => line.trim()).filter(line => line) : null;
+        const request = {
+            num_images: num_images,
+            seed: seed,
+            aspect_ratio: aspect_ratio,
+            model_name_display: model_name_display,
+            save_images: save_images,
+            reference_images: currentReferenceImages
+        };
+        if (batchPrompts) request.prompts = batchPrompts;
+        else request.prompt = prompt;
+
         disableAllButtons();
         try {
-            const response = await fetch('/generate', {
+            const response = await fetch(batchPrompts ? '/generate_batch' : '/generate', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    prompt: prompt,
-                    num_images: num_images,
-                    seed: seed,
-                    aspect_ratio: aspect_ratio,
-                    model_name_display: model_name_display,
-                    save_images: save_images,
-                    reference_images: currentReferenceImages
-                }),
+                body: JSON.stringify(request),
             });
 
             const result = await response.json();
 
             if (response.status === 202 && result.status === 'processing') {
                 showMessage(successMessage, '✨ ¡Pinceles listos! Tu obra de arte está en camino...', 'success');
-                pollTaskStatus(result.task_id);
+                watchTask(result.task_id);
             } else {
                 throw new Error(result.message || 'Error al enviar la solicitud.');
             }
@@ -463,40 +565,46 @@ document.addEventListener('DOMContentLoaded', function() {
         else if (images.length === 2) resultsContainer.classList.add('cols-2');
         else if (images.length === 3) resultsContainer.classList.add('cols-3');
         else resultsContainer.classList.add('cols-4');
+        // Ancho aproximado de cada tarjeta: el navegador elige entre la miniatura y el original.
+        const imageSizes = images.length === 1 ? '(max-width: 768px) 100vw, 70vw'
+            : images.length === 2 ? '(max-width: 768px) 100vw, 35vw'
+            : '(max-width: 768px) 100vw, (max-width: 1200px) 35vw, 20vw';
 
-        images.forEach((img_data_url, index) => {
+        images.forEach((imageId, index) => {
+            const imageUrl = generatedImageUrl(imageId);
             const card = document.createElement('div');
             card.className = 'result-card';
             const modelType = window.MODEL_DISPLAY_NAMES_JS[activeModelDisplayName];
             const isRefModel = ["R2I", "GEM_PIX"].includes(modelType);
             let actionButtonsHtml;
             if (isRefModel) {
-                actionButtonsHtml = `<button onclick="window.addReferenceImage('${img_data_url}', null, true)">➕ Añadir</button>`;
+                actionButtonsHtml = `<button onclick="window.addGeneratedImageAsReference('${imageId}', null, true)">➕ Añadir</button>`;
             } else {
                 actionButtonsHtml = `
                     <div class="popover-container">
                         <button class="popover-button" onclick="window.togglePopover(this)">🎨 Usar en...</button>
                         <div class="popover-content">
-                            <button onclick="window.addReferenceImage('${img_data_url}', '${window.MODEL_NAMES_LIST_JS[2]}')">${window.MODEL_NAMES_LIST_JS[2]}</button>
-                            <button onclick="window.addReferenceImage('${img_data_url}', '${window.MODEL_NAMES_LIST_JS[3]}')">${window.MODEL_NAMES_LIST_JS[3]}</button>
+                            <button onclick="window.addGeneratedImageAsReference('${imageId}', '${window.MODEL_NAMES_LIST_JS[2]}')">${window.MODEL_NAMES_LIST_JS[2]}</button>
+                            <button onclick="window.addGeneratedImageAsReference('${imageId}', '${window.MODEL_NAMES_LIST_JS[3]}')">${window.MODEL_NAMES_LIST_JS[3]}</button>
                         </div>
                     </div>`;
             }
 
-            if (!img_data_url || !img_data_url.startsWith('data:image/')) {
+            if (!imageId || !/^[0-9a-f]{64}$/.test(imageId)) {
                 card.innerHTML = `<div style="color:red; text-align:center; padding:1rem;">Error: Imagen generada inválida o corrupta.</div>`;
             } else {
                  card.innerHTML = `
-                    <img src="${img_data_url}" alt="Generated Image ${index + 1}" class="clickable-image">
+                    <img src="${thumbnailUrl(imageId)}" srcset="${thumbnailUrl(imageId)} ${window.THUMBNAIL_MAX_SIDE_JS}w, ${imageUrl} 1024w"
+                         sizes="${imageSizes}" alt="Generated Image ${index + 1}" class="clickable-image" decoding="async">
                     <div class="action-row">
                         <div class="action-col">${actionButtonsHtml}</div>
                         <div class="download-col">
-                            <button class="download-button" onclick="downloadImage('${img_data_url}', ${index + 1})">📥</button>
+                            <button class="download-button" onclick="downloadImage('${imageUrl}', ${index + 1})">📥</button>
                         </div>
                     </div>`;
                 const imgElement = card.querySelector('.clickable-image');
                 if (imgElement) {
-                    imgElement.addEventListener('click', () => window.openImageModal(img_data_url));
+                    imgElement.addEventListener('click', () => window.openImageModal(imageUrl));
                     imgElement.style.cursor = 'pointer';
                 }
             }
@@ -507,6 +615,82 @@ document.addEventListener('DOMContentLoaded', function() {
         if (clearResultsButton) clearResultsButton.style.display = 'block';
     }
 
+    // --- HISTORIAL: GALERÍA PAGINADA DE MINIATURAS ---
+    // Se pide página a página (/history?before=<cursor>) cuando el final de la
+    // galería se acerca a la pantalla; cada tarjeta sólo carga su miniatura.
+    const historyGrid = document.getElementById('history-grid');
+    const historyEmpty = document.getElementById('history-empty');
+    const historySentinel = document.getElementById('history-sentinel');
+    const historyMoreButton = document.getElementById('history-more-button');
+    let historyCursor = null;
+    let historyDone = false;
+    let historyLoading = false;
+    let historyStarted = false;
+
+    function renderHistoryItem(item) {
+        const card = document.createElement('div');
+        card.className = 'history-card';
+        const imageUrl = generatedImageUrl(item.image_id);
+        const [ratioW, ratioH] = (item.aspect_ratio || '1:1').split(':');
+        const img = document.createElement('img');
+        img.src = thumbnailUrl(item.image_id);
+        img.alt = item.prompt;
+        img.title = item.prompt;
+        img.loading = 'lazy';
+        img.decoding = 'async';
+        img.style.aspectRatio = `${ratioW} / ${ratioH}`;
+        img.addEventListener('click', () => window.openImageModal(imageUrl));
+        img.addEventListener('error', () => card.remove());
+        const download = document.createElement('button');
+        download.className = 'download-button';
+        download.textContent = '📥';
+        download.addEventListener('click', () => downloadImage(imageUrl, item.id));
+        card.append(img, download);
+        return card;
+    }
+
+    async function loadHistoryPage() {
+        if (!historyGrid || historyLoading || historyDone) return;
+        historyLoading = true;
+        historyStarted = true;
+        try {
+            const response = await fetch(historyCursor === null ? '/history' : `/history?before=${historyCursor}`);
+            const data = await response.json();
+            if (data.status !== 'success') throw new Error(data.message);
+            data.items.forEach(item => historyGrid.appendChild(renderHistoryItem(item)));
+            historyCursor = data.next;
+            historyDone = data.next === null;
+        } catch (error) {
+            historyDone = true;
+        } finally {
+            historyLoading = false;
+        }
+        if (historyEmpty) historyEmpty.style.display = historyGrid.children.length === 0 ? 'block' : 'none';
+        if (historyMoreButton) historyMoreButton.style.display = historyDone ? 'none' : 'inline-block';
+        // Si el final sigue a la vista tras cargar, el observador no vuelve a avisar: se le reengancha.
+        if (historyObserver && !historyDone) {
+            historyObserver.unobserve(historySentinel);
+            historyObserver.observe(historySentinel);
+        }
+    }
+
+    function reloadHistory() {
+        if (!historyGrid || !historyStarted) return;
+        historyGrid.innerHTML = '';
+        historyCursor = null;
+        historyDone = false;
+        loadHistoryPage();
+    }
+
+    const historyObserver = (historySentinel && window.IntersectionObserver)
+        ? new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) loadHistoryPage();
+        }, { rootMargin: '400px' })
+        : null;
+    if (historyObserver) historyObserver.observe(historySentinel);
+    else loadHistoryPage();
+    if (historyMoreButton) historyMoreButton.addEventListener('click', loadHistoryPage);
+
     if (clearResultsButton) {
         clearResultsButton.addEventListener('click', async function() {
             hideMessages();
@@ -543,33 +727,103 @@ document.addEventListener('DOMContentLoaded', function() {
                     showMessage(errorMessage, `Archivo '${file.name}' no es una imagen.`);
                     continue;
                 }
-                if (file.size > 10 * 1024 * 1024) { 
-                    showMessage(errorMessage, `Imagen '${file.name}' es demasiado grande. Máx 10MB.`);
+                const image = await prepareReferenceImage(file);
+                const maxBytes = window.REFERENCE_LIMITS_JS.max_upload_bytes;
+                if (image.size > maxBytes) {
+                    showMessage(errorMessage, `Imagen '${file.name}' es demasiado grande. Máx ${Math.round(maxBytes / (1024 * 1024))}MB.`);
                     continue;
                 }
-                const reader = new FileReader();
-                reader.onload = async function(e) {
-                    const imageDataUrl = e.target.result;
-                    const status = await updateSessionReferenceImages(imageDataUrl, 'add');
-                    if (status) renderReferenceImages();
-                };
-                reader.readAsDataURL(file);
+                const status = await updateSessionReferenceImages(image, 'add');
+                if (status) renderReferenceImages();
             }
             fileUploader.value = '';
         });
     }
 
-    async function updateSessionReferenceImages(imageDataUrl, action = 'add', index = -1) {
+    // --- PREPARACIÓN DE REFERENCIAS EN EL NAVEGADOR ---
+    function fitWithin(width, height, maxSide) {
+        const scale = Math.min(1, maxSide / Math.max(width, height));
+        return [Math.max(1, Math.round(width * scale)), Math.max(1, Math.round(height * scale))];
+    }
+
+    function canvasToReferenceBlob(canvas) {
+        const limits = window.REFERENCE_LIMITS_JS;
+        return new Promise(resolve => canvas.toBlob(resolve, limits.mime_type, limits.quality));
+    }
+
+    // Reduce y recodifica la imagen al objetivo del servidor antes de subirla, para no
+    // enviar la foto a resolución completa. Si el navegador no sabe decodificarla
+    // (p. ej. HEIC) o el resultado no es más pequeño, se envía el original y la normaliza el servidor.
+    async function prepareReferenceImage(file) {
+        const limits = window.REFERENCE_LIMITS_JS;
+        let source = null;
+        let objectUrl = null;
+        try {
+            if (window.createImageBitmap) {
+                source = await createImageBitmap(file, { imageOrientation: 'from-image' });
+            } else {
+                objectUrl = URL.createObjectURL(file);
+                source = new Image();
+                source.src = objectUrl;
+                await source.decode();
+            }
+        } catch (error) {
+            if (objectUrl) URL.revokeObjectURL(objectUrl);
+            return file;
+        }
+        try {
+            // Un JPEG que ya cumple se sube tal cual: recodificarlo sólo perdería calidad.
+            if (file.type === limits.mime_type && Math.max(source.width, source.height) <= limits.max_side
+                && file.size <= limits.passthrough_max_bytes) {
+                return file;
+            }
+            const [width, height] = fitWithin(source.width, source.height, limits.max_side);
+            const canvas = document.createElement('canvas');
+            canvas.width = width;
+            canvas.height = height;
+            const context = canvas.getContext('2d');
+            context.imageSmoothingQuality = 'high';
+            context.drawImage(source, 0, 0, width, height);
+            const encoded = await canvasToReferenceBlob(canvas);
+            return encoded && encoded.size < file.size ? encoded : file;
+        } finally {
+            if (source.close) source.close();
+            if (objectUrl) URL.revokeObjectURL(objectUrl);
+        }
+    }
+
+    // Las imágenes se guardan en el servidor; aquí sólo manejamos sus IDs.
+    function referenceImageUrl(imageId) {
+        return `/reference_images/${imageId}`;
+    }
+
+    function generatedImageUrl(imageId) {
+        return `/images/${imageId}`;
+    }
+
+    function thumbnailUrl(imageId) {
+        return `/thumbnails/${imageId}`;
+    }
+
+    // `image` puede ser un File/Blob (se envía como multipart), {image_id} de una imagen generada o un data URL.
+    async function updateSessionReferenceImages(image, action = 'add', index = -1) {
         const maxReferences = 3;
         if (action === 'add' && currentReferenceImages.length >= maxReferences) {
             showMessage(errorMessage, `Límite de ${maxReferences} imágenes de referencia alcanzado.`);
             return false;
         }
         const url = action === 'add' ? '/add_reference_image' : `/remove_reference_image/${index}`;
-        const method = 'POST';
-        const body = action === 'add' ? JSON.stringify({ image: imageDataUrl }) : null;
+        const options = { method: 'POST' };
+        if (action === 'add' && image instanceof Blob) {
+            const formData = new FormData();
+            formData.append('image', image, image.name || 'referencia.jpg');
+            options.body = formData;
+        } else if (action === 'add') {
+            options.headers = { 'Content-Type': 'application/json' };
+            options.body = JSON.stringify(image && image.image_id ? { image_id: image.image_id } : { image: image });
+        }
         try {
-            const response = await fetch(url, { method: method, headers: { 'Content-Type': 'application/json' }, body: body });
+            const response = await fetch(url, options);
             const data = await response.json();
             if (data.status !== 'success') {
                 showMessage(errorMessage, data.message);
@@ -584,13 +838,13 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    window.addReferenceImage = async function(imageDataUrl, modelToActivate = null, fromAddButton = false) {
+    window.addReferenceImage = async function(image, modelToActivate = null, fromAddButton = false) {
         hideMessages();
         if (currentReferenceImages.length >= 3) {
             showMessage(errorMessage, `Límite de 3 imágenes alcanzado.`);
             return;
         }
-        const status = await updateSessionReferenceImages(imageDataUrl, 'add');
+        const status = await updateSessionReferenceImages(image, 'add');
         if (status) { 
             if (modelToActivate && activeModelDisplayName !== modelToActivate) {
                 window.handleTabChange(modelToActivate);
@@ -601,6 +855,10 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     };
 
+    window.addGeneratedImageAsReference = function(imageId, modelToActivate = null, fromAddButton = false) {
+        return window.addReferenceImage({ image_id: imageId }, modelToActivate, fromAddButton);
+    };
+
     window.removeReferenceImage = async function(index) {
         hideMessages();
         if (index >= 0 && index < currentReferenceImages.length) {
@@ -615,17 +873,18 @@ document.addEventListener('DOMContentLoaded', function() {
     function renderReferenceImages() {
         if (!referenceImagesContainer) return;
         referenceImagesContainer.innerHTML = '';
-        currentReferenceImages.forEach((img_data_url, index) => {
+        currentReferenceImages.forEach((imageId, index) => {
+            const imageUrl = referenceImageUrl(imageId);
             const refCard = document.createElement('div');
             refCard.className = 'ref-image-card';
             refCard.innerHTML = `
-                <img src="${img_data_url}" alt="Reference Image ${index + 1}" class="clickable-image">
+                <img src="${imageUrl}" alt="Reference Image ${index + 1}" class="clickable-image">
                 <button onclick="window.removeReferenceImage(${index})">✕</button>
             `;
             referenceImagesContainer.appendChild(refCard);
             const imgElement = refCard.querySelector('.clickable-image');
             if (imgElement) {
-                imgElement.addEventListener('click', () => window.openImageModal(img_data_url));
+                imgElement.addEventListener('click', () => window.openImageModal(imageUrl));
                 imgElement.style.cursor = 'pointer';
             }
         });
@@ -716,8 +975,8 @@ document.addEventListener('DOMContentLoaded', function() {
             updateFooterSaveMessage(true);
             if (window.initialSessionState.save_images) {
                 setTimeout(() => {
-                    window.initialSessionState.results.forEach((imgDataUrl, index) => {
-                        downloadImage(imgDataUrl, index + 1);
+                    window.initialSessionState.results.forEach((imageId, index) => {
+                        downloadImage(generatedImageUrl(imageId), index + 1);
                     });
                 }, 500);
             }
@@ -729,9 +988,9 @@ document.addEventListener('DOMContentLoaded', function() {
         activeModelDisplayName = getActiveModelName();
     }
 
-    window.downloadImage = function(dataUrl, index) {
+    window.downloadImage = function(imageUrl, index) {
         const link = document.createElement('a');
-        link.href = dataUrl;
+        link.href = imageUrl;
         link.download = `imagen_generada_${index}_${new Date().getTime()}.png`;
         document.body.appendChild(link);
         link.click();
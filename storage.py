@@ -0,0 +1,26 @@
+# storage.py
+import os
+import sqlite3
+import threading
+
+# --- CONEXIONES SQLITE COMPARTIDAS ENTRE HILOS Y WORKERS ---
+# Una conexión por hilo y por proceso: sqlite3 no permite compartir conexiones
+# entre hilos y, tras un fork de gunicorn, las heredadas no son seguras.
+_local = threading.local()
+
+
+def sqlite_connection(path: str) -> sqlite3.Connection:
+    conns = getattr(_local, 'conns', None)
+    if conns is None or getattr(_local, 'pid', None) != os.getpid():
+        conns = _local.conns = {}
+        _local.pid = os.getpid()
+    conn = conns.get(path)
+    if conn is None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conns[path] = conn
+    return conn
@@ -0,0 +1,692 @@
+# task_queue.py
+import asyncio
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from threading import Thread
+
+from config import (
+    TASK_STORE, TASK_DB_PATH, TASK_WORKERS, TASK_QUEUE_MAX, TASK_RESULT_TTL,
+    ASYNC_TASK_CONCURRENCY, ASYNC_TASK_QUEUE_MAX
+)
+from log_setup import log_fields, session_tag
+from metrics import collect_timings, observe_stage, tasks
+from storage import sqlite_connection
+
+PENDING_STATUSES = ('PENDING', 'RUNNING')
+FINISHED_STATUSES = ('SUCCESS', 'FAILURE')
+
+# Resultado que se guarda cuando el proceso dueño de una tarea desaparece
+# (reciclado de gunicorn por --max-requests, reinicio del contenedor...) y la
+# tarea no se puede retomar: ya estaba en curso o su trabajo no se conoce.
+LOST_TASK_RESULT = {'status': 'error', 'message': 'La generación se interrumpió por un reinicio del servidor. Inténtalo de nuevo.'}
+
+
+class QueueFullError(Exception):
+    """La cola de generación está llena; la solicitud no se admite."""
+
+    def __init__(self, queue_position):
+        super().__init__(f"Task queue full (position {queue_position})")
+        self.queue_position = queue_position
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_is_dead(owner):
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+# --- ALMACENES DE TAREAS ---
+class _TaskChangeWaiter:
+    """
+    Permite esperar a que una tarea cambie. Los cambios hechos en este proceso
+    despiertan al instante a quien espera; los de otros workers se detectan
+    sondeando el almacén cada `poll_interval` segundos (`async_poll_interval`
+    en las esperas asíncronas, que son muchas más y no deben saturar el almacén).
+    """
+
+    poll_interval = 1.0
+    async_poll_interval = 2.0
+
+    def _init_waiter(self):
+        self._changed = threading.Condition()
+        # task_id -> {(bucle, futuro)} de las corrutinas que esperan esa tarea.
+        self._async_waiters = {}
+        self._async_lock = threading.Lock()
+
+    def _notify(self, task_id=None):
+        with self._changed:
+            self._changed.notify_all()
+        with self._async_lock:
+            if task_id is None:
+                waiters = [w for ws in self._async_waiters.values() for w in ws]
+                self._async_waiters.clear()
+            else:
+                waiters = self._async_waiters.pop(task_id, ())
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def wait_for_update(self, task_id, since, timeout):
+        """Devuelve la tarea cuando su `updated` supere `since`, desaparezca o venza el timeout."""
+        deadline = time.time() + timeout
+        while True:
+            task = self.get(task_id)
+            if task is None or task['updated'] > since:
+                return task
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return task
+            with self._changed:
+                self._changed.wait(min(remaining, self.poll_interval))
+
+    async def wait_for_update_async(self, task_id, since, timeout):
+        """Como wait_for_update, pero la espera es una corrutina y no ocupa un hilo."""
+        loop = asyncio.get_running_loop()
+        deadline = time.time() + timeout
+        while True:
+            # Se registra antes de leer para no perder un aviso entre get() y la espera.
+            waiter = (loop, loop.create_future())
+            with self._async_lock:
+                self._async_waiters.setdefault(task_id, set()).add(waiter)
+            try:
+                task = await asyncio.to_thread(self.get, task_id)
+                if task is None or task['updated'] > since:
+                    return task
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return task
+                try:
+                    await asyncio.wait_for(waiter[1], min(remaining, self.async_poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                with self._async_lock:
+                    waiters = self._async_waiters.get(task_id)
+                    if waiters is not None:
+                        waiters.discard(waiter)
+                        if not waiters:
+                            del self._async_waiters[task_id]
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class MemoryTaskStore(_TaskChangeWaiter):
+    """Tareas en un dict del proceso. Sólo sirve con un único worker de gunicorn."""
+
+    def __init__(self, result_ttl=TASK_RESULT_TTL):
+        self.result_ttl = result_ttl
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._init_waiter()
+
+    def create(self, task_id, record):
+        now = time.time()
+        with self._lock:
+            self._tasks[task_id] = {**record, 'created': now, 'updated': now, 'owner': _owner()}
+        self._notify(task_id)
+
+    def get(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return dict(task) if task else None
+
+    def update(self, task_id, **fields):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return False
+            task.update(fields, updated=time.time())
+        self._notify(task_id)
+        return True
+
+    def delete(self, task_id):
+        with self._lock:
+            self._tasks.pop(task_id, None)
+        self._notify(task_id)
+
+    def count_pending(self):
+        with self._lock:
+            return sum(1 for t in self._tasks.values() if t['status'] in PENDING_STATUSES)
+
+    def create_if_room(self, task_id, record, max_pending, job=None):
+        """
+        Como create, pero lanza QueueFullError si ya hay `max_pending` tareas
+        pendientes. `job` no se guarda: estas tareas mueren con el proceso.
+        """
+        now = time.time()
+        with self._lock:
+            pending = sum(1 for t in self._tasks.values() if t['status'] in PENDING_STATUSES)
+            if pending >= max_pending:
+                raise QueueFullError(pending + 1)
+            self._tasks[task_id] = {**record, 'created': now, 'updated': now, 'owner': _owner()}
+        self._notify(task_id)
+
+    def count_by_status(self):
+        with self._lock:
+            counts = {}
+            for t in self._tasks.values():
+                counts[t['status']] = counts.get(t['status'], 0) + 1
+            return counts
+
+    def position(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if not task or task['status'] != 'PENDING':
+                return 0
+            return sum(1 for t in self._tasks.values()
+                       if t['status'] == 'PENDING' and t['created'] <= task['created'])
+
+    def purge_expired(self):
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            expired = [tid for tid, t in self._tasks.items()
+                       if t['status'] in FINISHED_STATUSES and t['updated'] < cutoff]
+            for tid in expired:
+                del self._tasks[tid]
+        return len(expired)
+
+    def claim_orphaned(self):
+        return []
+
+
+class SQLiteTaskStore(_TaskChangeWaiter):
+    """Tareas en un fichero SQLite (WAL) compartido por todos los workers del contenedor."""
+
+    poll_interval = 0.5
+
+    def __init__(self, path=TASK_DB_PATH, result_ttl=TASK_RESULT_TTL):
+        self.path = path
+        self.result_ttl = result_ttl
+        self._init_waiter()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " task_id TEXT PRIMARY KEY, status TEXT NOT NULL, data TEXT NOT NULL,"
+            " owner TEXT, created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS tasks_status_created ON tasks (status, created)")
+        # Trabajo de la tarea ({'name', 'args', 'fair_key'}) mientras está
+        # pendiente: si su worker desaparece, otro la retoma (claim_orphaned).
+        columns = [row[1] for row in self._conn().execute("PRAGMA table_info(tasks)")]
+        if 'job' not in columns:
+            self._conn().execute("ALTER TABLE tasks ADD COLUMN job TEXT")
+
+    def _conn(self):
+        return sqlite_connection(self.path)
+
+    def create(self, task_id, record):
+        now = time.time()
+        data = {k: v for k, v in record.items() if k != 'status'}
+        self._conn().execute(
+            "INSERT OR REPLACE INTO tasks (task_id, status, data, owner, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (task_id, record['status'], json.dumps(data), _owner(), now, now)
+        )
+        self._notify(task_id)
+
+    def get(self, task_id):
+        row = self._conn().execute(
+            "SELECT status, data, owner, created, updated FROM tasks WHERE task_id = ?", (task_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, data, owner, created, updated = row
+        return {**json.loads(data), 'status': status, 'owner': owner, 'created': created, 'updated': updated}
+
+    def update(self, task_id, **fields):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT status, data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return False
+            status, data = row
+            data = json.loads(data)
+            status = fields.pop('status', status)
+            data.update(fields)
+            # Una tarea terminada ya no se retoma: su trabajo sobra.
+            conn.execute(
+                "UPDATE tasks SET status = ?, data = ?, updated = ?,"
+                " job = CASE WHEN ? IN (?, ?) THEN NULL ELSE job END WHERE task_id = ?",
+                (status, json.dumps(data), time.time(), status, *FINISHED_STATUSES, task_id)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify(task_id)
+        return True
+
+    def delete(self, task_id):
+        self._conn().execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+        self._notify(task_id)
+
+    def count_pending(self):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)", PENDING_STATUSES
+        ).fetchone()[0]
+
+    def create_if_room(self, task_id, record, max_pending, job=None):
+        """
+        Como create, pero lanza QueueFullError si ya hay `max_pending` tareas
+        pendientes. Cuenta e inserta en la misma transacción: dos workers que
+        admiten a la vez no pueden pasarse del límite. `job` (serializable en
+        JSON) permite a otro worker retomar la tarea si esta se queda huérfana.
+        """
+        now = time.time()
+        data = {k: v for k, v in record.items() if k != 'status'}
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)", PENDING_STATUSES
+            ).fetchone()[0]
+            if pending >= max_pending:
+                conn.execute("COMMIT")
+                raise QueueFullError(pending + 1)
+            conn.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, status, data, owner, created, updated, job) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (task_id, record['status'], json.dumps(data), _owner(), now, now, json.dumps(job) if job else None)
+            )
+            conn.execute("COMMIT")
+        except QueueFullError:
+            raise
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify(task_id)
+
+    def count_by_status(self):
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+    def position(self, task_id):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM tasks WHERE status = 'PENDING'"
+            " AND created <= (SELECT created FROM tasks WHERE task_id = ? AND status = 'PENDING')",
+            (task_id,)
+        ).fetchone()[0]
+
+    def purge_expired(self):
+        conn = self._conn()
+        cur = conn.execute(
+            "DELETE FROM tasks WHERE status IN (?, ?) AND updated < ?",
+            (*FINISHED_STATUSES, time.time() - self.result_ttl)
+        )
+        purged = cur.rowcount
+        # Tareas huérfanas que no se pueden retomar: su worker murió con ellas
+        # en curso, o no guardaron su trabajo. Las demás esperan a claim_orphaned.
+        lost = "owner = ? AND (status = 'RUNNING' OR (status = 'PENDING' AND job IS NULL))"
+        owners = conn.execute(
+            "SELECT DISTINCT owner FROM tasks WHERE status IN (?, ?)", PENDING_STATUSES
+        ).fetchall()
+        for (owner,) in owners:
+            if _owner_is_dead(owner):
+                failed = conn.execute(
+                    f"UPDATE tasks SET status = 'FAILURE', data = ?, updated = ?, job = NULL WHERE {lost}",
+                    (json.dumps({'result': LOST_TASK_RESULT}), time.time(), owner)
+                ).rowcount
+                if failed:
+                    logging.warning("Task owner %s is gone. Marked %d unrecoverable task(s) as failed.", owner, failed)
+        return purged
+
+    def claim_orphaned(self):
+        """
+        Pasa a este proceso las tareas PENDING con trabajo guardado cuyo worker
+        ya no existe. Devuelve [(task_id, trabajo)] por orden de llegada. El
+        cambio de dueño es atómico: cada tarea la retoma un solo worker.
+        """
+        conn = self._conn()
+        me = _owner()
+        owners = conn.execute(
+            "SELECT DISTINCT owner FROM tasks WHERE status = 'PENDING' AND job IS NOT NULL AND owner != ?", (me,)
+        ).fetchall()
+        claimed = []
+        for (owner,) in owners:
+            if not _owner_is_dead(owner):
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT task_id, job FROM tasks WHERE owner = ? AND status = 'PENDING' AND job IS NOT NULL ORDER BY created",
+                    (owner,)
+                ).fetchall()
+                conn.execute(
+                    "UPDATE tasks SET owner = ? WHERE owner = ? AND status = 'PENDING' AND job IS NOT NULL", (me, owner)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            claimed.extend((task_id, json.loads(job)) for task_id, job in rows)
+        return claimed
+
+
+def create_task_store():
+    if TASK_STORE == 'memory':
+        return MemoryTaskStore()
+    return SQLiteTaskStore()
+
+
+# --- COLA POR TURNOS ENTRE SESIONES ---
+class FairQueue:
+    """
+    Cola acotada con una sub-cola FIFO por clave (la sesión) que se atienden
+    por turnos: una sesión con diez tareas en espera no retrasa la primera de
+    otra sesión más que una tarea. Los elementos son tuplas cuyo primer campo
+    es el task_id. Interfaz mínima de queue.Queue (put_nowait, get, qsize).
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # clave -> deque de elementos; el orden del dict es el turno.
+        self._queues = OrderedDict()
+        self._keys = {}
+        self._size = 0
+        self._not_empty = threading.Condition()
+
+    def put_nowait(self, item, key=None):
+        with self._not_empty:
+            if self._size >= self.maxsize:
+                raise queue.Full
+            self._queues.setdefault(key, deque()).append(item)
+            self._keys[item[0]] = key
+            self._size += 1
+            self._not_empty.notify()
+
+    def get(self):
+        with self._not_empty:
+            while not self._size:
+                self._not_empty.wait()
+            key, items = self._queues.popitem(last=False)
+            item = items.popleft()
+            if items:
+                # La sesión vuelve al final del turno.
+                self._queues[key] = items
+            del self._keys[item[0]]
+            self._size -= 1
+            return item
+
+    def qsize(self):
+        with self._not_empty:
+            return self._size
+
+    def position(self, task_id):
+        """Posición (desde 1) en que get() devolverá la tarea, o 0 si no está en esta cola."""
+        with self._not_empty:
+            if task_id not in self._keys:
+                return 0
+            key = self._keys[task_id]
+            index = next(i for i, item in enumerate(self._queues[key]) if item[0] == task_id)
+            # Va en la vuelta `index`: antes salen, de cada otra sesión, las de
+            # vueltas anteriores y la de esta vuelta si su turno va delante.
+            keys = list(self._queues)
+            own_turn = keys.index(key)
+            position = index + 1
+            for turn, other in enumerate(keys):
+                if other != key:
+                    position += min(len(self._queues[other]), index + (1 if turn < own_turn else 0))
+            return position
+
+
+class FairExecutor:
+    """
+    Como ThreadPoolExecutor, pero lo enviado con distinta clave (la sesión) se
+    atiende por turnos (FairQueue): las llamadas de un lote grande no retrasan
+    hasta terminar las del lote de otra sesión. Los hilos se arrancan en cada
+    proceso la primera vez que se usa (ver TaskQueue.ensure_started).
+    """
+
+    def __init__(self, workers, thread_name_prefix="fair"):
+        self.workers = workers
+        self.thread_name_prefix = thread_name_prefix
+        self._queue = FairQueue(float('inf'))
+        self._ids = itertools.count()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        """Programa fn(*args) en el turno de `key`; devuelve un concurrent.futures.Future."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put_nowait((next(self._ids), future, fn, args), key)
+        return future
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = FairQueue(float('inf'))
+            for i in range(self.workers):
+                Thread(target=self._worker_loop, name=f"{self.thread_name_prefix}-{i}", daemon=True).start()
+
+    def _worker_loop(self):
+        while True:
+            _, future, fn, args = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+# --- POOL DE WORKERS CON COLA ACOTADA ---
+class TaskQueue:
+    """
+    Pool fijo de hilos que consume una cola acotada. Si hay demasiadas tareas
+    pendientes (en todo el almacén, no sólo en este proceso) se rechaza la
+    solicitud con QueueFullError en lugar de crear un hilo nuevo. Las tareas
+    de distintas sesiones (`fair_key`) se atienden por turnos (FairQueue).
+
+    Las funciones registradas con register_job() guardan su trabajo en el
+    almacén: si el worker se recicla con tareas aún en cola, otro las retoma.
+    """
+
+    PURGE_INTERVAL = 30
+
+    def __init__(self, store, workers=TASK_WORKERS, max_pending=TASK_QUEUE_MAX):
+        self.store = store
+        self.workers = workers
+        self.max_pending = max_pending
+        self._queue = FairQueue(max_pending)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self.running = 0
+        # nombre -> función de las tareas que se pueden retomar.
+        self.jobs = {}
+
+    def register_job(self, name, func):
+        """Registra func para retomar tareas huérfanas; sus argumentos deben ser serializables en JSON."""
+        self.jobs[name] = func
+
+    def _job_name(self, func):
+        return next((name for name, job in self.jobs.items() if job is func), None)
+
+    def ensure_started(self):
+        """
+        Arranca, una vez por proceso, los hilos de trabajo y la purga periódica
+        del almacén. Los hilos no sobreviven a un fork: si la app se precarga
+        en el master de gunicorn, cada worker arranca los suyos la primera vez.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = FairQueue(self.max_pending)
+            self._threads = []
+            for i in range(self.workers):
+                thread = Thread(target=self._worker_loop, name=f"task-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            Thread(target=self._purge_loop, name="task-purger", daemon=True).start()
+
+    def _purge_loop(self):
+        # Tareas caducadas y huérfanas se limpian aunque no lleguen solicitudes
+        # nuevas. Antes se retoman las huérfanas que se pueden volver a encolar.
+        while True:
+            try:
+                self._recover_orphaned()
+                purged = self.store.purge_expired()
+                if purged:
+                    logging.info("Purged %d expired task(s).", purged)
+            except Exception as e:
+                logging.error("Task purge failed: %s", e)
+            time.sleep(self.PURGE_INTERVAL)
+
+    def _recover_orphaned(self):
+        for task_id, job in self.store.claim_orphaned():
+            func = self.jobs.get(job['name'])
+            if func is None or not self._enqueue(task_id, func, tuple(job['args']), job['fair_key']):
+                self.store.update(task_id, status='FAILURE', result=LOST_TASK_RESULT)
+                continue
+            logging.info("Task %s recovered from a worker that is gone.", task_id)
+
+    def _enqueue(self, task_id, func, args, fair_key):
+        """Pone en la cola de este proceso una tarea ya admitida; False si no cabe."""
+        try:
+            self._queue.put_nowait((task_id, func, args, time.perf_counter(), fair_key), key=fair_key)
+        except queue.Full:
+            return False
+        return True
+
+    def _admit(self, task_id, func=None, args=(), fair_key=None):
+        """Da de alta la tarea como PENDING o lanza QueueFullError si hay demasiadas pendientes."""
+        name = self._job_name(func)
+        job = {'name': name, 'args': list(args), 'fair_key': fair_key} if name else None
+        self.store.create_if_room(task_id, {'status': 'PENDING', 'stage': 'queued'}, self.max_pending, job=job)
+
+    def _succeeded(self, task_id, result, timings):
+        self.store.update(task_id, status='SUCCESS', result=result, timings=timings)
+        tasks.inc(status='SUCCESS')
+
+    def _failed(self, task_id, error, timings):
+        logging.error("Task %s failed in worker: %s", task_id, error)
+        self.store.update(task_id, status='FAILURE', result={'status': 'error', 'message': 'La generación falló por un error inesperado.'}, timings=timings)
+        tasks.inc(status='FAILURE')
+
+    def submit(self, task_id, func, *args, fair_key=None):
+        """Encola func(task_id, *args) en el turno de `fair_key`. Devuelve la posición en la cola."""
+        self.ensure_started()
+        self._admit(task_id, func, args, fair_key)
+        if not self._enqueue(task_id, func, args, fair_key):
+            self.store.delete(task_id)
+            raise QueueFullError(self._queue.qsize() + 1)
+        return self.position(task_id)
+
+    def position(self, task_id):
+        """Posición en la cola de este proceso; si la tarea es de otro worker, la del almacén (por orden de llegada)."""
+        return self._queue.position(task_id) or self.store.position(task_id)
+
+    def _worker_loop(self):
+        while True:
+            task_id, func, args, queued_at, fair_key = self._queue.get()
+            with self._lock:
+                self.running += 1
+            # Los tiempos por etapa se guardan junto al resultado (ver /check_task?timings=1);
+            # cada línea de log de la tarea lleva su ID y el de su sesión.
+            with collect_timings() as timings, log_fields(task_id=task_id, session=session_tag(fair_key)):
+                observe_stage('queue_wait', time.perf_counter() - queued_at)
+                try:
+                    self.store.update(task_id, status='RUNNING', stage='running')
+                    started = time.perf_counter()
+                    result = func(task_id, *args)
+                    observe_stage('run', time.perf_counter() - started)
+                    self._succeeded(task_id, result, timings)
+                except Exception as e:
+                    self._failed(task_id, e, timings)
+                finally:
+                    with self._lock:
+                        self.running -= 1
+
+
+# --- COLA DEL MODO ASÍNCRONO (ASGI) ---
+class AsyncTaskQueue(TaskQueue):
+    """
+    Misma interfaz que TaskQueue, pero cada tarea es una corrutina en el bucle
+    de eventos del servidor ASGI (ver asgi.py): mientras espera al backend no
+    ocupa un hilo. `concurrency` acota las tareas que corren a la vez; el resto
+    sigue PENDING. submit() se puede llamar desde cualquier hilo (las vistas
+    de Flask corren en hilos del puente WSGI) una vez hecho start(loop).
+    """
+
+    def __init__(self, store, concurrency=ASYNC_TASK_CONCURRENCY, max_pending=ASYNC_TASK_QUEUE_MAX):
+        super().__init__(store, workers=0, max_pending=max_pending)
+        self.concurrency = concurrency
+        self.loop = None
+        self._semaphore = None
+        self._tasks = set()
+
+    def start(self, loop):
+        self.loop = loop
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.ensure_started()
+
+    def submit(self, task_id, func, *args, fair_key=None):
+        """
+        Programa la corrutina func(task_id, *args). Devuelve la posición en la
+        cola. Aquí no hace falta turno por sesión: el reparto lo hace el
+        planificador del backend (scheduler.py), al que llegan todas a la vez.
+        """
+        if self.loop is None:
+            raise RuntimeError("AsyncTaskQueue.start() has not been called")
+        self._admit(task_id, func, args, fair_key)
+        self._enqueue(task_id, func, args, fair_key)
+        return self.store.position(task_id)
+
+    def _enqueue(self, task_id, func, args, fair_key):
+        self.loop.call_soon_threadsafe(self._spawn, task_id, func, args, time.perf_counter(), fair_key)
+        return True
+
+    def position(self, task_id):
+        return self.store.position(task_id)
+
+    def _spawn(self, task_id, func, args, queued_at, fair_key):
+        # Se guarda una referencia: el bucle sólo mantiene referencias débiles a sus tareas.
+        task = self.loop.create_task(self._run(task_id, func, args, queued_at, fair_key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, task_id, func, args, queued_at, fair_key):
+        async with self._semaphore:
+            self.running += 1
+            with collect_timings() as timings, log_fields(task_id=task_id, session=session_tag(fair_key)):
+                observe_stage('queue_wait', time.perf_counter() - queued_at)
+                try:
+                    # El almacén (SQLite) bloquea: sus escrituras van a un hilo.
+                    await asyncio.to_thread(self.store.update, task_id, status='RUNNING', stage='running')
+                    started = time.perf_counter()
+                    result = await func(task_id, *args)
+                    observe_stage('run', time.perf_counter() - started)
+                    await asyncio.to_thread(self._succeeded, task_id, result, timings)
+                except Exception as e:
+                    await asyncio.to_thread(self._failed, task_id, e, timings)
+                finally:
+                    self.running -= 1
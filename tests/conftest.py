@@ -0,0 +1,26 @@
+# tests/conftest.py
+import os
+import sys
+
+# Los módulos de la app están en la raíz del repositorio.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+class FakeClock:
+    """Reloj que sólo avanza con advance(); se pasa como `clock` a UpstreamScheduler y CircuitBreaker."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
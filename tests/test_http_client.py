@@ -0,0 +1,211 @@
+# tests/test_http_client.py
+"""
+UpstreamClient y AsyncUpstreamClient contra un servidor local que hace de
+backend: reutilización de conexiones keep-alive, política de reintentos
+(idempotentes o no) y timeouts de lectura.
+"""
+import asyncio
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from http_client import AsyncUpstreamClient, UpstreamClient
+
+
+class StandInServer:
+    """
+    Backend de pruebas. Cada POST consume la siguiente acción de `script`
+    (la última se repite): un código HTTP, 'reset' (cierra la conexión tras
+    leer la petición, sin responder) o ('sleep', segundos).
+    """
+
+    def __init__(self, script=(200,)):
+        self.script = list(script)
+        self.hits = 0
+        self.client_ports = set()
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with server._lock:
+                    action = server.script[min(server.hits, len(server.script) - 1)]
+                    server.hits += 1
+                    server.client_ports.add(self.client_address[1])
+                if action == 'reset':
+                    self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, b'\x01\x00\x00\x00\x00\x00\x00\x00')
+                    self.close_connection = True
+                    return
+                if isinstance(action, tuple):
+                    time.sleep(action[1])
+                    action = 200
+                body = b'{"ok": true}'
+                self.send_response(action)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1:runImageFx"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server_factory():
+    servers = []
+
+    def start(script=(200,)):
+        server = StandInServer(script)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1:runImageFx"
+
+
+def make_client(**kwargs):
+    return UpstreamClient(**{'pool_size': 4, 'connect_timeout': 2, 'max_retries': 2, 'backoff': 0.01, **kwargs})
+
+
+# --- KEEP-ALIVE ---
+def test_sequential_calls_reuse_one_connection(server_factory):
+    server = server_factory()
+    client = make_client()
+    for _ in range(5):
+        assert client.post('generate', server.url, read_timeout=5, idempotent=False, json={}).status_code == 200
+    stats = client.stats()
+    assert server.hits == 5
+    assert len(server.client_ports) == 1
+    assert stats['connections_opened'] == 1
+    assert stats['reuse_ratio'] == 0.8
+
+
+# --- REINTENTOS ---
+def test_idempotent_call_retries_gateway_errors(server_factory):
+    server = server_factory([503, 502, 200])
+    client = make_client()
+    assert client.post('upload', server.url, read_timeout=5, json={}).status_code == 200
+    assert server.hits == 3
+    assert client.stats()['retries'] == 2
+
+
+def test_generate_does_not_retry_gateway_errors(server_factory):
+    server = server_factory([504, 200])
+    client = make_client()
+    assert client.post('generate', server.url, read_timeout=5, idempotent=False, json={}).status_code == 504
+    assert server.hits == 1
+    assert client.stats()['retries'] == 0
+
+
+def test_generate_does_not_retry_reset_after_sending(server_factory):
+    server = server_factory(['reset', 200])
+    client = make_client()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('generate', server.url, read_timeout=5, idempotent=False, json={})
+    assert server.hits == 1
+    assert client.stats()['failures'] == 1
+
+
+def test_idempotent_call_retries_reset(server_factory):
+    server = server_factory(['reset', 200])
+    client = make_client()
+    assert client.post('upload', server.url, read_timeout=5, json={}).status_code == 200
+    assert server.hits == 2
+
+
+def test_generate_retries_connection_refused():
+    client = make_client()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('generate', closed_port_url(), read_timeout=5, idempotent=False, json={})
+    stats = client.stats()
+    assert stats['retries'] == 2
+    assert stats['failures'] == 1
+
+
+# --- TIMEOUTS ---
+def test_read_timeout_is_not_retried(server_factory):
+    server = server_factory([('sleep', 1.0)])
+    client = make_client()
+    started = time.perf_counter()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post('upload', server.url, read_timeout=0.2, json={})
+    assert time.perf_counter() - started < 0.9
+    assert server.hits == 1
+    assert client.stats()['retries'] == 0
+    assert client.stats()['failures'] == 1
+
+
+# --- CLIENTE ASÍNCRONO ---
+def make_async_client():
+    pytest.importorskip('httpx')
+    return AsyncUpstreamClient(pool_size=4, connect_timeout=2, max_retries=2, backoff=0.01)
+
+
+def run_post(client, url, **kwargs):
+    async def call():
+        try:
+            response = await client.post('generate', url, read_timeout=kwargs.pop('read_timeout', 5), json={}, **kwargs)
+            return response.status_code
+        finally:
+            await client.aclose()
+    return asyncio.run(call())
+
+
+def test_async_generate_does_not_retry_gateway_errors(server_factory):
+    server = server_factory([503, 200])
+    assert run_post(make_async_client(), server.url, idempotent=False) == 503
+    assert server.hits == 1
+
+
+def test_async_idempotent_call_retries_gateway_errors(server_factory):
+    server = server_factory([503, 200])
+    assert run_post(make_async_client(), server.url) == 200
+    assert server.hits == 2
+
+
+def test_async_generate_does_not_retry_reset_after_sending(server_factory):
+    import httpx
+    server = server_factory(['reset', 200])
+    with pytest.raises(httpx.HTTPError):
+        run_post(make_async_client(), server.url, idempotent=False)
+    assert server.hits == 1
+
+
+def test_async_generate_retries_connection_refused():
+    import httpx
+    client = make_async_client()
+    with pytest.raises(httpx.ConnectError):
+        run_post(client, closed_port_url(), idempotent=False)
+    assert client.stats()['retries'] == 2
+
+
+def test_async_read_timeout_is_not_retried(server_factory):
+    import httpx
+    server = server_factory([('sleep', 1.0)])
+    with pytest.raises(httpx.ReadTimeout):
+        run_post(make_async_client(), server.url, read_timeout=0.2)
+    assert server.hits == 1
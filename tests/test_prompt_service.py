@@ -0,0 +1,154 @@
+# tests/test_prompt_service.py
+"""
+PromptService y CircuitBreaker con un cliente de Gemini falso: plazo máximo
+de cada llamada, circuito cerrado → abierto → semiabierto → cerrado, y
+respaldo al prompt original cuando Gemini no está disponible.
+"""
+import asyncio
+import threading
+import time
+import types
+
+import pytest
+
+import utils
+from cache import MemoryTTLCache
+from prompt_service import CircuitBreaker, PromptService, PromptServiceUnavailable
+
+
+class FakeModel:
+    """
+    Cliente compatible con PromptService. Cada llamada consume la siguiente
+    acción de `script` (la última se repite): un texto que devolver, una
+    excepción que lanzar o 'hang' (no responde hasta `release`).
+    """
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = []
+        self.release = threading.Event()
+
+    def _next(self, text, request_options):
+        self.calls.append((text, request_options))
+        return self.script.pop(0) if len(self.script) > 1 else self.script[0]
+
+    def generate_content(self, text, request_options=None):
+        action = self._next(text, request_options)
+        if action == 'hang':
+            self.release.wait(5)
+            action = 'tarde'
+        if isinstance(action, Exception):
+            raise action
+        return types.SimpleNamespace(text=f" {action} ")
+
+    async def generate_content_async(self, text, request_options=None):
+        action = self._next(text, request_options)
+        if action == 'hang':
+            await asyncio.sleep(5)
+        if isinstance(action, Exception):
+            raise action
+        return types.SimpleNamespace(text=f" {action} ")
+
+
+def make_service(model, breaker=None, timeout=5):
+    return PromptService(api_key='test', timeout=timeout, model_factory=lambda api_key, name: model,
+                         breaker=breaker or CircuitBreaker(failure_threshold=2, reset_timeout=30))
+
+
+def test_returns_the_stripped_text():
+    model = FakeModel('a cat on the moon')
+    service = make_service(model)
+    assert service.translate('un gato en la luna') == 'a cat on the moon'
+    assert 'un gato en la luna' in model.calls[0][0]
+    assert model.calls[0][1] == {'timeout': 5}
+
+
+def test_call_that_does_not_answer_times_out():
+    model = FakeModel('hang')
+    service = make_service(model, timeout=0.1)
+    started = time.perf_counter()
+    with pytest.raises(PromptServiceUnavailable, match='timed out'):
+        service.translate('un gato')
+    assert time.perf_counter() - started < 2
+    model.release.set()
+
+
+def test_async_call_that_does_not_answer_times_out():
+    service = make_service(FakeModel('hang'), timeout=0.1)
+    with pytest.raises(PromptServiceUnavailable, match='timed out'):
+        asyncio.run(service.translate_async('un gato'))
+
+
+def test_breaker_opens_then_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    model = FakeModel(RuntimeError('503'), RuntimeError('503'), 'a cat')
+    service = make_service(model, breaker)
+
+    for _ in range(2):
+        assert breaker.state == 'closed'
+        with pytest.raises(PromptServiceUnavailable, match='503'):
+            service.magic()
+    assert breaker.state == 'open'
+    with pytest.raises(PromptServiceUnavailable, match='circuit open'):
+        service.magic()
+    assert len(model.calls) == 2  # con el circuito abierto no se llama a Gemini
+
+    clock.advance(30)
+    assert breaker.state == 'half_open'
+    assert service.magic() == 'a cat'
+    assert breaker.state == 'closed'
+    assert len(model.calls) == 3
+
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    service = make_service(FakeModel(RuntimeError('503')), breaker)
+    with pytest.raises(PromptServiceUnavailable):
+        service.magic()
+    clock.advance(30)
+    with pytest.raises(PromptServiceUnavailable, match='503'):
+        service.magic()
+    assert breaker.state == 'open'
+    clock.advance(29)
+    assert breaker.state == 'open'
+
+
+def test_half_open_breaker_allows_a_single_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.allow()
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """Sustituye el servicio de utils por uno con cliente falso y una caché vacía en memoria."""
+    def install(*script):
+        model = FakeModel(*script)
+        monkeypatch.setattr(utils, 'prompt_service', make_service(model))
+        monkeypatch.setattr(utils, 'translation_cache', MemoryTTLCache('translations', 10, 60))
+        return model
+    return install
+
+
+def test_translation_falls_back_to_the_original_prompt(gemini):
+    gemini(RuntimeError('503'), 'a cat on the moon')
+    assert utils.translate_to_english(' un gato en la luna ') == 'un gato en la luna'
+    # El respaldo no se guarda en la caché: la siguiente vez se vuelve a pedir.
+    assert utils.translate_to_english('un gato en la luna') == 'a cat on the moon'
+
+
+def test_improve_falls_back_to_the_original_prompt(gemini):
+    model = gemini('hang')
+    utils.prompt_service.timeout = 0.1
+    assert utils.improve_and_translate_to_english('un gato') == 'un gato'
+    model.release.set()
+
+
+def test_english_prompt_is_not_sent_to_gemini(gemini):
+    model = gemini('should not be used')
+    assert utils.translate_to_english('a cat on the moon') == 'a cat on the moon'
+    assert model.calls == []
@@ -0,0 +1,130 @@
+# tests/test_response_parser.py
+"""
+EncodedImageExtractor y la lectura acotada: el JSON del backend se recorre
+por trozos cortados en cualquier punto (también dentro de la clave, del
+base64 o de un escape '\\/'), las imágenes se guardan decodificadas y el
+resto del documento queda como esqueleto pequeño.
+"""
+import asyncio
+import base64
+import json
+import os
+
+import pytest
+
+from blob_store import BlobStore
+from response_parser import (
+    EncodedImageExtractor, ResponseTooLarge, aread_limited, extract_encoded_images, iter_limited, panel_images,
+    read_limited
+)
+
+# '\xff\xfe\xfd' en base64 lleva '/', que el backend puede escapar como '\/'.
+FIRST = b'\xff\xfe\xfd' * 20 + b'png'
+SECOND = b'\x89PNG segunda imagen'
+
+
+def encoded(data, escape_slash=False):
+    text = base64.b64encode(data).decode()
+    return text.replace('/', '\\/') if escape_slash else text
+
+
+def document(*values):
+    images = ', '.join(f'{{"encodedImage": "{value}", "seed": {i}}}' for i, value in enumerate(values))
+    return f'{{"imagePanels": [{{"prompt": "un gato", "generatedImages": [{images}]}}]}}'.encode()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / 'generated'), 'image/png', ttl=60)
+
+
+def stored(store, blob_id):
+    with open(store._path(blob_id), 'rb') as f:
+        return f.read()
+
+
+def leftover_temp_files(store):
+    return [name for name in os.listdir(store.directory) if name.startswith('.tmp-')]
+
+
+def test_every_split_point_gives_the_same_result(store):
+    doc = document(encoded(FIRST, escape_slash=True), encoded(SECOND))
+    for cut in range(1, len(doc)):
+        skeleton, results = extract_encoded_images([doc[:cut], doc[cut:]], store.writer)
+        assert [stored(store, blob_id) for blob_id in results] == [FIRST, SECOND], cut
+        images = json.loads(skeleton)['imagePanels'][0]['generatedImages']
+        assert images == [{'encodedImage': '', 'seed': 0}, {'encodedImage': '', 'seed': 1}]
+    assert leftover_temp_files(store) == []
+
+
+def test_one_byte_chunks(store):
+    doc = document(encoded(FIRST, escape_slash=True))
+    skeleton, results = extract_encoded_images([doc[i:i + 1] for i in range(len(doc))], store.writer)
+    assert stored(store, results[0]) == FIRST
+    assert json.loads(skeleton)['imagePanels'][0]['prompt'] == 'un gato'
+
+
+def test_invalid_base64_gives_none_and_keeps_the_other_images(store):
+    doc = document('no es base64!', encoded(SECOND))
+    skeleton, results = extract_encoded_images([doc[:20], doc[20:]], store.writer)
+    assert results[0] is None
+    assert stored(store, results[1]) == SECOND
+    assert leftover_temp_files(store) == []
+
+
+def test_empty_value_gives_none(store):
+    _, results = extract_encoded_images([document('')], store.writer)
+    assert results == [None]
+
+
+def test_image_without_encoded_image_field(store):
+    doc = (b'{"imagePanels": [{"generatedImages": [{"seed": 1}, {"encodedImage": "'
+           + encoded(SECOND).encode() + b'"}]}]}')
+    skeleton, results = extract_encoded_images([doc], store.writer)
+    assert len(results) == 1
+    assert panel_images(json.loads(skeleton), results) == [[None, results[0]]]
+
+
+def test_response_ending_inside_an_image_is_an_error(store):
+    doc = document(encoded(FIRST))
+    extractor = EncodedImageExtractor(store.writer)
+    extractor.feed(doc[:doc.index(b'"encodedImage"') + 30])
+    with pytest.raises(ValueError):
+        extractor.finish()
+    assert leftover_temp_files(store) == []
+
+
+class FakeResponse:
+    """Respuesta de requests/httpx en streaming con el cuerpo `body`."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    async def aiter_bytes(self, chunk_size):
+        for chunk in self.iter_content(chunk_size):
+            yield chunk
+
+
+def test_limited_read_within_the_limit():
+    assert read_limited(FakeResponse(b'x' * 100), max_bytes=100) == b'x' * 100
+    assert asyncio.run(aread_limited(FakeResponse(b'x' * 100), max_bytes=100)) == b'x' * 100
+
+
+def test_limited_read_raises_past_the_limit():
+    with pytest.raises(ResponseTooLarge):
+        read_limited(FakeResponse(b'x' * 101), max_bytes=100)
+    with pytest.raises(ResponseTooLarge):
+        asyncio.run(aread_limited(FakeResponse(b'x' * 101), max_bytes=100))
+
+
+def test_too_large_response_discards_the_image_being_written(store):
+    doc = document(encoded(SECOND), encoded(FIRST))
+    # El límite cae dentro del valor de la segunda imagen.
+    chunks = iter_limited(FakeResponse(doc), max_bytes=doc.index(encoded(FIRST).encode()) + 20, chunk_size=16)
+    with pytest.raises(ResponseTooLarge):
+        extract_encoded_images(chunks, store.writer)
+    assert leftover_temp_files(store) == []
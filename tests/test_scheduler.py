@@ -0,0 +1,97 @@
+# tests/test_scheduler.py
+"""
+UpstreamScheduler con un reloj propio: orden de turnos entre sesiones,
+posición y espera estimada de quien espera, y reducción del límite a la
+mitad (con su periodo de espera) cuando el backend tarda o se satura.
+"""
+from scheduler import UpstreamScheduler
+
+
+def make_scheduler(clock, max_units=1, **kwargs):
+    # Tasa muy alta: sólo limita `max_units` salvo que la prueba diga otra cosa.
+    options = {'rate_per_minute': 60000, 'burst': 100, 'weights': {'IMAGEN_3_1': 1}, 'slow_seconds': 60}
+    return UpstreamScheduler(max_units=max_units, clock=clock, **{**options, **kwargs})
+
+
+def enqueue(scheduler, session, num_images=1):
+    return scheduler._enqueue(session, scheduler.cost('IMAGEN_3_1', num_images))
+
+
+def test_sessions_take_turns(clock):
+    scheduler = make_scheduler(clock)
+    tickets = {name: enqueue(scheduler, name[0]) for name in ('A1', 'A2', 'A3', 'B1', 'C1')}
+    order = []
+    while len(order) < len(tickets):
+        running = [name for name, ticket in tickets.items() if ticket.granted and name not in order]
+        assert len(running) == 1
+        order.append(running[0])
+        scheduler._complete(tickets[running[0]], 1.0, False)
+    assert order == ['A1', 'B1', 'C1', 'A2', 'A3']
+
+
+def test_waiting_position_follows_the_turn_order(clock):
+    scheduler = make_scheduler(clock)
+    tickets = {name: enqueue(scheduler, name[0]) for name in ('A1', 'A2', 'A3', 'B1', 'C1')}
+    assert tickets['A1'].granted
+    assert scheduler._poll(tickets['A1']) is None
+    positions = {name: scheduler._poll(tickets[name])[0] for name in ('A2', 'A3', 'B1', 'C1')}
+    assert positions == {'B1': 1, 'C1': 2, 'A2': 3, 'A3': 4}
+
+
+def test_eta_grows_with_the_units_ahead(clock):
+    scheduler = make_scheduler(clock)
+    running = enqueue(scheduler, 'A')
+    first, second = enqueue(scheduler, 'B'), enqueue(scheduler, 'C', num_images=4)
+    third = enqueue(scheduler, 'D')
+    etas = [scheduler._poll(ticket)[1] for ticket in (first, second, third)]
+    # Media duración de la llamada en curso (15 s estimados) y luego cada una entera.
+    assert etas == [round(0.5 * 15), round(1.5 * 15), round(5.5 * 15)]
+    assert running.granted
+
+
+def test_slow_call_halves_the_limit_once_per_cooldown(clock):
+    scheduler = make_scheduler(clock, max_units=8)
+    tickets = [enqueue(scheduler, 'A') for _ in range(3)]
+    assert all(ticket.granted for ticket in tickets)
+
+    scheduler._complete(tickets[0], 61.0, False)
+    assert scheduler.limit == 4
+    # Las que estaban en curso fallan a la vez por la misma causa: no reducen otra vez.
+    clock.advance(scheduler.backoff_cooldown - 1)
+    scheduler._complete(tickets[1], 1.0, True)
+    assert scheduler.limit == 4
+    clock.advance(2)
+    scheduler._complete(tickets[2], 1.0, True)
+    assert scheduler.limit == 2
+    assert scheduler.backoffs == 2
+
+
+def test_limit_recovers_after_successful_calls(clock):
+    scheduler = make_scheduler(clock, max_units=4)
+    scheduler._complete(enqueue(scheduler, 'A'), 1.0, True)
+    assert scheduler.limit == 2
+    scheduler._complete(enqueue(scheduler, 'A'), 1.0, False)
+    assert scheduler.limit == 2.5
+    for _ in range(10):
+        scheduler._complete(enqueue(scheduler, 'A'), 1.0, False)
+    assert scheduler.limit == 4
+
+
+def test_halved_limit_admits_fewer_calls(clock):
+    scheduler = make_scheduler(clock, max_units=2)
+    scheduler._complete(enqueue(scheduler, 'A'), 1.0, True)
+    first, second = enqueue(scheduler, 'A'), enqueue(scheduler, 'B')
+    assert first.granted and not second.granted
+    scheduler._complete(first, 1.0, False)
+    assert second.granted
+
+
+def test_rate_limit_waits_for_the_clock(clock):
+    scheduler = make_scheduler(clock, max_units=10, rate_per_minute=60, burst=1)
+    first, second = enqueue(scheduler, 'A'), enqueue(scheduler, 'B')
+    assert first.granted and not second.granted
+    clock.advance(0.5)
+    assert scheduler._poll(second) is not None
+    clock.advance(0.6)
+    assert scheduler._poll(second) is None
+    assert second.granted
@@ -0,0 +1,132 @@
+# tests/test_session_store.py
+"""
+LazySessionMixin sobre SQLiteSessionInterface: los endpoints sin sesión y
+las peticiones que no la cambian no leen ni escriben el almacén ni envían
+cookie; un cambio se guarda una sola vez, y un ID caducado o desconocido se
+sustituye por otro nuevo.
+"""
+import time
+
+import pytest
+from flask import Flask, jsonify, session
+
+from session_store import SQLiteSessionInterface
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    interface = SQLiteSessionInterface(app, path=str(tmp_path / 'sessions.sqlite3'), use_signer=True, permanent=False)
+    interface.sessionless_endpoints = {'ping'}
+    app.session_interface = interface
+
+    # E/S del almacén, como bench.serve_app.instrument_session_io.
+    app.io = {'reads': 0, 'writes': 0}
+    retrieve, upsert = interface._retrieve_session_data, interface._upsert_session
+
+    def counted_retrieve(store_id):
+        app.io['reads'] += 1
+        return retrieve(store_id)
+
+    def counted_upsert(session_lifetime, session, store_id):
+        app.io['writes'] += 1
+        return upsert(session_lifetime, session, store_id)
+
+    interface._retrieve_session_data, interface._upsert_session = counted_retrieve, counted_upsert
+
+    @app.route('/ping')
+    def ping():
+        return 'ok'
+
+    @app.route('/noop')
+    def noop():
+        return 'ok'
+
+    @app.route('/read')
+    def read():
+        return jsonify(value=session.get('value'))
+
+    @app.route('/set/<value>')
+    def set_value(value):
+        session['value'] = value
+        return jsonify(sid=session.sid)
+
+    @app.route('/sid')
+    def sid():
+        return jsonify(sid=session.sid, value=session.get('value'))
+
+    return app
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.get('/set/1')
+    app.io.update(reads=0, writes=0)
+    return client
+
+
+def io_after(app, client, path):
+    """E/S del almacén y cabeceras Set-Cookie de una petición."""
+    app.io.update(reads=0, writes=0)
+    response = client.get(path)
+    assert response.status_code == 200
+    return app.io['reads'], app.io['writes'], response.headers.getlist('Set-Cookie')
+
+
+def test_sessionless_endpoint_does_no_session_io(app, client):
+    assert io_after(app, client, '/ping') == (0, 0, [])
+
+
+def test_unknown_route_does_no_session_io(app, client):
+    app.io.update(reads=0, writes=0)
+    assert client.get('/missing').status_code == 404
+    assert app.io == {'reads': 0, 'writes': 0}
+
+
+def test_view_that_does_not_use_the_session_does_no_session_io(app, client):
+    assert io_after(app, client, '/noop') == (0, 0, [])
+
+
+def test_reading_the_session_does_not_save_it(app, client):
+    assert io_after(app, client, '/read') == (1, 0, [])
+    assert client.get('/read').json == {'value': '1'}
+
+
+def test_assigning_the_same_value_does_not_save_it(app, client):
+    assert io_after(app, client, '/set/1') == (1, 0, [])
+
+
+def test_a_change_is_saved_once(app, client):
+    reads, writes, cookies = io_after(app, client, '/set/2')
+    assert (reads, writes, len(cookies)) == (1, 1, 1)
+    assert client.get('/read').json == {'value': '2'}
+
+
+def test_new_visitor_without_changes_gets_no_cookie(app):
+    client = app.test_client()
+    assert io_after(app, client, '/read') == (0, 0, [])
+
+
+def test_expired_session_gets_a_new_id(app, client):
+    old_sid = client.get('/sid').json['sid']
+    app.session_interface._conn().execute("UPDATE sessions SET expiry = ?", (time.time() - 1,))
+    response = client.get('/sid').json
+    assert response == {'sid': response['sid'], 'value': None}
+    assert response['sid'] != old_sid
+
+
+def test_unknown_session_id_is_replaced(app):
+    client = app.test_client()
+    client.set_cookie('session', app.session_interface._sign(app, 'desconocido'))
+    new_sid = client.get('/set/3').json['sid']
+    assert new_sid != 'desconocido'
+    assert client.get('/sid').json == {'sid': new_sid, 'value': '3'}
+
+
+def test_badly_signed_cookie_starts_a_new_session(app):
+    client = app.test_client()
+    client.set_cookie('session', 'sin-firma')
+    assert io_after(app, client, '/read') == (0, 0, [])
+    assert client.get('/set/4').json['sid'] != 'sin-firma'
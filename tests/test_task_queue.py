@@ -0,0 +1,169 @@
+# tests/test_task_queue.py
+"""
+TaskQueue y su almacén SQLite: admisión acotada, turnos entre sesiones
+(FairQueue, FairExecutor) y tareas que sobreviven al reciclado de un worker
+(las pendientes con trabajo guardado se retoman; las que estaban en curso se
+marcan como perdidas).
+"""
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from task_queue import FairExecutor, FairQueue, LOST_TASK_RESULT, QueueFullError, SQLiteTaskStore, TaskQueue
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteTaskStore(path=str(tmp_path / 'tasks.sqlite3'))
+
+
+def dead_owner():
+    """Dueño con el PID de un proceso que ya terminó."""
+    child = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True, check=True)
+    return f"{socket.gethostname()}:{child.stdout.strip()}"
+
+
+def orphan(store, task_id):
+    store._conn().execute("UPDATE tasks SET owner = ? WHERE task_id = ?", (dead_owner(), task_id))
+
+
+def wait_for_status(store, task_id, statuses, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        task = store.get(task_id)
+        if task['status'] in statuses:
+            return task
+        time.sleep(0.02)
+    raise AssertionError(f"task {task_id} still {store.get(task_id)['status']}")
+
+
+def test_admission_is_bounded(store):
+    queue = TaskQueue(store, workers=0, max_pending=2)
+    queue._admit('a')
+    queue._admit('b')
+    with pytest.raises(QueueFullError) as error:
+        queue._admit('c')
+    assert error.value.queue_position == 3
+    assert store.get('c') is None
+
+
+def fill(fair_queue, names):
+    """Encola (nombre,) con la sesión en la primera letra del nombre."""
+    for name in names:
+        fair_queue.put_nowait((name,), key=name[0])
+
+
+def test_fair_queue_takes_sessions_in_turns():
+    fair_queue = FairQueue(maxsize=10)
+    fill(fair_queue, ['a1', 'a2', 'a3', 'b1', 'c1', 'c2'])
+    assert [fair_queue.get()[0] for _ in range(6)] == ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+
+
+def test_fair_queue_position_matches_the_order_of_get():
+    fair_queue = FairQueue(maxsize=10)
+    fill(fair_queue, ['a1', 'a2', 'a3', 'b1', 'c1', 'c2'])
+    positions = {name: fair_queue.position(name) for name in ('a1', 'a2', 'a3', 'b1', 'c1', 'c2')}
+    assert sorted(positions, key=positions.get) == ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+    assert sorted(positions.values()) == [1, 2, 3, 4, 5, 6]
+    fair_queue.get()
+    assert fair_queue.position('a1') == 0
+    assert fair_queue.position('b1') == 1
+
+
+def test_fair_queue_is_bounded():
+    fair_queue = FairQueue(maxsize=2)
+    fill(fair_queue, ['a1', 'b1'])
+    with pytest.raises(queue.Full):
+        fair_queue.put_nowait(('c1',), key='c')
+    assert fair_queue.qsize() == 2
+
+
+def test_fair_executor_takes_sessions_in_turns():
+    executor = FairExecutor(workers=1)
+    started, release, order = threading.Event(), threading.Event(), []
+    blocker = executor.submit('a', lambda: (started.set(), release.wait()))
+    assert started.wait(5)
+    futures = [executor.submit(name[0], order.append, name) for name in ('a1', 'a2', 'a3', 'b1')]
+    release.set()
+    for future in [blocker, *futures]:
+        future.result(timeout=5)
+    assert order == ['a1', 'b1', 'a2', 'a3']
+
+
+def test_fair_executor_passes_exceptions_to_the_future():
+    future = FairExecutor(workers=1).submit('a', int, 'no es un número')
+    with pytest.raises(ValueError):
+        future.result(timeout=5)
+
+
+def test_registered_job_is_stored_with_its_arguments(store):
+    queue = TaskQueue(store, workers=0)
+    queue.register_job('generate', lambda task_id, prompt, n: None)
+    queue._admit('t1', queue.jobs['generate'], ('un gato', 2), 'session-1')
+    row = store._conn().execute("SELECT job FROM tasks WHERE task_id = 't1'").fetchone()
+    assert row[0] is not None
+    assert store.claim_orphaned() == []  # su dueño sigue vivo
+
+
+def test_orphaned_pending_task_is_recovered_by_another_worker(store):
+    ran = threading.Event()
+    calls = []
+
+    def job(task_id, prompt, n):
+        calls.append((task_id, prompt, n))
+        ran.set()
+        return {'status': 'success', 'images': []}
+
+    old_worker = TaskQueue(store, workers=0)
+    old_worker.register_job('generate', job)
+    old_worker._admit('t1', job, ('un gato', 2), 'session-1')
+    orphan(store, 't1')
+
+    new_worker = TaskQueue(store, workers=1)
+    new_worker.register_job('generate', job)
+    new_worker.ensure_started()
+    assert ran.wait(5)
+    task = wait_for_status(store, 't1', ('SUCCESS',))
+    assert calls == [('t1', 'un gato', 2)]
+    assert task['result'] == {'status': 'success', 'images': []}
+    assert store.claim_orphaned() == []
+
+
+def test_orphans_that_cannot_be_resumed_are_marked_lost(store):
+    store.create_if_room('running', {'status': 'PENDING'}, 10, job={'name': 'generate', 'args': [], 'fair_key': None})
+    store.update('running', status='RUNNING')
+    store.create_if_room('no-job', {'status': 'PENDING'}, 10)
+    orphan(store, 'running')
+    orphan(store, 'no-job')
+
+    assert store.claim_orphaned() == []
+    store.purge_expired()
+    for task_id in ('running', 'no-job'):
+        task = store.get(task_id)
+        assert task['status'] == 'FAILURE'
+        assert task['result'] == LOST_TASK_RESULT
+
+
+def test_unknown_job_name_is_marked_lost(store):
+    store.create_if_room('t1', {'status': 'PENDING'}, 10, job={'name': 'gone', 'args': [], 'fair_key': None})
+    orphan(store, 't1')
+    TaskQueue(store, workers=0)._recover_orphaned()
+    assert store.get('t1')['status'] == 'FAILURE'
+
+
+def test_each_orphan_is_claimed_once(store):
+    for i in range(5):
+        store.create_if_room(f"t{i}", {'status': 'PENDING'}, 10, job={'name': 'generate', 'args': [i], 'fair_key': None})
+        orphan(store, f"t{i}")
+    claims = []
+    threads = [threading.Thread(target=lambda: claims.extend(store.claim_orphaned())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(task_id for task_id, _ in claims) == [f"t{i}" for i in range(5)]
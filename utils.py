@@ -1,119 +1,105 @@
 # utils.py
 import base64
+import contextvars
+import hashlib
 import io
 import json
 import os
 import random
-from datetime import datetime
-from functools import lru_cache
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 import requests
 import logging
-from langdetect import detect, DetectorFactory
 
 logging.getLogger("streamlit").setLevel(logging.ERROR)
 
 from config import (
-    GENERATE_URL_OBFUSCATED, UPLOAD_URL_OBFUSCATED, BASE_HEADERS,
-    MODEL_DISPLAY_NAMES, GOOGLE_SESSION_TOKEN, GEMINI_API_KEY
+    BASE_HEADERS, MODEL_DISPLAY_NAMES, GOOGLE_SESSION_TOKEN,
+    UPLOAD_CONCURRENCY, MEDIA_CACHE_MAX, MEDIA_CACHE_TTL, MAX_RESPONSE_BYTES,
+    TRANSLATION_CACHE_MAX, TRANSLATION_CACHE_TTL
 )
+from blob_store import generated_images
+from cache import create_cache
+from http_client import upstream, generate_url, upload_url
+from image_processing import image_pool
+from language import is_english
+from metrics import stage_timer
+from prompt_service import prompt_service, PromptServiceUnavailable
+from response_parser import ResponseTooLarge, extract_encoded_images, iter_limited, panel_images, read_limited
 
-import google.generativeai as genai
-
-# --- DETECCIÓN DE IDIOMA CON langdetect ---
-DetectorFactory.seed = 0
+# --- CACHE DE TRADUCCIONES ---
+# Compartida entre workers y reinicios (ver cache.py). Sólo se guardan las
+# respuestas reales de Gemini, nunca el prompt original usado como respaldo.
+translation_cache = create_cache('translations', TRANSLATION_CACHE_MAX, TRANSLATION_CACHE_TTL)
 
-def is_english(prompt: str) -> bool:
-    if not prompt or len(prompt.strip()) < 5:
-        return False
-    try:
-        lang = detect(prompt.strip())
-        return lang == 'en'
-    except:
-        logging.warning(f"Language detection failed for prompt: '{prompt[:50]}...'. Assuming non-English.")
-        return False
+def _prompt_cache_key(kind: str, prompt: str) -> str:
+    normalized = ' '.join(prompt.split()).casefold()
+    return f"{kind}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
 
-# --- CACHE DE TRADUCCIONES ---
-@lru_cache(maxsize=512)
 def _gemini_translate(prompt: str) -> str:
+    key = _prompt_cache_key('translate', prompt)
+    cached = translation_cache.get(key)
+    if cached:
+        return cached
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(
-            f"Translate this image generation prompt to English. Keep exact meaning, style, and details. Respond ONLY with the translation:\n\n{prompt}"
-        )
-        translated = response.text.strip()
-        return translated if translated else prompt
-    except Exception as e:
-        logging.error(f"Gemini translation failed: {e}")
+        translated = prompt_service.translate(prompt)
+    except PromptServiceUnavailable as e:
+        logging.error("Gemini translation failed: %s", e)
+        return prompt
+    if not translated:
         return prompt
+    translation_cache.set(key, translated)
+    return translated
 
 def translate_to_english(prompt: str) -> str:
     if is_english(prompt):
-        logging.info(f"Prompt detected as English. Skipping translation.")
+        logging.debug("Prompt detected as English. Skipping translation.")
+        return prompt.strip()
+    if not prompt_service.enabled:
+        logging.warning("GEMINI_API_KEY not set. Using original prompt.")
         return prompt.strip()
     return _gemini_translate(prompt.strip())
 
 # --- MEJORA + TRADUCCIÓN EN UNA SOLA LLAMADA ---
 def improve_and_translate_to_english(original_prompt: str) -> str:
-    if not GEMINI_API_KEY:
+    if not prompt_service.enabled:
         logging.warning("GEMINI_API_KEY not set. Using original prompt.")
         return original_prompt
 
-    if is_english(original_prompt):
-        improve_prompt = original_prompt
-    else:
-        try:
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            response = model.generate_content(
-                f"Improve this image prompt: add vivid, subtle details, optimize for high-quality AI generation. "
-                f"Keep original idea exactly. Then translate to English. "
-                f"Respond ONLY with the final English prompt. NO explanations.\n\nPrompt: {original_prompt}"
-            )
-            improve_prompt = response.text.strip()
-            logging.info(f"Improved & translated: '{original_prompt[:50]}...' → '{improve_prompt[:50]}...'")
-            return improve_prompt if improve_prompt else original_prompt
-        except Exception as e:
-            logging.error(f"Gemini improve+translate failed: {e}")
-            return original_prompt
-
+    key = _prompt_cache_key('improve', original_prompt)
+    cached = translation_cache.get(key)
+    if cached:
+        return cached
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(
-            f"Improve this English image prompt: add vivid, subtle details, optimize for high-quality AI generation. "
-            f"Keep original idea exactly. Respond ONLY with the improved English prompt.\n\nPrompt: {improve_prompt}"
-        )
-        final = response.text.strip()
-        return final if final else improve_prompt
-    except Exception as e:
-        logging.error(f"Gemini improve (EN) failed: {e}")
-        return improve_prompt
+        improved = prompt_service.improve(original_prompt)
+        logging.info("Improved & translated: '%.50s...' → '%.50s...'", original_prompt, improved)
+    except PromptServiceUnavailable as e:
+        logging.error("Gemini improve+translate failed: %s", e)
+        return original_prompt
+    if not improved:
+        return original_prompt
+    translation_cache.set(key, improved)
+    return improved
 
 # --- PROMPT MÁGICO EN INGLÉS DIRECTO ---
 def generate_magic_prompt_in_english() -> str:
-    if not GEMINI_API_KEY:
+    if not prompt_service.enabled:
         logging.warning("GEMINI_API_KEY not set. Using fallback magic prompt.")
         return "A surreal floating island with glowing waterfalls, ancient ruins, and a golden sky at sunset, ultra-detailed, cinematic lighting"
 
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(
-            "Generate ONE short (20-40 words) random image prompt in ENGLISH. Photorealistic or artistic style, vivid scenes. "
-            "Examples: 'A cat floating in space wearing an astronaut suit, Earth in background' or "
-            "'Hyperrealistic portrait of a woman with elaborate earrings, front lighting, full body'. "
-            "Include sensory and narrative details. Respond ONLY with the prompt."
-        )
-        magic_en = response.text.strip()
-        logging.info(f"Magic prompt generated (EN): '{magic_en[:100]}...'")
+        magic_en = prompt_service.magic()
+        logging.info("Magic prompt generated (EN): '%.100s...'", magic_en)
         return magic_en if magic_en else "A majestic dragon soaring over a crystal lake at dawn, mist rising, ultra-realistic"
-    except Exception as e:
-        logging.error(f"Gemini magic prompt failed: {e}")
+    except PromptServiceUnavailable as e:
+        logging.error("Gemini magic prompt failed: %s", e)
         return "A cyberpunk city at night with neon lights reflecting on wet streets, flying cars, ultra-detailed"
 
 # --- RESTO SIN CAMBIOS ---
+media_id_cache = create_cache('media_ids', MEDIA_CACHE_MAX, MEDIA_CACHE_TTL)
+
 def decode_token(token_b64):
     if not token_b64 or not token_b64.strip(): raise ValueError("El token está vacío.")
     decoded_str = base64.b64decode(token_b64.strip()).decode('utf-8')
@@ -121,76 +107,235 @@ def decode_token(token_b64):
     if len(parts) != 2: raise ValueError("Formato de token inválido.")
     return parts[0].strip(), parts[1].strip()
 
-def upload_image(bearer_token, x_client_data, pil_image, mime_type=None):
-    if pil_image is None: return ('error', 'no_image_provided')
-    try: real_upload_url = base64.b64decode(UPLOAD_URL_OBFUSCATED).decode('utf-8')
-    except: return ('error', 'internal_config_error')
-    
+def prepare_upload_image(pil_image) -> bytes:
+    """Normaliza una referencia tal y como la espera el backend: RGB, máx. 2048 px, JPEG q85."""
     if pil_image.mode != 'RGB': pil_image = pil_image.convert('RGB')
     
     pil_image.thumbnail((2048, 2048), Image.Resampling.LANCZOS)
     buffered = io.BytesIO()
     pil_image.save(buffered, format="JPEG", quality=85, optimize=True)
-    if len(buffered.getvalue()) > 10 * 1024 * 1024: return ('error', 'image_too_large')
-    image_b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    return buffered.getvalue()
+
+def normalize_reference_image(source) -> bytes:
+    """
+    Deja una imagen (bytes, ruta o fichero abierto) lista para subir al
+    backend. El trabajo se hace en el pool de procesos de image_processing.
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            source = f.read()
+    elif not isinstance(source, (bytes, bytearray)):
+        source = source.read()
+    return image_pool.normalize(bytes(source))
+
+def upload_image(bearer_token, x_client_data, pil_image, mime_type=None):
+    if pil_image is None: return ('error', 'no_image_provided')
+    return upload_image_bytes(bearer_token, x_client_data, prepare_upload_image(pil_image))
+
+ERROR_MAP_UPLOAD = {
+    "PUBLIC_ERROR_MINOR_UPLOAD": "minor_upload_error",
+    "PUBLIC_ERROR_PROMINENT_PEOPLE_UPLOAD": "prominent_people_error",
+    "PUBLIC_ERROR_CHILD_EXPLOITATION_UPLOAD": "child_exploitation_error",
+    "PUBLIC_ERROR_HARMFUL_CONTENT_UPLOAD": "harmful_content_error",
+}
+
+def build_upload_request(bearer_token, x_client_data, jpeg_bytes):
+    """Devuelve ('success', (url, headers, payload)) o ('error', clave)."""
+    try: real_upload_url = upload_url()
+    except: return ('error', 'internal_config_error')
+    
+    if len(jpeg_bytes) > 10 * 1024 * 1024: return ('error', 'image_too_large')
+    image_b64 = base64.b64encode(jpeg_bytes).decode('utf-8')
     
     headers = {**BASE_HEADERS, "Authorization": f"Bearer {bearer_token}", "X-Client-Data": x_client_data, "X-Browser-Year": "2025"}
     payload = {"imageInput": {"rawImageBytes": image_b64, "mimeType": "image/jpeg", "isUserUploaded": True}, "clientContext": {"tool": "ASSET_MANAGER"}}
+    return ('success', (real_upload_url, headers, payload))
+
+def parse_upload_response(status_code, body: bytes):
+    if status_code == 200:
+        return ('success', json.loads(body)["mediaGenerationId"]["mediaGenerationId"])
+    try:
+        resp_json = json.loads(body)
+    except json.JSONDecodeError:
+        logging.error("Upload response not JSON: %r", body[:200])
+        return ('error', 'generic_upload_error')
+    reason = resp_json.get("error", {}).get("details", [{}])[0].get("reason", "UNKNOWN_ERROR")
+    return ('error', ERROR_MAP_UPLOAD.get(reason, 'generic_upload_error'))
+
+def upload_image_bytes(bearer_token, x_client_data, jpeg_bytes):
+    status, request = build_upload_request(bearer_token, x_client_data, jpeg_bytes)
+    if status == 'error':
+        return (status, request)
+    real_upload_url, headers, payload = request
     
     try:
-        response = requests.post(real_upload_url, headers=headers, json=payload, timeout=60)
-        response.encoding = 'utf-8'
-        if response.status_code == 200: 
-            return ('success', response.json()["mediaGenerationId"]["mediaGenerationId"])
-        else:
-            try:
-                resp_json = response.json()
-            except json.JSONDecodeError:
-                logging.error(f"Upload response not JSON: {response.text[:200]}")
-                return ('error', 'generic_upload_error')
-            reason = resp_json.get("error", {}).get("details", [{}])[0].get("reason", "UNKNOWN_ERROR")
-            error_map = {
-                "PUBLIC_ERROR_MINOR_UPLOAD": "minor_upload_error",
-                "PUBLIC_ERROR_PROMINENT_PEOPLE_UPLOAD": "prominent_people_error",
-                "PUBLIC_ERROR_CHILD_EXPLOITATION_UPLOAD": "child_exploitation_error",
-                "PUBLIC_ERROR_HARMFUL_CONTENT_UPLOAD": "harmful_content_error",
-            }
-            return ('error', error_map.get(reason, 'generic_upload_error'))
+        response = upstream.post('upload', real_upload_url, read_timeout=60, headers=headers, json=payload)
+        return parse_upload_response(response.status_code, response.content)
     except requests.exceptions.Timeout:
         return ('error', 'connection_error: upload_timeout')
     except Exception as e:
-        logging.error(f"Upload exception: {e}")
+        logging.error("Upload exception: %s", e)
         return ('error', f'connection_error: {str(e)}')
 
+def prepare_reference_upload(ref_image, use_cache=True):
+    """
+    Decodifica una referencia (data URL o bytes ya normalizados), la normaliza
+    si hace falta y busca su mediaGenerationId en caché por el hash original y
+    el normalizado. Devuelve (media_id o None, jpeg_bytes, claves de caché).
+    """
+    if isinstance(ref_image, (bytes, bytearray)):
+        data = bytes(ref_image)
+    else:
+        header, encoded = ref_image.split(",", 1)
+        data = base64.b64decode(encoded)
+    raw_key = hashlib.sha256(data).hexdigest()
+    if use_cache:
+        media_id = media_id_cache.get(raw_key)
+        if media_id:
+            return media_id, None, [raw_key]
+    if isinstance(ref_image, (bytes, bytearray)):
+        jpeg_bytes = data
+    else:
+        with stage_timer('preprocess'):
+            jpeg_bytes = normalize_reference_image(data)
+    if jpeg_bytes is data:
+        return None, jpeg_bytes, [raw_key]
+    normalized_key = hashlib.sha256(jpeg_bytes).hexdigest()
+    if use_cache and normalized_key != raw_key:
+        media_id = media_id_cache.get(normalized_key)
+        if media_id:
+            media_id_cache.set(raw_key, media_id)
+            return media_id, None, [raw_key, normalized_key]
+    return None, jpeg_bytes, list(dict.fromkeys([normalized_key, raw_key]))
+
+def remember_media_id(keys, media_id):
+    for key in keys:
+        media_id_cache.set(key, media_id)
+
+def upload_reference_images(bearer_token, x_client_data, ref_images, max_concurrency=UPLOAD_CONCURRENCY, use_cache=True):
+    """
+    Decodifica y sube las imágenes de referencia en paralelo (como mucho
+    `max_concurrency` a la vez). Devuelve ('success', media_ids) respetando el
+    orden original, o ('error', clave) con el primer error que llegue. Tras un
+    error no se empiezan más subidas; las que ya están en vuelo terminan en
+    segundo plano y su resultado se descarta.
+
+    Cada referencia puede ser un data URL o los bytes JPEG ya normalizados
+    que guarda el almacén de referencias (éstos no se vuelven a procesar).
+
+    Los mediaGenerationId se cachean por hash de la imagen (la original y la
+    normalizada), así que repetir la misma referencia no vuelve a procesarla
+    ni a subirla. Con use_cache=False se fuerza una subida nueva.
+    """
+    cancelled = threading.Event()
+
+    def _upload_one(i, ref_image):
+        if cancelled.is_set():
+            return ('cancelled', None)
+        try:
+            media_id, jpeg_bytes, keys = prepare_reference_upload(ref_image, use_cache)
+        except Exception as e:
+            logging.error("Error decoding ref image %d: %s", i, e)
+            cancelled.set()
+            return ('error', 'generic_upload_error')
+        if media_id:
+            return ('success', media_id)
+        if cancelled.is_set():
+            return ('cancelled', None)
+        with stage_timer('upload'):
+            status, msg = upload_image_bytes(bearer_token, x_client_data, jpeg_bytes)
+        if status == 'error':
+            cancelled.set()
+            logging.info("Upload of reference image %d failed: %s", i, msg)
+        else:
+            remember_media_id(keys, msg)
+        return (status, msg)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(ref_images))), thread_name_prefix="ref-upload")
+    try:
+        # Cada subida hereda el contexto de la tarea para que sus tiempos cuenten en ella.
+        futures = [executor.submit(contextvars.copy_context().run, _upload_one, i, url) for i, url in enumerate(ref_images)]
+        for future in as_completed(futures):
+            status, msg = future.result()
+            if status == 'error':
+                for pending in futures:
+                    pending.cancel()
+                return ('error', msg)
+        return ('success', [future.result()[1] for future in futures])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _read_error_body(response):
+    """Cuerpo de una respuesta de error, que es pequeño; en las 200 se deja para leerlo en streaming."""
+    if response.status_code == 200:
+        return None
+    try:
+        return read_limited(response, MAX_RESPONSE_BYTES)
+    finally:
+        response.close()
+
+def _is_media_not_found(status_code, error_body, payload):
+    """
+    ¿La generación falló porque el backend ya no tiene alguna de las
+    referencias del payload? Tiene que ser un error de la API (JSON con status
+    NOT_FOUND) que hable de medios o cite uno de sus mediaId: un 404 por una
+    URL mal configurada no debe provocar otra subida y otra generación.
+    """
+    if status_code == 200 or not error_body:
+        return False
+    try:
+        error = json.loads(error_body).get("error")
+    except (ValueError, AttributeError):
+        return False
+    if not isinstance(error, dict) or (error.get("status") != "NOT_FOUND" and error.get("code") != 404):
+        return False
+    references = payload.get("userInput", {}).get("referenceImageInput", {}).get("referenceImages", [])
+    media_ids = [ref.get("mediaId") for ref in references if ref.get("mediaId")]
+    detail = json.dumps(error)
+    return 'media' in detail.lower() or any(media_id in detail for media_id in media_ids)
+
 def create_blank_image(aspect_ratio_str):
     sizes = {"16:9": (1024, 576), "9:16": (576, 1024), "1:1": (512, 512), "4:3": (768, 576), "3:4": (576, 768)}
     return Image.new('RGB', sizes.get(aspect_ratio_str, (512, 512)), color='white')
 
-def main_generator_function(prompt, num_images, seed, aspect_ratio_str, model_type, ref_images, save_images_flag=False):
-    import time
-    logging.info(f"\n--- DEBUG: API Request ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---")
-    logging.info(f"  Model Type (Internal): {model_type}")
+# --- PARTES COMUNES DE LA GENERACIÓN (SÍNCRONA Y ASÍNCRONA, ver async_generation.py) ---
+ASPECT_MAP = {"16:9": "IMAGE_ASPECT_RATIO_LANDSCAPE", "9:16": "IMAGE_ASPECT_RATIO_PORTRAIT", "1:1": "IMAGE_ASPECT_RATIO_SQUARE", "4:3": "IMAGE_ASPECT_RATIO_LANDSCAPE_FOUR_THREE", "3:4": "IMAGE_ASPECT_RATIO_PORTRAIT_THREE_FOUR"}
+
+ERROR_MAP_GENERATION = {
+    "PUBLIC_ERROR_UNSAFE_GENERATION": "unsafe_generation_error",
+    "PUBLIC_ERROR_MINORS": "minors_error",
+    "PUBLIC_ERROR_SEXUAL": "sexual_error",
+    "PUBLIC_ERROR_VIOLENCE": "violence_error",
+    "PUBLIC_ERROR_CRIMINAL": "criminal_error",
+}
+
+def build_generation_request(prompt, num_images, seed, aspect_ratio_str, model_type, ref_images):
+    """
+    Token, cabeceras y payload de runImageFx. Devuelve ('success', petición)
+    con las claves bearer_token, x_client_data, headers, payload y ref_images
+    (con el lienzo en blanco si el modelo lo necesita), o ('error', resultado).
+    `prompt` puede ser una lista: se piden `num_images` imágenes de cada uno
+    en la misma llamada (un panel por prompt en la respuesta).
+    """
+    prompts = [p.strip() for p in prompt] if isinstance(prompt, (list, tuple)) else [prompt.strip()]
     try:
         bearer_token, x_client_data = decode_token(GOOGLE_SESSION_TOKEN)
     except ValueError as e: 
-        logging.error(f"Token decode error: {e}")
-        return {'status': 'error', 'message': f'auth_error: {str(e)}'}
+        logging.error("Token decode error: %s", e)
+        return ('error', {'status': 'error', 'message': f'auth_error: {str(e)}'})
     
-    aspect_map = {"16:9": "IMAGE_ASPECT_RATIO_LANDSCAPE", "9:16": "IMAGE_ASPECT_RATIO_PORTRAIT", "1:1": "IMAGE_ASPECT_RATIO_SQUARE", "4:3": "IMAGE_ASPECT_RATIO_LANDSCAPE_FOUR_THREE", "3:4": "IMAGE_ASPECT_RATIO_PORTRAIT_THREE_FOUR"}
-    api_aspect_ratio = aspect_map.get(aspect_ratio_str, "IMAGE_ASPECT_RATIO_SQUARE")
+    api_aspect_ratio = ASPECT_MAP.get(aspect_ratio_str, "IMAGE_ASPECT_RATIO_SQUARE")
     
     tool, project_id = ("VIDEO_FX", "3bbf5eba-be3f-4022-b9a0-158b93131757") \
                        if model_type in ["IMAGEN_3_1", "IMAGEN_3_5"] and not ref_images \
                        else ("PINHOLE", "cc8e7fa2-9e2b-4742-ad19-41d3732460db")
     
-    logging.info(f"  Tool: {tool}, Project ID: {project_id}")
-    logging.info(f"  Aspect Ratio: {api_aspect_ratio}")
-    logging.info(f"  Prompt: '{prompt.strip()}'")
-    logging.info(f"  Num Images: {num_images}, Seed: {seed}")
-    logging.info(f"  Reference Images provided (count in data URLs): {len(ref_images)}")
+    # Una sola línea DEBUG (con INFO no se llega a construir): prompts completos incluidos.
+    logging.debug("API request: model=%s tool=%s project=%s aspect=%s num_images=%s seed=%s references=%d prompts=%r",
+                  model_type, tool, project_id, api_aspect_ratio, num_images, seed, len(ref_images), prompts)
     
     if model_type in ["R2I", "GEM_PIX"] and not ref_images:
-        logging.info(f"{model_type} selected without reference images. Creating blank image.")
+        logging.debug("%s selected without reference images. Creating blank image.", model_type)
         blank_pil = create_blank_image(aspect_ratio_str)
         buffered = io.BytesIO()
         blank_pil.save(buffered, format="PNG")
@@ -199,109 +344,157 @@ def main_generator_function(prompt, num_images, seed, aspect_ratio_str, model_ty
     
     headers = {**BASE_HEADERS, "Authorization": f"Bearer {bearer_token}", "X-Client-Data": x_client_data, "X-Browser-Year": "2025"}
     
-    payload = {"clientContext": {"tool": tool, "projectId": project_id}, "userInput": {"candidatesCount": int(num_images), "prompts": [prompt.strip()]}, "aspectRatio": api_aspect_ratio, "modelInput": {"modelNameType": model_type}}
+    payload = {"clientContext": {"tool": tool, "projectId": project_id}, "userInput": {"candidatesCount": int(num_images), "prompts": prompts}, "aspectRatio": api_aspect_ratio, "modelInput": {"modelNameType": model_type}}
     payload["userInput"]["seed"] = random.randint(0, 99999) if int(seed) == -1 else int(seed)
+    return ('success', {'bearer_token': bearer_token, 'x_client_data': x_client_data,
+                        'headers': headers, 'payload': payload, 'ref_images': ref_images})
+
+def set_reference_media(payload, media_ids):
+    payload["userInput"]["referenceImageInput"] = {"referenceImages": [{"mediaId": mid, "imageType": "REFERENCE_IMAGE_TYPE_CONTEXT"} for mid in media_ids]}
+
+def collect_generated_images(skeleton, stored_ids):
+    """Resultado de una respuesta 200 ya extraída con extract_encoded_images."""
+    try:
+        response_json = json.loads(skeleton)
+    except json.JSONDecodeError:
+        logging.error("API returned 200 OK, but response body is not valid JSON. Body without images: %r", skeleton[:500])
+        return {'status': 'error', 'message': 'generic_api_error: invalid_json'}
+    panels = panel_images(response_json, stored_ids)
+    generated_images_data = panels[0] if panels else []
+    
+    if not generated_images_data:
+        logging.info("API returned 200 OK, but no 'generatedImages' found in JSON response.")
+        return {'status': 'error', 'message': 'no_images_returned'}
+    
+    output_image_ids = []
+
+    for i, image_id in enumerate(generated_images_data):
+        if image_id is None:
+            logging.debug("Image %d in response had no decodable 'encodedImage'.", i)
+            continue
+        output_image_ids.append(image_id)
+
+    if not output_image_ids:
+        return {'status': 'error', 'message': 'no_images_returned'}
+
+    logging.debug("Stored %d images.", len(output_image_ids))
+    return {'status': 'success', 'images': output_image_ids}
+
+def collect_generated_panels(skeleton, stored_ids, num_prompts):
+    """
+    Como collect_generated_images para una llamada con varios prompts: en
+    'panels' hay una lista de IDs por prompt, en su orden (vacía si ese prompt
+    no devolvió imágenes) y en 'images' todas juntas.
+    """
+    try:
+        response_json = json.loads(skeleton)
+    except json.JSONDecodeError:
+        logging.error("API returned 200 OK, but response body is not valid JSON. Body without images: %r", skeleton[:500])
+        return {'status': 'error', 'message': 'generic_api_error: invalid_json'}
+    panels = [[image_id for image_id in panel if image_id is not None] for panel in panel_images(response_json, stored_ids)]
+    panels = (panels + [[] for _ in range(num_prompts)])[:num_prompts]
+    images = [image_id for panel in panels for image_id in panel]
+    if not images:
+        return {'status': 'error', 'message': 'no_images_returned'}
+    logging.debug("Stored %d images across %d prompts.", len(images), num_prompts)
+    return {'status': 'success', 'images': images, 'panels': panels}
+
+def collect_generation_result(prompt, skeleton, stored_ids):
+    if isinstance(prompt, (list, tuple)):
+        return collect_generated_panels(skeleton, stored_ids, len(prompt))
+    return collect_generated_images(skeleton, stored_ids)
+
+def parse_generation_error(error_body):
+    """Resultado de una respuesta distinta de 200, a partir de su cuerpo."""
+    try:
+        resp_json = json.loads(error_body)
+        reason = resp_json.get("error", {}).get("details", [{}])[0].get("reason", "UNKNOWN_ERROR")
+        final_error_message = ERROR_MAP_GENERATION.get(reason, 'generic_api_error')
+        logging.info("API error reason: %s, mapped: %s", reason, final_error_message, extra={'event': 'upstream_error'})
+        return {'status': 'error', 'message': final_error_message}
+    except json.JSONDecodeError:
+        logging.error("Could not decode API error response as JSON. Raw body: %r", error_body[:500])
+        return {'status': 'error', 'message': 'generic_api_error: non_json_error_response'}
+    except Exception as e:
+        logging.error("Error processing non-200 API response: %s", e)
+        return {'status': 'error', 'message': f'generic_api_error: {str(e)}'}
+
+def main_generator_function(prompt, num_images, seed, aspect_ratio_str, model_type, ref_images, save_images_flag=False, on_stage=None):
+    """
+    `on_stage(etapa)` se llama al pasar a 'uploading' y a 'generating'. Con
+    una lista de prompts el resultado trae además 'panels' (ver collect_generated_panels).
+    """
+    on_stage = on_stage or (lambda stage: None)
+    status, request = build_generation_request(prompt, num_images, seed, aspect_ratio_str, model_type, ref_images)
+    if status == 'error':
+        return request
+    bearer_token, x_client_data = request['bearer_token'], request['x_client_data']
+    headers, payload, ref_images = request['headers'], request['payload'], request['ref_images']
 
     if ref_images:
-        media_ids = []
-        for i, pil_img_data_url in enumerate(ref_images):
-            try:
-                header, encoded = pil_img_data_url.split(",", 1)
-                data = base64.b64decode(encoded)
-                pil_img = Image.open(io.BytesIO(data))
-            except Exception as e:
-                logging.error(f"Error decoding ref image {i}: {e}")
-                return {'status': 'error', 'message': 'generic_upload_error'}
-            
-            status, msg = upload_image(bearer_token, x_client_data, pil_img)
-            if status == 'error': 
-                logging.info(f"  DEBUG: Upload image {i} error: {msg}")
-                return {'status': 'error', 'message': msg} 
-            media_ids.append(msg)
+        on_stage('uploading')
+        status, result = upload_reference_images(bearer_token, x_client_data, ref_images)
+        if status == 'error':
+            return {'status': 'error', 'message': result}
+        media_ids = result
         if not media_ids: 
-            logging.info("  DEBUG: No media IDs after upload process for reference images.")
+            logging.info("No media IDs after upload process for reference images.")
             return {'status': 'error', 'message': 'upload_failed: no_media_ids'} 
-        payload["userInput"]["referenceImageInput"] = {"referenceImages": [{"mediaId": mid, "imageType": "REFERENCE_IMAGE_TYPE_CONTEXT"} for mid in media_ids]}
-        logging.info(f"  DEBUG: Payload includes {len(media_ids)} reference image(s).")
+        set_reference_media(payload, media_ids)
+        logging.debug("Payload includes %d reference image(s).", len(media_ids))
 
+    on_stage('generating')
+    response = None
     try:
-        real_generate_url = base64.b64decode(GENERATE_URL_OBFUSCATED).decode('utf-8')
-        logging.info(f"  DEBUG: Sending request to: {real_generate_url} with payload: {payload}")
+        real_generate_url = generate_url()
+        # El payload puede ser grande: sólo se formatea si el nivel DEBUG está activo.
+        logging.debug("Sending request to: %s with payload: %s", real_generate_url, payload)
         start_time = time.time()
-        response = requests.post(real_generate_url, headers=headers, json=payload, timeout=180)
+        with stage_timer('upstream'):
+            response = upstream.post('generate', real_generate_url, read_timeout=180, idempotent=False, headers=headers, json=payload, stream=True)
+        error_body = _read_error_body(response)
+        if ref_images and _is_media_not_found(response.status_code, error_body, payload):
+            # Algún mediaGenerationId cacheado ya no existe en el backend: se suben de nuevo.
+            logging.info("Upstream did not find the reference media IDs. Re-uploading without cache.")
+            status, result = upload_reference_images(bearer_token, x_client_data, ref_images, use_cache=False)
+            if status == 'error':
+                return {'status': 'error', 'message': result}
+            set_reference_media(payload, result)
+            with stage_timer('upstream'):
+                response = upstream.post('generate', real_generate_url, read_timeout=180, idempotent=False, headers=headers, json=payload, stream=True)
+            error_body = _read_error_body(response)
         end_time = time.time()
-        response.encoding = 'utf-8'
-        logging.info(f"  DEBUG: API request completed in {end_time - start_time:.2f} seconds, Status: {response.status_code}, Response (first 500 chars): {response.text[:500]}...")
-        
-        logging.info(f"--- DEBUG: API Response ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---")
-        logging.info(f"  Status Code: {response.status_code}")
-
-        if response.status_code == 200:
-            try:
-                response_json = response.json()
-                generated_images_data = response_json.get("imagePanels", [{}])[0].get("generatedImages", [])
-                
-                if not generated_images_data:
-                    logging.info(f"  DEBUG: API returned 200 OK, but no 'generatedImages' found in JSON response.")
-                    return {'status': 'error', 'message': 'no_images_returned'}
-                
-                output_images_b64 = []
-
-                for i, img_data in enumerate(generated_images_data):
-                    if "encodedImage" in img_data:
-                        try:
-                            img_bytes = base64.b64decode(img_data["encodedImage"])
-                            pil_image = Image.open(io.BytesIO(img_bytes))
-                            img_b64 = base64.b64encode(img_bytes).decode('utf-8')
-                            output_images_b64.append(f"data:image/png;base64,{img_b64}")
-                        except Exception as e:
-                            logging.error(f"  DEBUG: Error processing image {i}: {e}")
-                            continue
-                    else:
-                        logging.info(f"  DEBUG: Image {i} in response did not contain 'encodedImage'.")
-
-                if not output_images_b64:
-                    return {'status': 'error', 'message': 'no_images_returned'}
-
-                logging.info(f"  DEBUG: Successfully processed {len(output_images_b64)} images.")
-                return {'status': 'success', 'images': output_images_b64}
-
-            except json.JSONDecodeError as e:
-                logging.error(f"  DEBUG: API returned 200 OK, but response body is not valid JSON. Raw text: {response.text[:500]}")
-                return {'status': 'error', 'message': 'generic_api_error: invalid_json'}
-            except Exception as e:
-                logging.error(f"  DEBUG: Error processing 200 OK API response: {e}")
-                return {'status': 'error', 'message': f'generic_api_error: {str(e)}'}
+        logging.info("API responded in %.2f seconds, status: %s", end_time - start_time, response.status_code,
+                     extra={'event': 'upstream'})
 
-        else:
-            logging.info(f"  DEBUG: API returned non-200 status. Trying to extract error details...")
-            try:
-                resp_json = response.json()
-                reason = resp_json.get("error", {}).get("details", [{}])[0].get("reason", "UNKNOWN_ERROR")
-                error_map_generation = {
-                    "PUBLIC_ERROR_UNSAFE_GENERATION": "unsafe_generation_error",
-                    "PUBLIC_ERROR_MINORS": "minors_error",
-                    "PUBLIC_ERROR_SEXUAL": "sexual_error",
-                    "PUBLIC_ERROR_VIOLENCE": "violence_error",
-                    "PUBLIC_ERROR_CRIMINAL": "criminal_error",
-                }
-                final_error_message = error_map_generation.get(reason, 'generic_api_error')
-                logging.info(f"  DEBUG: API Error Reason: {reason}, Mapped: {final_error_message}")
-                return {'status': 'error', 'message': final_error_message}
-            except json.JSONDecodeError:
-                logging.error(f"  DEBUG: Could not decode API error response as JSON. Raw text: {response.text[:500]}")
-                return {'status': 'error', 'message': 'generic_api_error: non_json_error_response'}
-            except Exception as e:
-                logging.error(f"  DEBUG: Error processing non-200 API response: {e}")
-                return {'status': 'error', 'message': f'generic_api_error: {str(e)}'}
+        if response.status_code != 200:
+            return parse_generation_error(error_body)
+        try:
+            # El cuerpo se lee por trozos: cada imagen se decodifica directamente
+            # a su fichero y sólo el resto del JSON (sin el base64) queda en memoria.
+            with stage_timer('decode'):
+                skeleton, stored_ids = extract_encoded_images(
+                    iter_limited(response, MAX_RESPONSE_BYTES), generated_images.writer)
+        except ResponseTooLarge:
+            raise
+        except Exception as e:
+            logging.error("Error processing 200 OK API response: %s", e)
+            return {'status': 'error', 'message': f'generic_api_error: {str(e)}'}
+        return collect_generation_result(prompt, skeleton, stored_ids)
 
+    except ResponseTooLarge as e:
+        logging.error("%s. Aborting read.", e)
+        return {'status': 'error', 'message': 'generic_api_error: response_too_large'}
     except requests.exceptions.Timeout:
-        logging.error(f"--- DEBUG: API Request timed out after 180 seconds. ---")
+        logging.error("API request timed out after 180 seconds.", extra={'event': 'upstream_timeout'})
         return {'status': 'error', 'message': 'connection_error: timeout'}
     except requests.exceptions.ConnectionError as e:
-        logging.error(f"--- DEBUG: API Connection Error: {e} ---")
+        logging.error("API connection error: %s", e, extra={'event': 'upstream_error'})
         return {'status': 'error', 'message': f'connection_error: {str(e)}'}
     except Exception as e:
-        logging.error(f"Unhandled exception in main_generator_function: {e}")
-        logging.error(f"Response status: {response.status_code if 'response' in locals() else 'No response'}, Response body: {response.text[:1000] if 'response' in locals() else 'No response'}")
-        return {'status': 'error', 'message': f'connection_error: {str(e)}'}
\ No newline at end of file
+        logging.error("Unhandled exception in main_generator_function: %s (response status: %s)",
+                      e, response.status_code if response is not None else 'no response')
+        return {'status': 'error', 'message': f'connection_error: {str(e)}'}
+    finally:
+        if response is not None:
+            response.close()
\ No newline at end of file